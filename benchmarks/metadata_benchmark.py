@@ -0,0 +1,140 @@
+"""
+Times the metadata paths of the package against a synthetic local database.
+
+The database is created with `pharmbio.database.synthetic.create_synthetic_database`, so the
+benchmark never touches the production server. Every path is timed cold (empty query cache and
+plate layout provider) and, where a cache applies, warm.
+
+Usage:
+    python -m benchmarks.metadata_benchmark
+    python -m benchmarks.metadata_benchmark --projects 8 --plates-per-project 200 --repeat 5
+"""
+import argparse
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from pharmbio import config as cfg
+from pharmbio.logger import set_logger_level
+from pharmbio.database.connection import clear_query_cache, dispose_engines
+from pharmbio.database.fetch import fetch_concurrently
+from pharmbio.database.plate_layout import plate_layout_provider, get_plate_layout
+from pharmbio.database.synthetic import create_synthetic_database
+from pharmbio.dataset.experiment import get_projects_list
+from pharmbio.dataset.image_quality import get_image_quality_ref
+from pharmbio.dataset.cell_morphology import (
+    get_cell_morphology_ref,
+    _merge_with_plate_info,
+)
+
+
+def _time(function, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def _cold():
+    clear_query_cache()
+    plate_layout_provider.clear()
+
+
+def _image_rows(layout_df, sites_per_well):
+    """One row per image of the plates, shaped like the image quality data."""
+    wells_df = layout_df.select(
+        pl.col("barcode").alias(cfg.METADATA_BARCODE_COLUMN),
+        pl.col("well_id").alias(cfg.METADATA_WELL_COLUMN),
+    )
+    return wells_df.select(
+        pl.all().repeat_by(sites_per_well).explode(),
+    ).with_columns(
+        pl.Series(
+            cfg.METADATA_SITE_COLUMN,
+            np.tile(np.arange(1, sites_per_well + 1), wells_df.height),
+        ),
+        pl.lit(0.5).alias("ImageQuality_FocusScore_HOECHST"),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--projects", type=int, default=4)
+    parser.add_argument("--plates-per-project", type=int, default=50)
+    parser.add_argument("--wells-per-plate", type=int, default=384, choices=[96, 384])
+    parser.add_argument("--sites-per-well", type=int, default=9)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    set_logger_level("ERROR")
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        cfg.CACHE_DIRECTORY = str(Path(temporary_dir) / "cache")
+        # The warm timings read the query results from the cache, which is off by default
+        cfg.QUERY_CACHE = True
+        cfg.DB_URI = create_synthetic_database(
+            Path(temporary_dir) / "synthetic.db",
+            n_projects=args.projects,
+            plates_per_project=args.plates_per_project,
+            wells_per_plate=args.wells_per_plate,
+        )
+
+        project = "synthetic-project-0"
+        barcodes = get_cell_morphology_ref(project)["plate_barcode"].unique().to_list()
+        image_df = _image_rows(get_plate_layout(barcodes), args.sites_per_well)
+
+        cases = [
+            ("projects list", get_projects_list, True),
+            ("image quality reference", lambda: get_image_quality_ref(project), True),
+            ("cell morphology reference", lambda: get_cell_morphology_ref(project), True),
+            (
+                "cell morphology reference, filtered",
+                lambda: get_cell_morphology_ref(
+                    project, filter={"plate_barcode": {"in": barcodes[:2]}}
+                ),
+                True,
+            ),
+            (
+                "both references, concurrently",
+                lambda: fetch_concurrently(
+                    {
+                        "image_quality": (get_image_quality_ref, project),
+                        "cell_morphology": (get_cell_morphology_ref, project),
+                    }
+                ),
+                False,
+            ),
+            (f"plate layout, {len(barcodes)} plates", lambda: get_plate_layout(barcodes), True),
+            (
+                f"layout join, {image_df.height} images",
+                lambda: _merge_with_plate_info(image_df),
+                True,
+            ),
+        ]
+
+        print(
+            f"{args.projects} projects x {args.plates_per_project} plates x {args.wells_per_plate} wells, "
+            f"median of {args.repeat} runs in ms"
+        )
+        print(f"{'path':<45}{'cold':>10}{'cached':>10}")
+        for name, function, cached in cases:
+            cold_time = _time(function, args.repeat, setup=_cold)
+            if cached:
+                function()
+                warm_time = f"{_time(function, args.repeat) * 1000:>10.1f}"
+            else:
+                warm_time = f"{'-':>10}"
+            print(f"{name:<45}{cold_time * 1000:>10.1f}{warm_time}")
+
+        dispose_engines()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Times the multivariate methods of `flag_outlier_images` on synthetic plates and compares their detection with "SD".
+
+Every plate has correlated channels, a few gross outliers in one channel and a few subtle
+outliers that are moderately off in two channels at once (e.g. slightly defocused and dim).
+
+Usage:
+    python -m benchmarks.multivariate_qc_benchmark
+    python -m benchmarks.multivariate_qc_benchmark --images 1000000 --max-workers 8
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+import polars as pl
+
+from pharmbio import config as cfg
+from pharmbio.data_processing.quality_control import flag_outlier_images
+
+CHANNELS = ["CONC", "HOECHST", "ICF", "MITO", "PHAandWGA"]
+MODULES = ["FocusScore", "MaxIntensity", "MeanIntensity", "PowerLogLogSlope", "StdIntensity"]
+IMAGES_PER_PLATE = 384 * 9
+
+
+def _synthetic_plates(n_images, gross_fraction=0.002, subtle_fraction=0.002, seed=0):
+    rng = np.random.default_rng(seed)
+    n_plates = -(-n_images // IMAGES_PER_PLATE)
+    barcodes = np.repeat([f"PB{i:06d}" for i in range(n_plates)], IMAGES_PER_PLATE)
+    columns = {cfg.METADATA_BARCODE_COLUMN: barcodes[:n_images]}
+
+    gross = rng.random(n_images) < gross_fraction
+    subtle = ~gross & (rng.random(n_images) < subtle_fraction)
+    n_channels = len(CHANNELS)
+    covariance = 0.8 * np.ones((n_channels, n_channels)) + 0.2 * np.eye(n_channels)
+    for module in MODULES:
+        values = rng.multivariate_normal(np.zeros(n_channels), covariance, n_images)
+        # Plate-to-plate shifts
+        values += np.repeat(rng.normal(0, 0.5, (n_plates, 1)), IMAGES_PER_PLATE, axis=0)[
+            :n_images
+        ]
+        values[gross, 0] += 10
+        values[subtle, 0] += 2
+        values[subtle, 1] -= 2
+        for i, channel in enumerate(CHANNELS):
+            columns[f"ImageQuality_{module}_{channel}"] = values[:, i]
+    return pl.DataFrame(columns), gross, subtle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=100_000)
+    parser.add_argument("--max-workers", type=int, default=None)
+    args = parser.parse_args()
+
+    qc_data, gross, subtle = _synthetic_plates(args.images)
+    inliers = ~gross & ~subtle
+    print(
+        f"{args.images} images on {qc_data[cfg.METADATA_BARCODE_COLUMN].n_unique()} plates, "
+        f"{len(MODULES)} modules x {len(CHANNELS)} channels"
+    )
+    print(f"{'method':<14}{'time (s)':>10}{'gross':>10}{'subtle':>10}{'inliers':>10}  (flagged fraction)")
+    for method in ["SD", "mahalanobis", "isolation"]:
+        start = time.perf_counter()
+        # flag_outlier_images displays a summary of the flags, keep the output clean
+        with contextlib.redirect_stdout(io.StringIO()):
+            flagged_qc_data = flag_outlier_images(
+                qc_data,
+                module_to_keep=set(MODULES),
+                method=method,
+                normalize_by="plate" if method == "SD" else None,
+                max_workers=args.max_workers,
+            )
+        elapsed = time.perf_counter() - start
+        flags = flagged_qc_data["outlier_flag"].to_numpy().astype(bool)
+        print(
+            f"{method:<14}{elapsed:>10.2f}{flags[gross].mean():>10.3f}"
+            f"{flags[subtle].mean():>10.3f}{flags[inliers].mean():>10.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Times `flag_outlier_images` on synthetic image quality data and checks its flags against a row-wise reference.
+
+The reference is the previous implementation, which evaluated every image row in Python with
+`DataFrame.map_rows`, with its flags stored as integer columns.
+
+Usage:
+    python -m benchmarks.qc_flagging_benchmark
+    python -m benchmarks.qc_flagging_benchmark --images 100000 --repeat 3
+"""
+import argparse
+import contextlib
+import io
+import time
+from collections import defaultdict
+
+import numpy as np
+import polars as pl
+
+from pharmbio.data_processing.quality_control import (
+    flag_outlier_images,
+    get_qc_data_dict,
+)
+from pharmbio.utils import normalize_df
+
+CHANNELS = ["CONC", "HOECHST", "ICF", "MITO", "PHAandWGA"]
+MODULES = ["FocusScore", "MaxIntensity", "MeanIntensity", "PowerLogLogSlope", "StdIntensity"]
+
+
+def _synthetic_qc_data(n_images, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {
+        "Metadata_Barcode": rng.choice(["PB000001", "PB000002"], n_images),
+        "Metadata_Well": rng.choice(["A01", "B02", "C03"], n_images),
+        "Metadata_Site": rng.integers(1, 10, n_images),
+    }
+    for module in MODULES:
+        for channel in CHANNELS:
+            values = rng.normal(0, 1, n_images)
+            # Heavy tails so that every module has outliers
+            values[rng.random(n_images) < 0.002] *= 20
+            columns[f"ImageQuality_{module}_{channel}"] = values
+    return pl.DataFrame(columns)
+
+
+def _row_wise_flags(qc_data, method, sd_step=(-4.5, 4.5), quantile_limit=0.25, multiplier=1.5):
+    """The flags of the previous implementation, one Python call per image row and module."""
+    data_frame_dictionary = get_qc_data_dict(qc_data, module_to_keep=set(MODULES))
+    all_sd_step_dict = defaultdict(lambda: sd_step)
+    flags = {}
+    for module in sorted(data_frame_dictionary):
+        current_dataframe = normalize_df(data_frame_dictionary[module], method="zscore")
+        if method == "SD":
+            lower_threshold, upper_threshold = all_sd_step_dict[module]
+            name = f"OutlierSD_{module}_{lower_threshold}_{upper_threshold}"
+        else:
+            lower_quantile = current_dataframe.quantile(quantile_limit)
+            upper_quantile = current_dataframe.quantile(1 - quantile_limit)
+            IQR = upper_quantile - lower_quantile
+            lower_threshold = (lower_quantile - multiplier * IQR).to_numpy().min()
+            upper_threshold = (upper_quantile + multiplier * IQR).to_numpy().max()
+            name = f"OutlierIQR_{module}_{round(lower_threshold, 3)}_{round(upper_threshold, 3)}"
+        flags[name] = [
+            1 if i else 0
+            for i in current_dataframe.map_rows(
+                lambda row: any(
+                    (val < lower_threshold) | (val > upper_threshold) for val in row
+                )
+            ).to_series()
+        ]
+    return pl.DataFrame(flags)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    qc_data = _synthetic_qc_data(args.images)
+    print(f"{args.images} images x {len(MODULES)} modules x {len(CHANNELS)} channels")
+    print(f"{'method':<8}{'row-wise (s)':>14}{'vectorized (s)':>16}{'speed-up':>10}  flags")
+    for method in ["SD", "IQR"]:
+        start = time.perf_counter()
+        reference_flags = _row_wise_flags(qc_data, method)
+        row_wise_time = time.perf_counter() - start
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            # flag_outlier_images displays a summary of the flags, keep the output clean
+            with contextlib.redirect_stdout(io.StringIO()):
+                flagged_qc_data = flag_outlier_images(
+                    qc_data, module_to_keep=set(MODULES), method=method
+                )
+            timings.append(time.perf_counter() - start)
+        vectorized_time = min(timings)
+
+        identical = flagged_qc_data.select(reference_flags.columns).equals(
+            reference_flags
+        )
+        print(
+            f"{method:<8}{row_wise_time:>14.3f}{vectorized_time:>16.3f}"
+            f"{row_wise_time / vectorized_time:>9.0f}x  {'identical' if identical else 'DIFFERENT'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Times `read_file` with the image quality dtype policy on wide synthetic files and checks it against a per-column reference.
+
+The reference is the previous implementation: it read the whole file, counted the nulls of
+every column one at a time and then cast every all-null, Float64 and Int64 column with its own
+`with_columns` call. CSV files are read both by parsing the text and from their parquet copy in
+the conversion cache.
+
+Usage:
+    python -m benchmarks.read_file_benchmark
+    python -m benchmarks.read_file_benchmark --columns 4000 --rows 3456 --repeat 3
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+from pharmbio import config as cfg
+from pharmbio.logger import set_logger_level
+from pharmbio.utils import read_file
+
+
+def _synthetic_wide_df(n_rows, n_columns, null_fraction=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    columns = {
+        "ImageNumber": np.arange(1, n_rows + 1),
+        "Metadata_Barcode": ["PB000001"] * n_rows,
+        "Metadata_Site": rng.integers(1, 10, n_rows),
+    }
+    for i in range(n_columns):
+        if rng.random() < null_fraction:
+            # Measurements that were not computed for this plate
+            columns[f"ImageQuality_Module{i}_CONC"] = pl.Series([None] * n_rows, dtype=pl.Float64)
+        else:
+            columns[f"ImageQuality_Module{i}_CONC"] = rng.normal(size=n_rows)
+    return pl.DataFrame(columns)
+
+
+def _per_column_read_file(filename, extension):
+    """The file read and dtype casts of the previous implementation, one `with_columns` per column."""
+    if extension == ".parquet":
+        df = pl.read_parquet(filename + extension)
+    else:
+        df = pl.read_csv(filename + extension, separator="," if extension == ".csv" else "\t")
+    for name in df.columns:
+        if df[name].is_null().sum() == len(df[name]):
+            df = df.with_columns(df[name].cast(pl.Float32))
+    for name, dtype in zip(df.columns, df.dtypes):
+        if dtype == pl.Float64:
+            df = df.with_columns(pl.col(name).cast(pl.Float32))
+        elif dtype == pl.Int64:
+            df = df.with_columns(pl.col(name).cast(pl.Int32))
+    return df
+
+
+def _best_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--columns", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=3456)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    set_logger_level("ERROR")
+    df = _synthetic_wide_df(args.rows, args.columns)
+    print(f"{args.rows} rows x {df.width} columns, best of {args.repeat} runs")
+    print(f"{'file':<12}{'per-column (s)':>14}{'read_file (s)':>15}{'speed-up':>10}  result")
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        cfg.CACHE_DIRECTORY = str(Path(temporary_dir) / "cache")
+        filename = str(Path(temporary_dir) / "qcRAW_images_PB000001")
+        df.write_parquet(filename + ".parquet")
+        df.write_csv(filename + ".csv")
+
+        for label, extension, use_cache in [
+            ("parquet", ".parquet", False),
+            ("csv", ".csv", False),
+            # Read from the parquet copy of the conversion cache, converted by the first read
+            ("csv cached", ".csv", True),
+        ]:
+            per_column_time, reference_df = _best_time(
+                lambda: _per_column_read_file(filename, extension), args.repeat
+            )
+            if use_cache:
+                read_file(filename, extension, use_cache=True)
+            read_file_time, result_df = _best_time(
+                lambda: read_file(
+                    filename, extension, compact_dtypes=True, use_cache=use_cache
+                ),
+                args.repeat,
+            )
+            print(
+                f"{label:<12}{per_column_time:>14.3f}{read_file_time:>15.3f}"
+                f"{per_column_time / read_file_time:>9.0f}x  "
+                f"{'identical' if result_df.equals(reference_df) and result_df.schema == reference_df.schema else 'DIFFERENT'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
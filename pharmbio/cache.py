@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import polars as pl
+from pathlib import Path
+from typing import Optional, Dict, Any
+from . import config as cfg
+from .logger import (
+    log_debug,
+    log_info,
+    log_warning,
+)
+
+
+def file_fingerprint(file_path: str) -> Dict[str, Any]:
+    """
+    Returns the identity of a file as used in cache keys: its absolute path, size and modification time.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Returns:
+        Dict[str, Any]: A dictionary with the "path", "size" and "mtime_ns" of the file.
+
+    Example:
+        ```python
+        fingerprint = file_fingerprint("results/featICF_cells.parquet")
+        print(fingerprint)
+        ```
+    """
+    stat = os.stat(file_path)
+    return {
+        "path": os.path.abspath(file_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Returns a content address for the given parts by hashing their JSON representation.
+
+    Args:
+        *parts (Any): JSON serializable values (lists, dicts, strings, numbers) describing the inputs and settings of a result. Other values are converted with `str`.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest of the parts.
+
+    Example:
+        ```python
+        key = make_cache_key("cell_morphology_plate", file_fingerprint(path), {"aggregation_level": "well"})
+        ```
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    A size-bounded, content-addressed on-disk store of dataframes.
+
+    Each entry is a parquet file named after its key, with a JSON metadata file next to it
+    recording the namespace and creation time of the entry. Entries are written and removed
+    one file at a time, so several threads and processes (e.g. the workers of
+    `get_cell_morphology_data` or parallel sessions) can share the directory without
+    overwriting each other's entries. Reading an entry only updates the modification time of
+    its parquet file, which serves as the last access time, and the least recently used
+    entries are evicted when the total size exceeds `max_size_gb`.
+
+    Args:
+        directory (str, optional): The cache directory. Defaults to `config.CACHE_DIRECTORY`.
+        max_size_gb (float, optional): The maximum total size of the cached files in GB. Defaults to `config.CACHE_MAX_SIZE_GB`.
+
+    Example:
+        ```python
+        cache = ResultCache()
+        key = make_cache_key("my_result", settings)
+        df = cache.get(key)
+        if df is None:
+            df = compute(settings)
+            cache.put(key, df, namespace="my_result")
+
+        cache.invalidate(namespace="my_result")  # drop all entries of a kind
+        cache.clear()  # drop everything
+        ```
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_size_gb: Optional[float] = None):
+        self.directory = Path(directory or cfg.CACHE_DIRECTORY)
+        self.max_size_gb = cfg.CACHE_MAX_SIZE_GB if max_size_gb is None else max_size_gb
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, key: str) -> Path:
+        return self.directory / f"{key}.parquet"
+
+    def _metadata_path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _temporary_path(self, path: Path) -> Path:
+        # Unique per writer, so concurrent writers of the same key do not share a file
+        return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def _read_metadata(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._metadata_path(key), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            log_warning(
+                f"Cache metadata is corrupted, the entry is ignored: {self._metadata_path(key)}"
+            )
+            return None
+
+    def _lookup(self, key: str, max_age: Optional[float]) -> Optional[Dict[str, Any]]:
+        """Returns the metadata of a valid entry and marks it as used, or None if there is no such entry.
+
+        Parameters:
+            key (str): The cache key.
+            max_age (float, optional): The maximum age of the entry in seconds since it was stored.
+
+        Returns:
+            Optional[Dict[str, Any]]: The metadata of the entry.
+        """
+        metadata = self._read_metadata(key)
+        if metadata is None:
+            return None
+        if max_age is not None and time.time() - metadata["created"] > max_age:
+            return None
+        try:
+            # The modification time of the parquet file is the last access time of the entry
+            os.utime(self._entry_path(key))
+        except FileNotFoundError:
+            return None
+        return metadata
+
+    def _entries(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the namespace, size and last access time of every entry, read from the directory."""
+        entries = {}
+        for metadata_path in self.directory.glob("*.json"):
+            key = metadata_path.stem
+            metadata = self._read_metadata(key)
+            if metadata is None:
+                continue
+            try:
+                stat = self._entry_path(key).stat()
+            except FileNotFoundError:
+                # Removed by another process, or not written completely
+                continue
+            entries[key] = {
+                **metadata,
+                "size": stat.st_size,
+                "last_access": stat.st_mtime,
+            }
+        return entries
+
+    def _remove(self, key: str):
+        # The metadata goes first, so the entry is never found without its parquet file
+        self._metadata_path(key).unlink(missing_ok=True)
+        self._entry_path(key).unlink(missing_ok=True)
+
+    def __contains__(self, key: str) -> bool:
+        return self._metadata_path(key).exists() and self._entry_path(key).exists()
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[pl.DataFrame]:
+        """
+        Returns the dataframe stored under the key, or None if there is no such entry.
+
+        Args:
+            key (str): The cache key.
+            max_age (float, optional): The maximum age of the entry in seconds since it was stored. Older entries are treated as missing but are kept. Defaults to None (any age).
+
+        Returns:
+            Optional[pl.DataFrame]: The cached dataframe.
+        """
+        metadata = self._lookup(key, max_age)
+        if metadata is None:
+            return None
+        entry_path = self._entry_path(key)
+        try:
+            df = pl.read_parquet(entry_path)
+        except FileNotFoundError:
+            # Evicted by another process since the lookup
+            return None
+        log_debug(f"Cache hit ({metadata['namespace']}): {entry_path}")
+        return df
+
+    def get_path(self, key: str, max_age: Optional[float] = None) -> Optional[Path]:
+        """
+        Returns the parquet file of the entry stored under the key, or None if there is no such entry.
+
+        Unlike `get`, the file is not read, so it can be scanned lazily, e.g. with a column projection.
+
+        Args:
+            key (str): The cache key.
+            max_age (float, optional): The maximum age of the entry in seconds since it was stored. Older entries are treated as missing but are kept. Defaults to None (any age).
+
+        Returns:
+            Optional[Path]: The path of the cached parquet file.
+        """
+        metadata = self._lookup(key, max_age)
+        if metadata is None:
+            return None
+        entry_path = self._entry_path(key)
+        log_debug(f"Cache hit ({metadata['namespace']}): {entry_path}")
+        return entry_path
+
+    def put(self, key: str, df: pl.DataFrame, namespace: str = "default") -> Path:
+        """
+        Stores the dataframe under the key and evicts the least recently used entries if the cache grew too large.
+
+        Args:
+            key (str): The cache key.
+            df (pl.DataFrame): The dataframe to store.
+            namespace (str, optional): A label for the kind of result, used by `invalidate`. Defaults to "default".
+
+        Returns:
+            Path: The path of the cached parquet file.
+        """
+        temporary_path = self._temporary_path(self._entry_path(key))
+        df.write_parquet(temporary_path)
+        return self._add_entry(key, temporary_path, namespace)
+
+    def put_file(self, key: str, file_path: str, namespace: str = "default") -> Path:
+        """
+        Stores a copy of a parquet file under the key, without reading it into memory.
+
+        Args:
+            key (str): The cache key.
+            file_path (str): The parquet file to store, e.g. a result written by a worker process.
+            namespace (str, optional): A label for the kind of result, used by `invalidate`. Defaults to "default".
+
+        Returns:
+            Path: The path of the cached parquet file.
+        """
+        temporary_path = self._temporary_path(self._entry_path(key))
+        shutil.copyfile(file_path, temporary_path)
+        return self._add_entry(key, temporary_path, namespace)
+
+    def _add_entry(self, key: str, temporary_path: Path, namespace: str) -> Path:
+        """Moves a written parquet file into place, records its metadata and evicts old entries.
+
+        Parameters:
+            key (str): The cache key.
+            temporary_path (Path): The parquet file written for the entry.
+            namespace (str): The namespace of the entry.
+
+        Returns:
+            Path: The path of the cached parquet file.
+        """
+        entry_path = self._entry_path(key)
+        os.replace(temporary_path, entry_path)
+
+        metadata_path = self._metadata_path(key)
+        temporary_path = self._temporary_path(metadata_path)
+        with open(temporary_path, "w") as file:
+            json.dump({"namespace": namespace, "created": time.time()}, file)
+        os.replace(temporary_path, metadata_path)
+
+        self._evict()
+        return entry_path
+
+    def invalidate(self, key: Optional[str] = None, namespace: Optional[str] = None) -> int:
+        """
+        Removes the entry with the given key and/or all entries of the given namespace.
+
+        Args:
+            key (str, optional): The key of the entry to remove.
+            namespace (str, optional): The namespace whose entries are removed.
+
+        Returns:
+            int: The number of removed entries.
+        """
+        keys_to_remove = [
+            entry_key
+            for entry_key, entry in self._entries().items()
+            if entry_key == key or (namespace is not None and entry["namespace"] == namespace)
+        ]
+        for entry_key in keys_to_remove:
+            self._remove(entry_key)
+        return len(keys_to_remove)
+
+    def clear(self) -> int:
+        """
+        Removes all entries from the cache.
+
+        Returns:
+            int: The number of removed entries.
+        """
+        entry_keys = list(self._entries())
+        for entry_key in entry_keys:
+            self._remove(entry_key)
+        return len(entry_keys)
+
+    def _evict(self):
+        max_size = self.max_size_gb * 1024**3
+        entries = self._entries()
+        total_size = sum(entry["size"] for entry in entries.values())
+        for entry_key in sorted(entries, key=lambda k: entries[k]["last_access"]):
+            if total_size <= max_size:
+                break
+            total_size -= entries[entry_key]["size"]
+            self._remove(entry_key)
+            log_info(f"Evicted least recently used cache entry: {entry_key}")
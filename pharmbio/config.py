@@ -24,6 +24,45 @@ import os
 
 DB_URI = os.environ.get("DB_URI")
 
+# Connection pool of the shared database engine (see pharmbio.database.connection)
+DB_POOL_SIZE = 5  # connections kept open
+DB_POOL_MAX_OVERFLOW = 10  # extra connections opened under load
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection
+DB_POOL_RECYCLE = 1800  # seconds after which a connection is replaced
+DB_FETCH_MAX_WORKERS = 4  # queries run concurrently in the background (see database.fetch)
+DB_PARTITION_PLATES = 50  # plates per partition query of a plate layout read
+
+# Query results can be cached on disk in CACHE_DIRECTORY (see database.connection.read_database).
+# The cache is off by default: a cached result is served for up to QUERY_CACHE_TTL seconds, so
+# e.g. a plate that finished its analysis in the meantime is not seen until the result expires.
+# Enable it for sessions on a slow database, or with the PHARMBIO_QUERY_CACHE=1 environment
+# variable. In offline mode, set with PHARMBIO_OFFLINE=1, queries are only served from the
+# cache and the database is never contacted.
+QUERY_CACHE = os.environ.get("PHARMBIO_QUERY_CACHE", "0") == "1"
+QUERY_CACHE_TTL = 3600  # seconds before a cached query result is fetched again
+DB_OFFLINE = os.environ.get("PHARMBIO_OFFLINE", "0") == "1"
+
+# ---------------------------------------------------------------------------- #
+#                                 CACHE SETTING                                #
+#  Directory and maximum size of the on-disk cache of computed results. The    #
+#  directory can also be set with the PHARMBIO_CACHE_DIR environment variable. #
+# ---------------------------------------------------------------------------- #
+CACHE_DIRECTORY = os.environ.get(
+    "PHARMBIO_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pharmbio")
+)
+CACHE_MAX_SIZE_GB = 50
+# CSV/TSV result files are converted to parquet in the cache on first read (see conversion)
+CSV_CONVERSION_CACHE = os.environ.get("PHARMBIO_CSV_CONVERSION_CACHE", "1") == "1"
+CSV_CONVERSION_MAX_WORKERS = 8  # files converted concurrently by convert_csv_files
+
+# ---------------------------------------------------------------------------- #
+#                               STREAMING SETTING                              #
+#  Estimated memory needed to process a plate, as a multiple of the size of    #
+#  its object feature files on disk. Used to fit the plates processed at the   #
+#  same time into the memory_budget_gb of get_cell_morphology_data.            #
+# ---------------------------------------------------------------------------- #
+PLATE_MEMORY_EXPANSION_FACTOR = 5
+
 # ---------------------------------------------------------------------------- #
 #                                DATABASE SCHEMA                               #
 # ---------------------------------------------------------------------------- #
@@ -83,6 +122,7 @@ IMAHGE_QUALITY_METADATA_TYPE = "cp-qc"
 #  for each plate and retrived from csv/parquet file in the result directory.  #
 # ---------------------------------------------------------------------------- #
 IMAGE_QUALITY_FILE_PREFIX = "qcRAW_images"
+IMAGE_QUALITY_READ_MAX_WORKERS = 8  # plate files located and read concurrently
 
 # ---------------------- CELL MORPHOLOGY METADATA SCHEMA --------------------- #
 #  The dataframe that include the metadata for the cell morphology data and    #
@@ -99,6 +139,24 @@ METADATA_BARCODE_COLUMN = "Metadata_Barcode"
 METADATA_WELL_COLUMN = "Metadata_Well"
 METADATA_SITE_COLUMN = "Metadata_Site"
 
+# ---------------------------------------------------------------------------- #
+#                             COMPACT DTYPE POLICY                             #
+#  Used by get_cell_morphology_data(compact_dtypes=True): features are read as #
+#  COMPACT_FLOAT_DTYPE and these string metadata columns become Categorical.   #
+# ---------------------------------------------------------------------------- #
+import polars as pl
+
+COMPACT_FLOAT_DTYPE = pl.Float32
+
+CATEGORICAL_METADATA_COLUMNS = [
+    METADATA_BARCODE_COLUMN,
+    METADATA_WELL_COLUMN,
+    "batch_id",
+    "compound_name",
+    "smiles",
+    "inchi",
+]
+
 # ---------------------------------------------------------------------------- #
 #              IMAGE NUMBER COLUMN NAME IN IMAGE QUALITY DATA FILE             #
 # ---------------------------------------------------------------------------- #
@@ -137,10 +195,94 @@ CONSTRUCTING_IMAGE_ID = (
     + pl.col(METADATA_SITE_COLUMN).cast(pl.Utf8)
 ).alias(IMAGE_ID_COLUMN_NAME)
 
+# ---------------------------------------------------------------------------- #
+#                   COMPACT INTEGER KEYS FOR WELL, IMAGE AND CELL              #
+#  String IDs above are expensive for tens of millions of cells, so joins,     #
+#  filters and groupings of the morphology data use UInt64 keys instead:       #
+#                                                                              #
+#    well_key  = AcqID (25 bits) | well row (5 bits) | well column (6 bits)    #
+#    image_key = well_key | site (8 bits)                                      #
+#    cell_key  = image_key | ObjectNumber (20 bits)                            #
+#                                                                              #
+#  Well rows "A".."Z", "AA".."AF" map to 0..31 (up to 1536-well plates). The   #
+#  string IDs are only built on request when the data is returned. Values      #
+#  that do not fit their field are rejected, see `KEY_FIELD_BITS`.             #
+# ---------------------------------------------------------------------------- #
+WELL_KEY_COLUMN_NAME = "well_key"
+IMAGE_KEY_COLUMN_NAME = "image_key"
+CELL_KEY_COLUMN_NAME = "cell_key"
+
+# Widths of the key fields, 64 bits in total
+KEY_ACQID_BITS = 25
+KEY_WELL_ROW_BITS = 5
+KEY_WELL_COLUMN_BITS = 6
+KEY_SITE_BITS = 8
+KEY_OBJECT_NUMBER_BITS = 20
+
+# Bits below the AcqID in the well key and in the image key
+WELL_KEY_ACQID_SHIFT = KEY_WELL_ROW_BITS + KEY_WELL_COLUMN_BITS
+IMAGE_KEY_ACQID_SHIFT = WELL_KEY_ACQID_SHIFT + KEY_SITE_BITS
+
+_WELL_ROW_BASE36 = (
+    pl.col(METADATA_WELL_COLUMN)
+    .cast(pl.Utf8)
+    .str.extract(r"^([A-Za-z]+)", 1)
+    .str.to_integer(base=36)
+)
+
+# Row index (0 for "A", 26 for "AA") and column number of the well, null if the name does not parse
+WELL_ROW_INDEX = (
+    pl.when(_WELL_ROW_BASE36 > 35)
+    .then(_WELL_ROW_BASE36 - 344)
+    .otherwise(_WELL_ROW_BASE36 - 10)
+)
+WELL_COLUMN_NUMBER = (
+    pl.col(METADATA_WELL_COLUMN).cast(pl.Utf8).str.extract(r"(\d+)$", 1).cast(pl.Int64)
+)
+
+# The column, value and width of every key field, the object number is the one of the cells
+KEY_FIELD_BITS = {
+    "AcqID": (
+        METADATA_ACQID_COLUMN,
+        pl.col(METADATA_ACQID_COLUMN).cast(pl.Int64),
+        KEY_ACQID_BITS,
+    ),
+    "well row": (METADATA_WELL_COLUMN, WELL_ROW_INDEX, KEY_WELL_ROW_BITS),
+    "well column": (METADATA_WELL_COLUMN, WELL_COLUMN_NUMBER, KEY_WELL_COLUMN_BITS),
+    "site": (
+        METADATA_SITE_COLUMN,
+        pl.col(METADATA_SITE_COLUMN).cast(pl.Int64),
+        KEY_SITE_BITS,
+    ),
+    "object number": (
+        OBJECT_ID_COLUMN,
+        pl.col(OBJECT_ID_COLUMN).cast(pl.Int64),
+        KEY_OBJECT_NUMBER_BITS,
+    ),
+}
+
+CONSTRUCTING_WELL_KEY = (
+    pl.col(METADATA_ACQID_COLUMN).cast(pl.UInt64) * 2**WELL_KEY_ACQID_SHIFT
+    + WELL_ROW_INDEX.cast(pl.UInt64) * 2**KEY_WELL_COLUMN_BITS
+    + WELL_COLUMN_NUMBER.cast(pl.UInt64)
+).alias(WELL_KEY_COLUMN_NAME)
+
+CONSTRUCTING_IMAGE_KEY = (
+    CONSTRUCTING_WELL_KEY * 2**KEY_SITE_BITS
+    + pl.col(METADATA_SITE_COLUMN).cast(pl.UInt64)
+).alias(IMAGE_KEY_COLUMN_NAME)
+
+# The object number of the joined objects is the one of the cells, see `OBJECT_FILE_NAMES`
+CONSTRUCTING_CELL_KEY = (
+    pl.col(IMAGE_KEY_COLUMN_NAME) * 2**KEY_OBJECT_NUMBER_BITS
+    + pl.col(f"{OBJECT_ID_COLUMN}_cells").cast(pl.UInt64)
+).alias(CELL_KEY_COLUMN_NAME)
+
+# The cell ID is built from the image ID and the object number stored in the cell key
 CONSTRUCTING_CELL_ID = (
-    pl.col(IMAGE_ID_COLUMN_NAME).cast(pl.Utf8)
+    pl.col(IMAGE_ID_COLUMN_NAME)
     + "_"
-    + pl.col(OBJECT_ID_COLUMN).cast(pl.Utf8)
+    + (pl.col(CELL_KEY_COLUMN_NAME) % 2**KEY_OBJECT_NUMBER_BITS).cast(pl.Utf8)
 ).alias(CELL_ID_COLUMN_NAME)
 
 # --------------------- Aggregation method for each level -------------------- #
@@ -156,31 +298,13 @@ AGGREGATION_METHOD_DICT = {
 
 # ---------------------------------------------------------------------------- #
 #            Mapping of aggregation levels to their grouping columns           #
+#  Metadata such as barcode, well or batch_id depends on the key of a level    #
+#  and is carried along with the first value of each group.                    #
 # ---------------------------------------------------------------------------- #
 GROUPING_COLUMN_MAP = {
-    "cell": [
-        "cell_id",
-        "image_id",
-        METADATA_ACQID_COLUMN,
-        METADATA_BARCODE_COLUMN,
-        METADATA_WELL_COLUMN,
-        METADATA_SITE_COLUMN,
-        DATABASE_SCHEMA["PLATE_COMPOUND_NAME_COLUMN"],
-    ],
-    "site": [
-        "image_id",
-        METADATA_ACQID_COLUMN,
-        METADATA_BARCODE_COLUMN,
-        METADATA_WELL_COLUMN,
-        METADATA_SITE_COLUMN,
-        DATABASE_SCHEMA["PLATE_COMPOUND_NAME_COLUMN"],
-    ],
-    "well": [
-        METADATA_ACQID_COLUMN,
-        METADATA_BARCODE_COLUMN,
-        METADATA_WELL_COLUMN,
-        DATABASE_SCHEMA["PLATE_COMPOUND_NAME_COLUMN"],
-    ],
+    "cell": [CELL_KEY_COLUMN_NAME],
+    "site": [IMAGE_KEY_COLUMN_NAME],
+    "well": [WELL_KEY_COLUMN_NAME],
     "plate": [
         METADATA_ACQID_COLUMN,
         METADATA_BARCODE_COLUMN,
@@ -212,6 +336,12 @@ DEFAULT_QC_MODULES = {
     "StdIntensity",
 }
 
+# Image quality columns are named "ImageQuality_<module>_<channel>[_<scale>]"
+IMAGE_QUALITY_COLUMN_PREFIX = "ImageQuality_"
+
+# Number of schemas whose parsed image quality column index is kept in memory
+QC_COLUMN_INDEX_CACHE_SIZE = 32
+
 # ---------------------------------------------------------------------------- #
 #                              PLOT DECRETE COLOR                              #
 # ---------------------------------------------------------------------------- #
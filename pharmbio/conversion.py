@@ -0,0 +1,196 @@
+import os
+import glob
+import argparse
+import polars as pl
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union, List, Dict
+from . import config as cfg
+from .cache import ResultCache, file_fingerprint, make_cache_key
+from .logger import (
+    log_info,
+    log_warning,
+)
+
+CSV_CONVERSION_NAMESPACE = "csv_conversion"
+CSV_SEPARATORS = {".csv": ",", ".tsv": "\t"}
+
+
+def _conversion_key(file_path: str) -> str:
+    """Returns the cache key of the parquet copy of a file, which changes with the path, size and modification time of the file.
+
+    Parameters:
+        file_path (str): The CSV/TSV file.
+
+    Returns:
+        str: The cache key.
+    """
+    return make_cache_key(CSV_CONVERSION_NAMESPACE, file_fingerprint(file_path))
+
+
+def get_converted_csv(file_path: str, cache_dir: Optional[str] = None) -> Optional[Path]:
+    """
+    Returns the parquet copy of a CSV/TSV file in the cache, if the file was converted and has not changed since.
+
+    Args:
+        file_path (str): The CSV/TSV file.
+        cache_dir (str, optional): The cache directory. Defaults to `config.CACHE_DIRECTORY`.
+
+    Returns:
+        Optional[Path]: The parquet file, or None if the file was not converted yet.
+    """
+    return ResultCache(cache_dir).get_path(_conversion_key(file_path))
+
+
+def convert_csv_to_parquet(
+    file_path: str, cache_dir: Optional[str] = None, refresh: bool = False
+) -> Path:
+    """
+    Returns the parquet copy of a CSV/TSV file, converting the file on first use.
+
+    The copy is stored in the result cache (see `pharmbio.cache.ResultCache`) under a key of
+    the path, size and modification time of the file, so result directories are never written
+    to and a changed file is converted again. The columns keep the types `pl.read_csv` infers,
+    so reading the copy gives the same dataframe as parsing the file.
+
+    Args:
+        file_path (str): The CSV/TSV file.
+        cache_dir (str, optional): The cache directory. Defaults to `config.CACHE_DIRECTORY`.
+        refresh (bool, optional): Whether to convert the file even if a copy is cached. Defaults to False.
+
+    Returns:
+        Path: The parquet file.
+
+    Raises:
+        ValueError: If the file is not a CSV/TSV file.
+
+    Example:
+        ```python
+        parquet_path = convert_csv_to_parquet("results/PB000123/qcRAW_images_PB000123.csv")
+        df = pl.read_parquet(parquet_path)
+        ```
+    """
+    extension = os.path.splitext(file_path)[1]
+    if extension not in CSV_SEPARATORS:
+        raise ValueError(f"Only {list(CSV_SEPARATORS)} files can be converted: {file_path}")
+
+    cache = ResultCache(cache_dir)
+    key = _conversion_key(file_path)
+    if not refresh and (parquet_path := cache.get_path(key)) is not None:
+        return parquet_path
+
+    df = pl.read_csv(file_path, separator=CSV_SEPARATORS[extension])
+    parquet_path = cache.put(key, df, namespace=CSV_CONVERSION_NAMESPACE)
+    log_info(f"Converted {df.shape} to parquet: {file_path} -> {parquet_path}")
+    return parquet_path
+
+
+def find_csv_files(
+    directories: Union[str, List[str]],
+    pattern: str = f"{cfg.IMAGE_QUALITY_FILE_PREFIX}*",
+) -> List[str]:
+    """
+    Returns the CSV/TSV files whose name matches the pattern in the directories and their subdirectories.
+
+    Args:
+        directories (Union[str, List[str]]): The directories to search, e.g. result directories of experiments.
+        pattern (str, optional): The glob pattern of the file names, without extension. Defaults to the image quality files (`config.IMAGE_QUALITY_FILE_PREFIX` + "*").
+
+    Returns:
+        List[str]: The sorted file paths.
+    """
+    if isinstance(directories, (str, Path)):
+        directories = [directories]
+    return sorted(
+        {
+            file_path
+            for directory in directories
+            for extension in CSV_SEPARATORS
+            for file_path in glob.glob(
+                os.path.join(directory, "**", pattern + extension), recursive=True
+            )
+        }
+    )
+
+
+def convert_csv_files(
+    directories: Union[str, List[str]],
+    pattern: str = f"{cfg.IMAGE_QUALITY_FILE_PREFIX}*",
+    max_workers: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    refresh: bool = False,
+) -> Dict[str, Path]:
+    """
+    Converts all CSV/TSV files of the result directories to parquet copies in the cache, in parallel.
+
+    Run it once on the result directories of a legacy experiment so that all later sessions
+    read its files from parquet (see `convert_csv_to_parquet`). Files that are already converted
+    and did not change are skipped. It can also be run from the command line:
+    `python -m pharmbio.conversion /share/data/cellprofiler/automation/results/PB000123 --max-workers 16`.
+
+    Args:
+        directories (Union[str, List[str]]): The directories to convert, searched recursively.
+        pattern (str, optional): The glob pattern of the file names, without extension. Defaults to the image quality files (`config.IMAGE_QUALITY_FILE_PREFIX` + "*").
+        max_workers (int, optional): The number of files converted concurrently. Defaults to None (`config.CSV_CONVERSION_MAX_WORKERS`).
+        cache_dir (str, optional): The cache directory. Defaults to `config.CACHE_DIRECTORY`.
+        refresh (bool, optional): Whether to convert files even if a copy is cached. Defaults to False.
+
+    Returns:
+        Dict[str, Path]: The parquet copy of every converted file. Files that fail to convert are logged and left out.
+
+    Example:
+        ```python
+        qc_ref_df = get_image_quality_ref("AROS-Reproducibility-MoA-Full")
+        convert_csv_files(qc_ref_df["results"].unique().to_list(), max_workers=16)
+        ```
+    """
+    file_paths = find_csv_files(directories, pattern)
+
+    # CSV parsing and parquet writing release the GIL, the files are converted in threads
+    parquet_paths = {}
+    with ThreadPoolExecutor(
+        max_workers=max_workers or cfg.CSV_CONVERSION_MAX_WORKERS,
+        thread_name_prefix="pharmbio-conversion",
+    ) as executor:
+        futures = {
+            file_path: executor.submit(
+                convert_csv_to_parquet, file_path, cache_dir, refresh
+            )
+            for file_path in file_paths
+        }
+        for file_path, future in futures.items():
+            try:
+                parquet_paths[file_path] = future.result()
+            except Exception as error:
+                log_warning(f"Could not convert {file_path}: {error}")
+
+    log_info(f"{len(parquet_paths)} of {len(file_paths)} CSV/TSV files available as parquet")
+    return parquet_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts the CSV/TSV result files of directories to parquet copies in the pharmbio cache."
+    )
+    parser.add_argument("directories", nargs="+", help="The result directories, searched recursively.")
+    parser.add_argument(
+        "--pattern",
+        default=f"{cfg.IMAGE_QUALITY_FILE_PREFIX}*",
+        help="The glob pattern of the file names, without extension.",
+    )
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--refresh", action="store_true", help="Convert files that are already cached.")
+    args = parser.parse_args()
+
+    convert_csv_files(
+        args.directories,
+        pattern=args.pattern,
+        max_workers=args.max_workers,
+        cache_dir=args.cache_dir,
+        refresh=args.refresh,
+    )
+
+
+if __name__ == "__main__":
+    main()
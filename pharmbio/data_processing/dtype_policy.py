@@ -0,0 +1,139 @@
+import polars as pl
+import pandas as pd
+from typing import Union, Optional, List
+from .. import config as cfg
+
+
+def compact_float_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame],
+    columns: Optional[List[str]] = None,
+) -> Union[pl.DataFrame, pl.LazyFrame]:
+    """
+    Casts the Float64 columns of the dataframe to `config.COMPACT_FLOAT_DTYPE` (Float32).
+
+    Args:
+        df (Union[pl.DataFrame, pl.LazyFrame]): The input dataframe.
+        columns (List[str], optional): The columns to consider. Defaults to None (all columns).
+
+    Returns:
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with compact float columns.
+
+    Example:
+        ```python
+        df = compact_float_columns(df, columns=feature_columns)
+        ```
+    """
+    float_columns = [
+        name
+        for name, dtype in df.schema.items()
+        if dtype == pl.Float64 and (columns is None or name in columns)
+    ]
+    return df.with_columns(pl.col(float_columns).cast(cfg.COMPACT_FLOAT_DTYPE))
+
+
+def categorical_metadata_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
+    """
+    Casts the string metadata columns listed in `config.CATEGORICAL_METADATA_COLUMNS` to Categorical.
+
+    Categories of dataframes that are combined later should be created under the same `pl.StringCache()`.
+
+    Args:
+        df (Union[pl.DataFrame, pl.LazyFrame]): The input dataframe.
+
+    Returns:
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with categorical metadata columns.
+    """
+    categorical_columns = [
+        name
+        for name, dtype in df.schema.items()
+        if dtype == pl.Utf8 and name in cfg.CATEGORICAL_METADATA_COLUMNS
+    ]
+    return df.with_columns(pl.col(categorical_columns).cast(pl.Categorical))
+
+
+def get_dtype_report(df: Union[pl.DataFrame, pd.DataFrame]) -> pl.DataFrame:
+    """
+    Reports the memory saved and the precision lost by applying the compact dtype policy to a dataframe.
+
+    The report is computed from a dataframe with the original dtypes, e.g. one plate loaded with
+    `compact_dtypes=False`, and has one row per column that the policy changes.
+
+    Args:
+        df (Union[pl.DataFrame, pd.DataFrame]): The dataframe with the original Float64 and string columns.
+
+    Returns:
+        pl.DataFrame: A dataframe with the columns "column", "dtype", "compact_dtype", "size_mb", "compact_size_mb", "saved_mb",
+        "max_abs_error" and "max_rel_error", sorted by the relative error. The errors are null for categorical columns, which are lossless.
+
+    Example:
+        ```python
+        plate_df = get_cell_morphology_data(cell_morphology_ref_df.head(1), aggregation_level="cell")
+        report = get_dtype_report(plate_df)
+        print(report["saved_mb"].sum(), report["max_rel_error"].max())
+        ```
+    """
+    if isinstance(df, pd.DataFrame):
+        df = pl.from_pandas(df)
+
+    compact_df = categorical_metadata_columns(compact_float_columns(df))
+    changed_columns = [
+        name for name in df.columns if df.schema[name] != compact_df.schema[name]
+    ]
+
+    float_columns = [name for name in changed_columns if df.schema[name] == pl.Float64]
+    abs_errors = df.select(
+        (pl.col(name) - pl.col(name).cast(cfg.COMPACT_FLOAT_DTYPE).cast(pl.Float64))
+        .abs()
+        .max()
+        for name in float_columns
+    ).row(0) if float_columns else []
+    rel_errors = df.select(
+        (
+            (pl.col(name) - pl.col(name).cast(cfg.COMPACT_FLOAT_DTYPE).cast(pl.Float64))
+            / pl.col(name)
+        )
+        .abs()
+        .filter(pl.col(name) != 0)
+        .max()
+        for name in float_columns
+    ).row(0) if float_columns else []
+    errors = {
+        name: (abs_error, rel_error)
+        for name, abs_error, rel_error in zip(float_columns, abs_errors, rel_errors)
+    }
+
+    return pl.DataFrame(
+        {
+            "column": changed_columns,
+            "dtype": [str(df.schema[name]) for name in changed_columns],
+            "compact_dtype": [str(compact_df.schema[name]) for name in changed_columns],
+            "size_mb": [
+                df[name].estimated_size("mb") for name in changed_columns
+            ],
+            "compact_size_mb": [
+                compact_df[name].estimated_size("mb") for name in changed_columns
+            ],
+            "max_abs_error": [
+                errors.get(name, (None, None))[0] for name in changed_columns
+            ],
+            "max_rel_error": [
+                errors.get(name, (None, None))[1] for name in changed_columns
+            ],
+        },
+        schema_overrides={"max_abs_error": pl.Float64, "max_rel_error": pl.Float64},
+    ).with_columns(
+        (pl.col("size_mb") - pl.col("compact_size_mb")).alias("saved_mb")
+    ).select(
+        "column",
+        "dtype",
+        "compact_dtype",
+        "size_mb",
+        "compact_size_mb",
+        "saved_mb",
+        "max_abs_error",
+        "max_rel_error",
+    ).sort(
+        "max_rel_error", descending=True, nulls_last=True
+    )
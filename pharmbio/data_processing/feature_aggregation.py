@@ -9,7 +9,7 @@ from ..logger import (
 
 
 def aggregate_data_cpu(
-    df: Union[pl.DataFrame, pd.DataFrame],
+    df: Union[pl.DataFrame, pl.LazyFrame, pd.DataFrame],
     columns_to_aggregate: List[str],
     groupby_columns: List[str],
     aggregation_function: str = "mean",
@@ -18,14 +18,14 @@ def aggregate_data_cpu(
     Aggregates morphology data using the specified columns and aggregation function.
 
     Args:
-        df (Union[pl.DataFrame, pd.DataFrame]): The input DataFrame to be aggregated.
+        df (Union[pl.DataFrame, pl.LazyFrame, pd.DataFrame]): The input DataFrame to be aggregated. A LazyFrame is aggregated lazily.
         columns_to_aggregate (List[str]): The list of columns to be aggregated.
         groupby_columns (List[str]): The list of columns to group by.
         aggregation_function (str, optional): The aggregation function to be applied. Defaults to "mean" where
         possible values could set to: "mean", median, "sum", "min", "max".
 
     Returns:
-        pl.DataFrame: The aggregated DataFrame.
+        Union[pl.DataFrame, pl.LazyFrame]: The aggregated DataFrame, or the aggregation plan as a LazyFrame if `df` is a LazyFrame.
 
     Examples:
         ```python
@@ -43,7 +43,7 @@ def aggregate_data_cpu(
     if isinstance(df, pd.DataFrame):
         df = pl.from_pandas(df)
 
-    grouped = df.lazy().groupby(groupby_columns)
+    grouped = df.lazy().group_by(groupby_columns)
     agg_exprs = [
         getattr(pl.col(col), aggregation_function)().alias(col)
         for col in columns_to_aggregate
@@ -58,10 +58,10 @@ def aggregate_data_cpu(
 
     all_agg_exprs = agg_exprs + metadata_agg_exprs
 
-    # Execute the aggregation.
-    agg_df = grouped.agg(all_agg_exprs)
+    # Execute the aggregation, unless the caller is still building a lazy plan.
+    agg_df = grouped.agg(all_agg_exprs).sort(groupby_columns)
 
-    return agg_df.sort(groupby_columns).collect()
+    return agg_df if isinstance(df, pl.LazyFrame) else agg_df.collect()
 
 
 def aggregate_data_gpu(
@@ -0,0 +1,374 @@
+import numpy as np
+import polars as pl
+from statistics import NormalDist
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, List, Dict
+
+# Default thresholds of the multivariate methods: the probability of the chi-square quantile
+# of the squared distances, and the isolation forest anomaly score
+DEFAULT_OUTLIER_THRESHOLDS = {"mahalanobis": 0.999, "isolation": 0.7}
+MULTIVARIATE_METHODS = list(DEFAULT_OUTLIER_THRESHOLDS)
+
+# Rows scored at once by an isolation forest, bounds the (trees x rows) traversal arrays
+_ISOLATION_BATCH_ELEMENTS = 2**22
+
+
+def _chi2_quantile(probability: float, df: int) -> float:
+    """Returns the chi-square quantile with the Wilson-Hilferty approximation.
+
+    Parameters:
+        probability (float): The probability of the quantile.
+        df (int): The degrees of freedom.
+
+    Returns:
+        float: The quantile.
+    """
+    z = NormalDist().inv_cdf(probability)
+    return df * (1 - 2 / (9 * df) + z * np.sqrt(2 / (9 * df))) ** 3
+
+
+def _mean_covariance(X: np.ndarray):
+    """Returns the mean and the covariance of the rows, regularized to be positive definite.
+
+    Parameters:
+        X (np.ndarray): The (n, p) matrix.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The mean and the covariance.
+    """
+    center = X.mean(axis=0)
+    centered = X - center
+    covariance = centered.T @ centered / max(X.shape[0] - 1, 1)
+    # Constant or collinear channels would make the covariance singular
+    ridge = max(np.trace(covariance) / covariance.shape[0], 1.0) * 1e-9
+    return center, covariance + ridge * np.eye(covariance.shape[0])
+
+
+def _squared_distances(
+    X: np.ndarray, center: np.ndarray, covariance: np.ndarray
+) -> np.ndarray:
+    """Returns the squared Mahalanobis distances of the rows.
+
+    Parameters:
+        X (np.ndarray): The (n, p) matrix.
+        center (np.ndarray): The mean.
+        covariance (np.ndarray): The positive definite covariance.
+
+    Returns:
+        np.ndarray: The (n,) squared distances.
+    """
+    whitening = np.linalg.inv(np.linalg.cholesky(covariance))
+    whitened = (X - center) @ whitening.T
+    return np.einsum("ij,ij->i", whitened, whitened)
+
+
+def robust_mahalanobis_distances(
+    X: np.ndarray,
+    support_fraction: float = 0.75,
+    max_iter: int = 30,
+    max_fit_rows: int = 50_000,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Returns the squared Mahalanobis distances of the rows to a robust estimate of their center and covariance.
+
+    The estimate follows the minimum covariance determinant (MCD): starting from the
+    coordinate-wise median and median absolute deviation, concentration steps refit the mean
+    and covariance on the `support_fraction` of rows closest to the current estimate until the
+    support no longer changes. The covariance is scaled to be consistent at the normal
+    distribution and reweighted on the rows within the 97.5% chi-square quantile, so a few
+    failed images cannot mask each other. Under normality the squared distances of inliers
+    follow a chi-square distribution with `p` degrees of freedom.
+
+    Args:
+        X (np.ndarray): The (n, p) matrix, e.g. the channels of one QC module on one plate.
+        support_fraction (float, optional): The fraction of rows the concentration steps are fitted on. Defaults to 0.75.
+        max_iter (int, optional): The maximum number of concentration steps. Defaults to 30.
+        max_fit_rows (int, optional): The estimate is fitted on a random subset of at most this many rows. Defaults to 50_000.
+        seed (int, optional): The random seed of the subset. Defaults to 0.
+
+    Returns:
+        np.ndarray: The (n,) squared distances, NaN for rows with non-finite values or when there are too few rows.
+
+    Example:
+        ```python
+        X = qc_data.select(["ImageQuality_FocusScore_HOECHST", "ImageQuality_FocusScore_MITO"]).to_numpy()
+        outliers = robust_mahalanobis_distances(X) > _chi2_quantile(0.999, X.shape[1])
+        ```
+    """
+    X = np.asarray(X, dtype=np.float64)
+    distances = np.full(X.shape[0], np.nan)
+    valid = np.isfinite(X).all(axis=1)
+    X_valid = X[valid]
+    n_rows, n_columns = X_valid.shape
+    if n_rows < n_columns + 2:
+        return distances
+
+    X_fit = X_valid
+    if n_rows > max_fit_rows:
+        rng = np.random.default_rng(seed)
+        X_fit = X_valid[rng.choice(n_rows, max_fit_rows, replace=False)]
+
+    center = np.median(X_fit, axis=0)
+    scale = 1.4826 * np.median(np.abs(X_fit - center), axis=0)
+    scale[scale == 0] = 1.0
+    squared_distances = np.square((X_fit - center) / scale).sum(axis=1)
+
+    # Concentration steps, each one can only lower the determinant of the covariance
+    support_size = max(int(support_fraction * X_fit.shape[0]), n_columns + 1)
+    support = None
+    for _ in range(max_iter):
+        new_support = np.sort(
+            np.argpartition(squared_distances, support_size - 1)[:support_size]
+        )
+        if support is not None and np.array_equal(support, new_support):
+            break
+        support = new_support
+        center, covariance = _mean_covariance(X_fit[support])
+        squared_distances = _squared_distances(X_fit, center, covariance)
+
+    # Consistency at the normal distribution, then reweighting on the inliers
+    covariance *= np.median(squared_distances) / _chi2_quantile(0.5, n_columns)
+    squared_distances = _squared_distances(X_fit, center, covariance)
+    inliers = squared_distances <= _chi2_quantile(0.975, n_columns)
+    if inliers.sum() > n_columns + 1:
+        center, covariance = _mean_covariance(X_fit[inliers])
+
+    distances[valid] = _squared_distances(X_valid, center, covariance)
+    return distances
+
+
+def _average_path_length(n: np.ndarray) -> np.ndarray:
+    """Returns the average path length of an unsuccessful binary search tree search among `n` points.
+
+    Parameters:
+        n (np.ndarray): The numbers of points.
+
+    Returns:
+        np.ndarray: The average path lengths, 0 for fewer than 2 points.
+    """
+    n = np.asarray(n, dtype=np.float64)
+    lengths = np.zeros_like(n)
+    lengths[n == 2] = 1.0
+    large = n > 2
+    lengths[large] = 2.0 * (np.log(n[large] - 1.0) + np.euler_gamma) - 2.0 * (
+        n[large] - 1.0
+    ) / n[large]
+    return lengths
+
+
+def isolation_forest_scores(
+    X: np.ndarray,
+    n_trees: int = 100,
+    sample_size: int = 256,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Returns the isolation forest anomaly scores of the rows.
+
+    Every tree splits a random subsample on random channels at random values until each
+    point is isolated or the depth limit `ceil(log2(sample_size))` is reached. Outliers are
+    isolated after fewer splits, the score `2 ** (-mean path length / c(sample_size))` is close
+    to 1 for them and about 0.5 or below for inliers. All trees are grown and traversed level by
+    level as (trees x points) arrays, so the cost is a few NumPy operations per level.
+
+    Args:
+        X (np.ndarray): The (n, p) matrix, e.g. the channels of one QC module on one plate.
+        n_trees (int, optional): The number of trees. Defaults to 100.
+        sample_size (int, optional): The number of rows each tree is grown on. Defaults to 256.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: The (n,) scores, NaN for rows with non-finite values.
+
+    Example:
+        ```python
+        X = qc_data.select(["ImageQuality_FocusScore_HOECHST", "ImageQuality_FocusScore_MITO"]).to_numpy()
+        outliers = isolation_forest_scores(X) > 0.7
+        ```
+    """
+    X = np.asarray(X, dtype=np.float64)
+    scores = np.full(X.shape[0], np.nan)
+    valid = np.isfinite(X).all(axis=1)
+    X_valid = X[valid]
+    n_rows, n_columns = X_valid.shape
+    if n_rows < 2 or n_columns == 0:
+        return scores
+
+    rng = np.random.default_rng(seed)
+    sample_size = min(sample_size, n_rows)
+    max_depth = int(np.ceil(np.log2(sample_size)))
+    n_nodes = 2 ** (max_depth + 1) - 1
+    tree_index = np.arange(n_trees)[:, None]
+
+    # Complete binary trees: the children of node i are 2i + 1 and 2i + 2
+    feature = rng.integers(0, n_columns, (n_trees, n_nodes))
+    threshold = np.zeros((n_trees, n_nodes))
+    is_leaf = np.ones((n_trees, n_nodes), dtype=bool)
+    node_size = np.zeros((n_trees, n_nodes), dtype=np.int64)
+
+    samples = X_valid[
+        np.stack([rng.choice(n_rows, sample_size, replace=False) for _ in range(n_trees)])
+    ]
+    node = np.zeros((n_trees, sample_size), dtype=np.int64)
+    active = np.ones((n_trees, sample_size), dtype=bool)
+    for depth in range(max_depth + 1):
+        level = slice(2**depth - 1, 2 ** (depth + 1) - 1)
+        flat_node = (tree_index * n_nodes + node)[active]
+        node_size.reshape(-1)[:] += np.bincount(flat_node, minlength=n_trees * n_nodes)
+        if depth == max_depth:
+            break
+
+        values = np.take_along_axis(
+            samples, feature[tree_index, node][..., None], axis=2
+        )[..., 0]
+        low = np.full(n_trees * n_nodes, np.inf)
+        high = np.full(n_trees * n_nodes, -np.inf)
+        np.minimum.at(low, flat_node, values[active])
+        np.maximum.at(high, flat_node, values[active])
+        # Nodes without samples keep zero bounds, they are never split
+        low = np.where(np.isfinite(low), low, 0.0).reshape(n_trees, n_nodes)
+        high = np.where(np.isfinite(high), high, 0.0).reshape(n_trees, n_nodes)
+
+        splittable = (node_size[:, level] > 1) & (high[:, level] > low[:, level])
+        is_leaf[:, level] = ~splittable
+        threshold[:, level] = np.where(
+            splittable,
+            low[:, level]
+            + rng.random(splittable.shape) * (high[:, level] - low[:, level]),
+            0.0,
+        )
+
+        active &= ~is_leaf[tree_index, node]
+        node = np.where(
+            active, 2 * node + 1 + (values >= threshold[tree_index, node]), node
+        )
+
+    node_depth = np.floor(np.log2(np.arange(n_nodes) + 1))
+    leaf_path_length = (node_depth + _average_path_length(node_size)).reshape(-1)
+    normalization = _average_path_length(np.array([sample_size]))[0]
+
+    # Leaves lead to themselves (threshold inf), the right child follows the left one, so every
+    # point takes max_depth steps of next = left_child[node] + (value >= threshold[node])
+    node_index = np.arange(n_trees * n_nodes).reshape(n_trees, n_nodes)
+    left_child = np.where(
+        is_leaf, node_index, tree_index * n_nodes + 2 * np.arange(n_nodes) + 1
+    ).reshape(-1)
+    threshold = np.where(is_leaf, np.inf, threshold).reshape(-1)
+    feature = feature.reshape(-1)
+
+    valid_scores = np.empty(n_rows)
+    batch_size = max(1, _ISOLATION_BATCH_ELEMENTS // n_trees)
+    for start in range(0, n_rows, batch_size):
+        # Channel-major values, value (row, channel) is at channel * rows + row
+        values_by_channel = X_valid[start : start + batch_size].T.reshape(-1)
+        batch_rows = values_by_channel.size // n_columns
+        feature_offset = feature * batch_rows
+        row_index = np.arange(batch_rows)
+        node = np.repeat(tree_index * n_nodes, batch_rows, axis=1)
+        for _ in range(max_depth):
+            values = values_by_channel.take(feature_offset.take(node) + row_index)
+            node = left_child.take(node) + (values >= threshold.take(node))
+        path_length = leaf_path_length.take(node).mean(axis=0)
+        valid_scores[start : start + batch_rows] = 2.0 ** (-path_length / normalization)
+
+    scores[valid] = valid_scores
+    return scores
+
+
+def _multivariate_outlier_rows(
+    X: np.ndarray,
+    method: Literal["mahalanobis", "isolation"],
+    threshold: float,
+    seed: int,
+) -> np.ndarray:
+    """Flags the outlier rows of one module matrix.
+
+    Parameters:
+        X (np.ndarray): The (n, p) matrix of one group of images.
+        method (Literal["mahalanobis", "isolation"]): The outlier detection method.
+        threshold (float): The chi-square probability or the anomaly score above which a row is an outlier.
+        seed (int): The random seed.
+
+    Returns:
+        np.ndarray: The (n,) boolean flags, rows with non-finite values are never flagged.
+    """
+    # Channels without any value in the group, e.g. not imaged on this plate
+    X = X[:, np.isfinite(X).any(axis=0)]
+    if X.shape[1] == 0:
+        return np.zeros(X.shape[0], dtype=bool)
+
+    with np.errstate(invalid="ignore"):
+        if method == "mahalanobis":
+            distances = robust_mahalanobis_distances(X, seed=seed)
+            return distances > _chi2_quantile(threshold, X.shape[1])
+        return isolation_forest_scores(X, seed=seed) > threshold
+
+
+def multivariate_outlier_flags(
+    qc_data: pl.DataFrame,
+    module_columns: Dict[str, List[str]],
+    method: Literal["mahalanobis", "isolation"] = "mahalanobis",
+    group_columns: List[str] = None,
+    threshold: float = None,
+    max_workers: int = None,
+    seed: int = 0,
+) -> Dict[str, np.ndarray]:
+    """
+    Flags the images that are outliers over all channels of a QC module at once, group by group.
+
+    Every module is one matrix of images x channels, so an image that is slightly off in
+    several channels (e.g. slightly defocused and dim) can be flagged although no single
+    channel is extreme, with one flag per module however many channels there are. The
+    (group, module) matrices are scored in parallel threads, NumPy releases the GIL in the
+    heavy operations.
+
+    Args:
+        qc_data (pl.DataFrame): The QC data.
+        module_columns (Dict[str, List[str]]): The columns of every module, e.g. from `get_qc_data_dict`.
+        method (Literal["mahalanobis", "isolation"], optional): Robust Mahalanobis distances (`robust_mahalanobis_distances`) or isolation forest scores (`isolation_forest_scores`). Defaults to "mahalanobis".
+        group_columns (List[str], optional): The columns of the groups fitted separately, e.g. the plate barcode. Defaults to None (all images at once).
+        threshold (float, optional): The chi-square probability of the squared distances, or the anomaly score, above which an image is an outlier. Defaults to None (`DEFAULT_OUTLIER_THRESHOLDS`).
+        max_workers (int, optional): The number of threads. Defaults to None (the `ThreadPoolExecutor` default).
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        Dict[str, np.ndarray]: The boolean flags of every module, in the row order of `qc_data`.
+
+    Raises:
+        ValueError: If the method is not supported.
+    """
+    if method not in MULTIVARIATE_METHODS:
+        raise ValueError(f"Method must be one of {MULTIVARIATE_METHODS}")
+    if threshold is None:
+        threshold = DEFAULT_OUTLIER_THRESHOLDS[method]
+
+    if group_columns:
+        group_rows = [
+            np.asarray(rows)
+            for rows in qc_data.select(group_columns)
+            .with_row_index("__row")
+            .group_by(group_columns, maintain_order=True)
+            .agg(pl.col("__row"))["__row"]
+            .to_list()
+        ]
+    else:
+        group_rows = [np.arange(qc_data.height)]
+
+    matrices = {
+        module: qc_data.select(pl.col(columns).cast(pl.Float64)).to_numpy()
+        for module, columns in module_columns.items()
+    }
+    tasks = [(module, rows) for module in matrices for rows in group_rows]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            _multivariate_outlier_rows,
+            [matrices[module][rows] for module, rows in tasks],
+            [method] * len(tasks),
+            [threshold] * len(tasks),
+            [seed] * len(tasks),
+        )
+        flags = {module: np.zeros(qc_data.height, dtype=bool) for module in matrices}
+        for (module, rows), module_flags in zip(tasks, results):
+            flags[module][rows] = module_flags
+    return flags
@@ -0,0 +1,512 @@
+import json
+import numpy as np
+import polars as pl
+import pandas as pd
+from pathlib import Path
+from collections import defaultdict
+from typing import Union, Tuple, Literal, Set, List, Dict
+from .quality_control import (
+    get_qc_column_index,
+    _select_qc_modules,
+    _outlier_flag_expr,
+)
+from ..logger import (
+    log_info,
+)
+
+QC_MODEL_FORMAT_VERSION = 1
+
+
+class QuantileSketch:
+    """
+    A mergeable sketch of a distribution that answers quantile queries in bounded memory.
+
+    The sketch is a merging t-digest: the values are summarized by at most about `compression`
+    centroids (mean and weight), which are smaller near the tails, so extreme quantiles stay
+    accurate. Sketches of separate batches can be merged, which gives the same result as
+    sketching all values at once up to the approximation error.
+
+    Args:
+        compression (int, optional): The size parameter of the sketch, larger is more accurate. Defaults to 200.
+
+    Example:
+        ```python
+        sketch = QuantileSketch()
+        sketch.update(first_plate_values)
+        sketch.update(second_plate_values)
+        q1, q3 = sketch.quantile(0.25), sketch.quantile(0.75)
+        ```
+    """
+
+    def __init__(self, compression: int = 200):
+        self.compression = compression
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self) -> float:
+        return float(self.weights.sum())
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        # Quantile of the middle of every centroid, mapped to the k1 scale of the t-digest,
+        # centroids that fall into the same unit of the scale are merged
+        cumulative = np.cumsum(weights) - weights / 2
+        k = (
+            self.compression
+            / (2 * np.pi)
+            * np.arcsin(np.clip(2 * cumulative / total - 1, -1, 1))
+        )
+        cluster = np.floor(k)
+        starts = np.flatnonzero(np.r_[True, cluster[1:] != cluster[:-1]])
+        merged_weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / merged_weights
+        self.weights = merged_weights
+
+    def update(self, values: Union[np.ndarray, pl.Series]) -> "QuantileSketch":
+        """
+        Adds values to the sketch, null and NaN values are ignored.
+
+        Args:
+            values (Union[np.ndarray, pl.Series]): The new values.
+
+        Returns:
+            QuantileSketch: The sketch itself.
+        """
+        if isinstance(values, pl.Series):
+            values = values.cast(pl.Float64).fill_nan(None).drop_nulls().to_numpy()
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(
+            np.concatenate([self.means, values]),
+            np.concatenate([self.weights, np.ones(values.size)]),
+        )
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """
+        Merges another sketch into this one.
+
+        Args:
+            other (QuantileSketch): The sketch of other values.
+
+        Returns:
+            QuantileSketch: The sketch itself.
+        """
+        if other.weights.size == 0:
+            return self
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress(
+            np.concatenate([self.means, other.means]),
+            np.concatenate([self.weights, other.weights]),
+        )
+        return self
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the approximate quantile of the values, NaN if the sketch is empty.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The quantile.
+        """
+        if self.weights.size == 0:
+            return np.nan
+        cumulative = np.cumsum(self.weights) - self.weights / 2
+        return float(
+            np.interp(
+                q * self.count,
+                np.r_[0.0, cumulative, self.count],
+                np.r_[self.min, self.means, self.max],
+            )
+        )
+
+    def to_dict(self) -> Dict:
+        return {
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+            "min": self.min if self.weights.size else None,
+            "max": self.max if self.weights.size else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "QuantileSketch":
+        sketch = cls(data["compression"])
+        sketch.means = np.array(data["means"], dtype=np.float64)
+        sketch.weights = np.array(data["weights"], dtype=np.float64)
+        sketch.min = np.inf if data["min"] is None else data["min"]
+        sketch.max = -np.inf if data["max"] is None else data["max"]
+        return sketch
+
+
+class QCModel:
+    """
+    Outlier flagging of image quality data with statistics that are fitted once and reused.
+
+    The model stores, per QC column (module and channel), streaming statistics that can be
+    merged across batches of images: count, mean and sum of squared deviations (Welford),
+    minimum, maximum and a `QuantileSketch`. The thresholds of every module follow from them
+    as in `flag_outlier_images`. New plates are flagged with `apply` in time proportional to
+    their own size and flags of earlier plates do not change, while `update` adds the new plates
+    to the statistics for the next ones. NaN values are ignored by the statistics and never
+    flag an image.
+
+    Args:
+        module_to_keep (Set[str], optional): The set of QC modules to keep. Defaults to None (`config.DEFAULT_QC_MODULES`).
+        module_to_drop (Set[str], optional): The set of QC modules to drop. Defaults to None.
+        method (Literal["SD", "IQR"], optional): The method to use for outlier detection. Defaults to "SD".
+        IQR_normalization (bool, optional): Whether to perform IQR normalization. Defaults to True.
+        normalization (Literal["zscore", "minmax"], optional): The normalization method to use. Defaults to "zscore".
+        sd_step_dict (Dict[str, Tuple[float, float]], optional): The dictionary of SD steps for each module. Defaults to None.
+        default_sd_step (Tuple[float, float], optional): The default SD steps. Defaults to (-4.5, 4.5).
+        quantile_limit (float, optional): The quantile limit for IQR method. Defaults to 0.25.
+        multiplier (float, optional): The multiplier for IQR method. Defaults to 1.5.
+        sketch_compression (int, optional): The size parameter of the quantile sketches. Defaults to 200.
+
+    Raises:
+        ValueError: If a setting is not supported.
+
+    Example:
+        ```python
+        model = QCModel(method="IQR").fit(qc_data)
+        model.save("qc_model.json")
+
+        # Later, when a new plate comes off the microscope
+        model = QCModel.load("qc_model.json")
+        flagged_plate_df = model.apply(new_plate_qc_data)
+        model.update(new_plate_qc_data).save("qc_model.json")
+        ```
+    """
+
+    def __init__(
+        self,
+        module_to_keep: Set[str] = None,
+        module_to_drop: Set[str] = None,
+        method: Literal["SD", "IQR"] = "SD",
+        IQR_normalization: bool = True,
+        normalization: Literal["zscore", "minmax"] = "zscore",
+        sd_step_dict: Dict[str, Tuple[float, float]] = None,
+        default_sd_step: Tuple[float, float] = (-4.5, 4.5),
+        quantile_limit: float = 0.25,
+        multiplier: float = 1.5,
+        sketch_compression: int = 200,
+    ):
+        if method not in ["SD", "IQR"]:
+            raise ValueError("Method must be either 'SD' or 'IQR'")
+        if normalization not in ["zscore", "minmax"]:
+            # The median absolute deviation of the "robust" method cannot be merged across batches
+            raise ValueError("QCModel normalization must be either 'zscore' or 'minmax'")
+        if not 0 < quantile_limit <= 0.5:
+            raise ValueError("quantile_limit must be between 0 and 0.5")
+        if multiplier <= 0:
+            raise ValueError("multiplier must be a positive value")
+
+        self.settings = {
+            "module_to_keep": sorted(module_to_keep) if module_to_keep else None,
+            "module_to_drop": sorted(module_to_drop) if module_to_drop else None,
+            "method": method,
+            "IQR_normalization": IQR_normalization,
+            "normalization": normalization,
+            "sd_step_dict": {
+                module: list(step) for module, step in (sd_step_dict or {}).items()
+            },
+            "default_sd_step": list(default_sd_step),
+            "quantile_limit": quantile_limit,
+            "multiplier": multiplier,
+            "sketch_compression": sketch_compression,
+        }
+        self.module_columns: Dict[str, List[str]] = {}
+        self.statistics: Dict[str, Dict[str, float]] = {}
+        self.sketches: Dict[str, QuantileSketch] = {}
+
+    @property
+    def is_fitted(self) -> bool:
+        return bool(self.module_columns)
+
+    def fit(self, qc_data: Union[pl.DataFrame, pd.DataFrame]) -> "QCModel":
+        """
+        Fits the statistics to the image quality data, discarding earlier statistics.
+
+        Args:
+            qc_data (Union[pl.DataFrame, pd.DataFrame]): The QC data containing columns related to image quality.
+
+        Returns:
+            QCModel: The fitted model itself.
+        """
+        if isinstance(qc_data, pd.DataFrame):
+            qc_data = pl.from_pandas(qc_data)
+
+        qc_column_index = get_qc_column_index(qc_data)
+        self.module_columns = {
+            module: list(qc_column_index.module_columns[module])
+            for module in _select_qc_modules(
+                qc_column_index,
+                set(self.settings["module_to_keep"] or []),
+                set(self.settings["module_to_drop"] or []),
+            )
+        }
+        self.statistics = {}
+        self.sketches = {}
+        return self.update(qc_data)
+
+    def update(self, qc_data: Union[pl.DataFrame, pd.DataFrame]) -> "QCModel":
+        """
+        Adds new images, e.g. a new plate, to the statistics of the model.
+
+        Args:
+            qc_data (Union[pl.DataFrame, pd.DataFrame]): The QC data of the new images, with the columns the model was fitted on.
+
+        Returns:
+            QCModel: The updated model itself.
+
+        Raises:
+            ValueError: If the model is not fitted yet.
+        """
+        if not self.is_fitted:
+            raise ValueError("The QC model is not fitted yet, please call fit first.")
+        if isinstance(qc_data, pd.DataFrame):
+            qc_data = pl.from_pandas(qc_data)
+
+        columns = self._columns()
+        values = qc_data.select(
+            [pl.col(col).cast(pl.Float64).fill_nan(None) for col in columns]
+        )
+        # Count, mean, sum of squared deviations, minimum and maximum of all columns in one pass
+        batch_statistics = values.select(
+            [pl.col(col).count().alias(f"{col}_count") for col in columns]
+            + [pl.col(col).mean().alias(f"{col}_mean") for col in columns]
+            + [
+                ((pl.col(col) - pl.col(col).mean()) ** 2).sum().alias(f"{col}_m2")
+                for col in columns
+            ]
+            + [pl.col(col).min().alias(f"{col}_min") for col in columns]
+            + [pl.col(col).max().alias(f"{col}_max") for col in columns]
+        ).row(0, named=True)
+
+        for col in columns:
+            batch_count = batch_statistics[f"{col}_count"]
+            if batch_count == 0:
+                continue
+            statistics = self.statistics.setdefault(
+                col, {"count": 0, "mean": 0.0, "m2": 0.0, "min": np.inf, "max": -np.inf}
+            )
+            # Parallel combination of the Welford statistics (Chan et al.)
+            count = statistics["count"] + batch_count
+            delta = batch_statistics[f"{col}_mean"] - statistics["mean"]
+            statistics["m2"] += (
+                batch_statistics[f"{col}_m2"]
+                + delta**2 * statistics["count"] * batch_count / count
+            )
+            statistics["mean"] += delta * batch_count / count
+            statistics["count"] = count
+            statistics["min"] = min(statistics["min"], batch_statistics[f"{col}_min"])
+            statistics["max"] = max(statistics["max"], batch_statistics[f"{col}_max"])
+
+            self.sketches.setdefault(
+                col, QuantileSketch(self.settings["sketch_compression"])
+            ).update(values[col])
+
+        log_info(
+            f"Updated QC model with {qc_data.height} images, {self.image_count} images in total"
+        )
+        return self
+
+    @property
+    def image_count(self) -> int:
+        return max(
+            (statistics["count"] for statistics in self.statistics.values()), default=0
+        )
+
+    def _columns(self) -> List[str]:
+        return list(
+            dict.fromkeys(
+                col for columns in self.module_columns.values() for col in columns
+            )
+        )
+
+    def _center_scale(self, col: str) -> Tuple[float, float]:
+        """Returns the center and scale of the normalization of a column, NaN if undefined."""
+        statistics = self.statistics.get(col)
+        if statistics is None:
+            return np.nan, np.nan
+        if self.settings["normalization"] == "minmax":
+            return statistics["min"], statistics["max"] - statistics["min"]
+        if statistics["count"] < 2:
+            return statistics["mean"], np.nan
+        return statistics["mean"], np.sqrt(statistics["m2"] / (statistics["count"] - 1))
+
+    def _normalizes(self) -> bool:
+        return self.settings["method"] == "SD" or self.settings["IQR_normalization"]
+
+    def get_thresholds(self) -> Dict[str, Tuple[float, float]]:
+        """
+        Returns the lower and upper threshold of every module, on the normalized scale if the data is normalized.
+
+        Returns:
+            Dict[str, Tuple[float, float]]: The thresholds by module.
+
+        Raises:
+            ValueError: If the model is not fitted yet.
+        """
+        if not self.is_fitted:
+            raise ValueError("The QC model is not fitted yet, please call fit first.")
+
+        if self.settings["method"] == "SD":
+            all_sd_step_dict = defaultdict(lambda: tuple(self.settings["default_sd_step"]))
+            for module, step in self.settings["sd_step_dict"].items():
+                all_sd_step_dict[module] = tuple(step)
+            return {module: all_sd_step_dict[module] for module in self.module_columns}
+
+        quantile_limit = self.settings["quantile_limit"]
+        multiplier = self.settings["multiplier"]
+        thresholds = {}
+        for module, columns in self.module_columns.items():
+            lower_quantile, upper_quantile = [], []
+            for col in columns:
+                sketch = self.sketches.get(col, QuantileSketch())
+                lower, upper = sketch.quantile(quantile_limit), sketch.quantile(
+                    1 - quantile_limit
+                )
+                if self._normalizes():
+                    # Normalization is affine, the quantiles of the normalized values follow
+                    center, scale = self._center_scale(col)
+                    lower, upper = (lower - center) / scale, (upper - center) / scale
+                lower_quantile.append(lower)
+                upper_quantile.append(upper)
+
+            # Define the IQR and the bounds for outliers
+            lower_quantile, upper_quantile = np.array(lower_quantile), np.array(upper_quantile)
+            IQR = upper_quantile - lower_quantile
+            thresholds[module] = (
+                (lower_quantile - multiplier * IQR).min(),
+                (upper_quantile + multiplier * IQR).max(),
+            )
+        return thresholds
+
+    def apply(self, qc_data: Union[pl.DataFrame, pd.DataFrame]) -> pl.DataFrame:
+        """
+        Flags the outlier images of new data with the fitted statistics, without changing the model.
+
+        Args:
+            qc_data (Union[pl.DataFrame, pd.DataFrame]): The QC data with the columns the model was fitted on.
+
+        Returns:
+            pl.DataFrame: The QC data with one flag column per module and "outlier_flag", named as by `flag_outlier_images`.
+
+        Raises:
+            ValueError: If the model is not fitted yet.
+        """
+        if isinstance(qc_data, pd.DataFrame):
+            qc_data = pl.from_pandas(qc_data)
+        thresholds = self.get_thresholds()
+
+        outlier_prefix = f"Outlier{self.settings['method']}_"
+        flag_exprs = []
+        for module, columns in self.module_columns.items():
+            if self._normalizes():
+                exprs = []
+                for col in columns:
+                    center, scale = self._center_scale(col)
+                    exprs.append((pl.col(col) - center) / scale)
+            else:
+                exprs = [pl.col(col) for col in columns]
+
+            lower_threshold, upper_threshold = thresholds[module]
+            if self.settings["method"] == "SD":
+                flag_name = f"{outlier_prefix}{module}_{lower_threshold}_{upper_threshold}"
+            else:
+                flag_name = f"{outlier_prefix}{module}_{round(lower_threshold, 3)}_{round(upper_threshold, 3)}"
+            flag_exprs.append(
+                _outlier_flag_expr(exprs, lower_threshold, upper_threshold).alias(
+                    flag_name
+                )
+            )
+
+        flagged_qc_data = qc_data.with_columns(flag_exprs)
+        return flagged_qc_data.with_columns(
+            pl.max_horizontal(
+                [expr.meta.output_name() for expr in flag_exprs]
+            ).alias("outlier_flag")
+        )
+
+    def save(self, path: Union[str, Path]) -> Path:
+        """
+        Saves the model as a JSON file.
+
+        Args:
+            path (Union[str, Path]): The file path.
+
+        Returns:
+            Path: The file path.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "format_version": QC_MODEL_FORMAT_VERSION,
+                    "settings": self.settings,
+                    "module_columns": self.module_columns,
+                    "statistics": self.statistics,
+                    "sketches": {
+                        col: sketch.to_dict() for col, sketch in self.sketches.items()
+                    },
+                },
+                file,
+            )
+        log_info(f"Saved QC model of {self.image_count} images: {path}")
+        return path
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "QCModel":
+        """
+        Loads a model saved with `save`.
+
+        Args:
+            path (Union[str, Path]): The file path.
+
+        Returns:
+            QCModel: The model.
+
+        Raises:
+            ValueError: If the file was written by an incompatible version.
+        """
+        with open(path, "r") as file:
+            data = json.load(file)
+        if data.get("format_version") != QC_MODEL_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported QC model format {data.get('format_version')} in {path}"
+            )
+
+        settings = data["settings"]
+        model = cls(
+            module_to_keep=settings["module_to_keep"],
+            module_to_drop=settings["module_to_drop"],
+            method=settings["method"],
+            IQR_normalization=settings["IQR_normalization"],
+            normalization=settings["normalization"],
+            sd_step_dict=settings["sd_step_dict"],
+            default_sd_step=tuple(settings["default_sd_step"]),
+            quantile_limit=settings["quantile_limit"],
+            multiplier=settings["multiplier"],
+            sketch_compression=settings["sketch_compression"],
+        )
+        model.module_columns = data["module_columns"]
+        model.statistics = data["statistics"]
+        model.sketches = {
+            col: QuantileSketch.from_dict(sketch)
+            for col, sketch in data["sketches"].items()
+        }
+        return model
@@ -1,14 +1,141 @@
 import re
+import functools
+import numpy as np
 import polars as pl
 import pandas as pd
 from collections import defaultdict
-from typing import Union, Tuple, Literal, Set, List, Dict
+from typing import Union, Optional, Tuple, Literal, Set, List, Dict, Iterable
 from sys import displayhook
 
-from ..utils import normalize_df, pretty_print_channel_dict
+from ..utils import (
+    normalize_df,
+    get_normalization_group_columns,
+    pretty_print_channel_dict,
+)
+from .multivariate_outliers import (
+    multivariate_outlier_flags,
+    MULTIVARIATE_METHODS,
+    DEFAULT_OUTLIER_THRESHOLDS,
+)
 from .. import config as cfg
 
 
+# A scale suffix of a column name, e.g. "20" in "ImageQuality_Correlation_CONC_20" or "2W" in "ImageQuality_ThresholdOtsu_CONC_2W"
+_PATTERN_DIGIT = re.compile(r"\d+$")
+_PATTERN_DIGIT_LETTER = re.compile(r"\d+[A-Z]+")
+
+
+class QCColumnIndex:
+    """
+    Parsed index of the image quality columns of a schema: module -> channel -> sub-channel -> column name.
+
+    Column names are parsed once, splitting "ImageQuality_<module>_<channel>[_<scale>]" at the
+    underscores, so a module or channel is resolved by its exact name instead of substring
+    matching and selections only touch the selected columns. Plain channel columns have the
+    sub-channel None, columns with a scale suffix (e.g. "ImageQuality_Correlation_CONC_20")
+    have the sub-channel "CONC_20". Use `get_qc_column_index`, which caches the index by schema.
+
+    Args:
+        columns (Iterable[str]): The column names of the QC data.
+
+    Example:
+        ```python
+        qc_column_index = get_qc_column_index(qc_data)
+        qc_column_index.modules  # ['FocusScore', 'MaxIntensity', ...]
+        qc_column_index.module_columns["FocusScore"]  # ['ImageQuality_FocusScore_CONC', ...]
+        qc_column_index.index["Correlation"]["CONC"]["CONC_20"]  # 'ImageQuality_Correlation_CONC_20'
+        ```
+    """
+
+    def __init__(self, columns: Iterable[str]):
+        self.index: Dict[str, Dict[str, Dict[Optional[str], str]]] = {}
+        # Columns of every module, in the order of the schema
+        self.module_columns: Dict[str, List[str]] = {}
+        self.sub_channels: Dict[str, List[str]] = {}
+
+        for col in columns:
+            if not col.startswith(cfg.IMAGE_QUALITY_COLUMN_PREFIX):
+                continue
+            module = col[len(cfg.IMAGE_QUALITY_COLUMN_PREFIX) :].split("_")[0]
+            parts = col.split("_")
+            last_part = parts[-1]
+            if last_part.isdigit() or _PATTERN_DIGIT_LETTER.match(last_part):
+                channel = _PATTERN_DIGIT.sub("", parts[-2])
+                sub_channel = col[len(cfg.IMAGE_QUALITY_COLUMN_PREFIX) + len(module) + 1 :]
+                self.sub_channels.setdefault(module, []).append(sub_channel)
+            else:
+                channel, sub_channel = last_part, None
+            self.index.setdefault(module, {}).setdefault(channel, {})[sub_channel] = col
+            self.module_columns.setdefault(module, []).append(col)
+
+        self.modules: List[str] = sorted(self.module_columns)
+        self.columns: List[str] = [
+            col for module in self.modules for col in self.module_columns[module]
+        ]
+
+    def select_modules(
+        self, module_to_keep: Set[str] = None, module_to_drop: Set[str] = None
+    ) -> List[str]:
+        """
+        Returns the sorted modules of the schema that are kept and not dropped.
+
+        Args:
+            module_to_keep (Set[str], optional): The set of QC modules to keep. Defaults to None (all modules).
+            module_to_drop (Set[str], optional): The set of QC modules to drop. Defaults to None.
+
+        Returns:
+            List[str]: The selected modules.
+        """
+        return [
+            module
+            for module in self.modules
+            if (not module_to_keep or module in module_to_keep)
+            and (not module_to_drop or module not in module_to_drop)
+        ]
+
+    def channels(self, module: str) -> Dict[str, List[str]]:
+        """
+        Returns the sorted channels and sub-channels of a module.
+
+        Args:
+            module (str): The QC module.
+
+        Returns:
+            Dict[str, List[str]]: The "channels" and "sub_channels" of the module, both empty if the module is not in the schema.
+        """
+        return {
+            "channels": sorted(self.index.get(module, {})),
+            "sub_channels": sorted(set(self.sub_channels.get(module, []))),
+        }
+
+
+@functools.lru_cache(maxsize=cfg.QC_COLUMN_INDEX_CACHE_SIZE)
+def _cached_qc_column_index(columns: Tuple[str, ...]) -> QCColumnIndex:
+    return QCColumnIndex(columns)
+
+
+def get_qc_column_index(
+    qc_data: Union[pl.DataFrame, pd.DataFrame, List[str]]
+) -> QCColumnIndex:
+    """
+    Returns the parsed image quality column index of the QC data, built once per schema.
+
+    Args:
+        qc_data (Union[pl.DataFrame, pd.DataFrame, List[str]]): The QC data or its column names.
+
+    Returns:
+        QCColumnIndex: The shared index, it must not be modified.
+
+    Example:
+        ```python
+        qc_column_index = get_qc_column_index(qc_data)
+        focus_df = qc_data.select(qc_column_index.module_columns["FocusScore"])
+        ```
+    """
+    columns = qc_data if isinstance(qc_data, (list, tuple)) else qc_data.columns
+    return _cached_qc_column_index(tuple(columns))
+
+
 def get_qc_module(qc_data: Union[pl.DataFrame, pd.DataFrame]):
     """
     Returns a sorted list of image quality module names extracted from the given image quality data .
@@ -26,13 +153,7 @@ def get_qc_module(qc_data: Union[pl.DataFrame, pd.DataFrame]):
         print(qc_modules)
         ```
     """
-    # Collect columns related to image quality
-    image_quality_cols = [col for col in qc_data.columns if "ImageQuality_" in col]
-    # Remove 'ImageQuality_' prefix from column names
-    image_quality_module = [
-        col.replace("ImageQuality_", "") for col in image_quality_cols
-    ]
-    return sorted({re.sub("_.*", "", measure) for measure in image_quality_module})
+    return list(get_qc_column_index(qc_data).modules)
 
 
 def get_qc_data_dict(
@@ -67,35 +188,32 @@ def get_qc_data_dict(
     if isinstance(qc_data, pd.DataFrame):
         qc_data = pl.from_pandas(qc_data)
 
-    default_module_to_keep = cfg.DEFAULT_QC_MODULES
+    qc_column_index = get_qc_column_index(qc_data)
+    return {
+        measure: qc_data.select(qc_column_index.module_columns[measure])
+        for measure in _select_qc_modules(qc_column_index, module_to_keep, module_to_drop)
+    }
 
-    # If both are None, use default
-    if not module_to_keep and not module_to_drop:
-        module_to_keep = default_module_to_keep
 
-    # Filter and transform column names
-    image_quality_cols = [
-        col for col in qc_data.columns if col.startswith("ImageQuality_")
-    ]
-    image_quality_measures_all = {
-        col.replace("ImageQuality_", "").split("_")[0] for col in image_quality_cols
-    }
+def _select_qc_modules(
+    qc_column_index: QCColumnIndex,
+    module_to_keep: Set[str] = None,
+    module_to_drop: Set[str] = None,
+) -> List[str]:
+    """Returns the selected modules of the schema, `config.DEFAULT_QC_MODULES` if no module is kept or dropped.
 
-    # Filter out the measures
-    image_quality_measures_filtered = {
-        measure
-        for measure in image_quality_measures_all
-        if (not module_to_keep or measure in module_to_keep)
-        and (not module_to_drop or measure not in module_to_drop)
-    }
+    Parameters:
+        qc_column_index (QCColumnIndex): The column index of the QC data.
+        module_to_keep (Set[str], optional): The set of QC modules to keep. Defaults to None.
+        module_to_drop (Set[str], optional): The set of QC modules to drop. Defaults to None.
 
-    # Create the DataFrame dictionary
-    return {
-        measure: qc_data.select(
-            [col for col in image_quality_cols if f"_{measure}" in col]
-        )
-        for measure in image_quality_measures_filtered
-    }
+    Returns:
+        List[str]: The sorted modules.
+    """
+    # If both are None, use default
+    if not module_to_keep and not module_to_drop:
+        module_to_keep = cfg.DEFAULT_QC_MODULES
+    return qc_column_index.select_modules(module_to_keep, module_to_drop)
 
 
 def get_channels(
@@ -126,55 +244,56 @@ def get_channels(
         # Output:{'FocusScore': {'channels': ['CONC', 'HOECHST'], 'sub_channels': []},
                 'Intensity': {'channels': ['CONC'], 'sub_channels': []}
     """
-
-    # Check if data is in pandas DataFrame, if so convert to polars DataFrame
-    if isinstance(qc_data, pd.DataFrame):
-        qc_data = pl.from_pandas(qc_data)
-
-    pattern_digit = re.compile(r"\d+$")
-    pattern_digit_letter = re.compile(r"\d+[A-Z]+")
-    pattern_sub_channel = re.compile(r"^.*?_.*?_")
+    qc_column_index = get_qc_column_index(qc_data)
 
     if not qc_module_list:
-        qc_module_list = get_qc_module(qc_data)
-
-    result_dict = {}
-
-    for module in qc_module_list:
-        channel_list = set()
-        sub_channel_list = set()
-        data_dict = get_qc_data_dict(qc_data, module_to_keep={module})
-        for c in data_dict[module].columns:
-            if module in c:
-                parts = c.split("_")
-                last_part = parts[-1]
-                if last_part.isdigit() or pattern_digit_letter.match(last_part):
-                    channel = pattern_digit.sub("", parts[-2])
-                    sub_channel = pattern_sub_channel.sub("", c)
-                    channel_list.add(channel)
-                    sub_channel_list.add(sub_channel)
-                else:
-                    channel_list.add(last_part)
-
-        result_dict[module] = {
-            "channels": sorted(channel_list),
-            "sub_channels": sorted(sub_channel_list),
-        }
+        qc_module_list = qc_column_index.modules
+
+    result_dict = {module: qc_column_index.channels(module) for module in qc_module_list}
 
     return result_dict if out_put == "dict" else pretty_print_channel_dict(result_dict)
 
 
+def _outlier_flag_expr(
+    exprs: List[pl.Expr], lower_threshold: float, upper_threshold: float
+) -> pl.Expr:
+    """Returns an expression that is 1 for the rows with any value outside the thresholds and 0 otherwise.
+
+    Parameters:
+        exprs (List[pl.Expr]): The (normalized) columns of a QC module.
+        lower_threshold (float): The lower threshold.
+        upper_threshold (float): The upper threshold.
+
+    Returns:
+        pl.Expr: The Int64 flag.
+    """
+    # NaN values and NaN thresholds never flag a row, Polars would order NaN above all numbers
+    conditions = []
+    for expr in exprs:
+        expr = expr.fill_nan(None)
+        if not np.isnan(lower_threshold):
+            conditions.append(expr < lower_threshold)
+        if not np.isnan(upper_threshold):
+            conditions.append(expr > upper_threshold)
+    if not conditions:
+        return pl.lit(0, dtype=pl.Int64)
+    return pl.any_horizontal(conditions).fill_null(False).cast(pl.Int64)
+
+
 def flag_outlier_images(
     qc_data: Union[pl.DataFrame, pd.DataFrame],
     module_to_keep: Set[str] = None,
     module_to_drop: Set[str] = None,
-    method: Literal["SD", "IQR"] = "SD",
+    method: Literal["SD", "IQR", "mahalanobis", "isolation"] = "SD",
     IQR_normalization: bool = True,
-    normalization: Literal["zscore", "minmax"] = "zscore",
+    normalization: Literal["zscore", "minmax", "robust"] = "zscore",
+    normalize_by: Union[str, List[str]] = None,
     sd_step_dict: Dict[str, Tuple[float, float]] = None,
     default_sd_step: Tuple[float, float] = (-4.5, 4.5),
     quantile_limit: float = 0.25,
     multiplier: float = 1.5,
+    outlier_threshold: float = None,
+    max_workers: int = None,
 ):
     """
     Flags outlier images based on the specified quality control (QC) data.
@@ -183,19 +302,22 @@ def flag_outlier_images(
         qc_data (Union[pl.DataFrame, pd.DataFrame]): The QC data containing columns related to image quality.
         module_to_keep (Set[str], optional): The set of QC modules to keep. Defaults to None.
         module_to_drop (Set[str], optional): The set of QC modules to drop. Defaults to None.
-        method (Literal["SD", "IQR"], optional): The method to use for outlier detection. Defaults to "SD".
+        method (Literal["SD", "IQR", "mahalanobis", "isolation"], optional): The method to use for outlier detection. "SD" and "IQR" test every channel separately, "mahalanobis" (robust Mahalanobis distance with an MCD-style covariance) and "isolation" (isolation forest) test all channels of a module at once, per plate. Defaults to "SD".
         IQR_normalization (bool, optional): Whether to perform IQR normalization. Defaults to True.
-        normalization (Literal["zscore", "minmax"], optional): The normalization method to use. Defaults to "zscore".
+        normalization (Literal["zscore", "minmax", "robust"], optional): The normalization method to use, "robust" uses the median and the scaled median absolute deviation. Defaults to "zscore".
+        normalize_by (Union[str, List[str]], optional): Normalize each group separately: "plate", "acquisition", any grouping column, or a list of them, so that plate-to-plate shifts do not flag whole plates. Defaults to None (the whole experiment, or every plate for the multivariate methods).
         sd_step_dict (Dict[str, Tuple[float, float]], optional): The dictionary of SD steps for each module. Defaults to None.
         default_sd_step (Tuple[float, float], optional): The default SD steps. Defaults to (-4.5, 4.5).
         quantile_limit (float, optional): The quantile limit for IQR method. Defaults to 0.25.
         multiplier (float, optional): The multiplier for IQR method. Defaults to 1.5.
+        outlier_threshold (float, optional): For "mahalanobis", the chi-square probability of the squared distance above which an image is an outlier, for "isolation", the anomaly score. Defaults to None (0.999 and 0.7).
+        max_workers (int, optional): The number of threads of the multivariate methods. Defaults to None (the `ThreadPoolExecutor` default).
 
     Returns:
         pl.DataFrame: The QC data with flagged outlier images.
 
     Raises:
-        ValueError: If the quantile limit is not between 0 and 0.5, or if the multiplier is not a positive value.
+        ValueError: If the method is not supported, the quantile limit is not between 0 and 0.5, or if the multiplier is not a positive value.
 
     Example:
         ```python
@@ -209,9 +331,13 @@ def flag_outlier_images(
     if isinstance(qc_data, pd.DataFrame):
         qc_data = pl.from_pandas(qc_data)
 
-    # Create the DataFrame dictionary
-    data_frame_dictionary = get_qc_data_dict(qc_data, module_to_keep, module_to_drop)
-    module_list = sorted(data_frame_dictionary.keys())
+    # Resolve the columns of the selected modules
+    qc_column_index = get_qc_column_index(qc_data)
+    module_list = _select_qc_modules(qc_column_index, module_to_keep, module_to_drop)
+    module_column_dict = {
+        image_quality_name: qc_column_index.module_columns[image_quality_name]
+        for image_quality_name in module_list
+    }
 
     if not 0 < quantile_limit <= 0.5:
         raise ValueError("quantile_limit must be between 0 and 0.5")
@@ -219,6 +345,25 @@ def flag_outlier_images(
     if multiplier <= 0:
         raise ValueError("multiplier must be a positive value")
 
+    # Normalize the columns of all modules in one pass
+    module_columns = [
+        col
+        for image_quality_name in module_list
+        for col in module_column_dict[image_quality_name]
+    ]
+    group_columns = get_normalization_group_columns(normalize_by)
+    if method in MULTIVARIATE_METHODS:
+        # The multivariate scores are invariant to the scale of every channel
+        scaled_data = qc_data.select(module_columns)
+    elif method == "SD" or IQR_normalization:
+        scaled_data = normalize_df(
+            qc_data.select(group_columns + module_columns),
+            method=normalization,
+            normalize_by=normalize_by,
+        )
+    else:
+        scaled_data = qc_data.select(module_columns)
+
     if method == "SD":
         outlier_prefix = "OutlierSD_"
         all_sd_step_dict = defaultdict(lambda: default_sd_step)
@@ -227,84 +372,109 @@ def flag_outlier_images(
             for key, value in sd_step_dict.items():
                 all_sd_step_dict[key] = value
 
+        flag_exprs = []
         for image_quality_name in module_list:
-            # Get the current dataframe from the dictionary
-            current_dataframe = data_frame_dictionary[image_quality_name]
-
-            # Scale the dataframe values
-            current_dataframe_scaled = normalize_df(
-                current_dataframe, method=normalization
-            )
+            scaled_exprs = [
+                pl.col(col) for col in module_column_dict[image_quality_name]
+            ]
 
             # Get the lower and upper treshold for the current image_quality_name
             lower_threshold, upper_threshold = all_sd_step_dict[image_quality_name]
 
             # Create a new flag
             new_flag_scaled = f"{outlier_prefix}{image_quality_name}_{lower_threshold}_{upper_threshold}"
-            outliers = [
-                1 if i == True else 0
-                for i in current_dataframe_scaled.apply(
-                    lambda row: any(
-                        (val < lower_threshold) | (val > upper_threshold) for val in row
-                    )
-                ).to_series()
-            ]
-            qc_data = qc_data.with_columns(pl.lit(outliers).alias(new_flag_scaled))
-
-        # Identify columns starting with 'OutlierZscore_'
-        outlier_flaged_columns = [
-            item for item in qc_data.columns if item.startswith(outlier_prefix)
-        ]
-        flagged_qc_data = qc_data.with_columns(
-            pl.max_horizontal(outlier_flaged_columns).alias("outlier_flag")
-        )
+            flag_exprs.append(
+                _outlier_flag_expr(
+                    scaled_exprs, lower_threshold, upper_threshold
+                ).alias(new_flag_scaled)
+            )
 
     elif method == "IQR":
         outlier_prefix = "OutlierIQR_"
 
-        for image_quality_name in module_list:
-            # Get the current dataframe from the dictionary
-            current_dataframe = data_frame_dictionary[image_quality_name]
-
-            if IQR_normalization:
-                # Scale the dataframe values
-                current_dataframe = normalize_df(
-                    current_dataframe, method=normalization
-                )
+        module_exprs = {
+            image_quality_name: [
+                pl.col(col) for col in module_column_dict[image_quality_name]
+            ]
+            for image_quality_name in module_list
+        }
 
-            # Calculate the lower and upper quantiles
-            lower_quantile = current_dataframe.quantile(quantile_limit)
-            upper_quantile = current_dataframe.quantile(1 - quantile_limit)
+        # Calculate the lower and upper quantiles of all modules in one pass
+        quantile_exprs = [
+            expr.quantile(quantile, interpolation="nearest").alias(
+                f"{image_quality_name}_{i}_{quantile}"
+            )
+            for image_quality_name, exprs in module_exprs.items()
+            for i, expr in enumerate(exprs)
+            for quantile in [quantile_limit, 1 - quantile_limit]
+        ]
+        quantiles = scaled_data.select(quantile_exprs).row(0) if quantile_exprs else ()
+
+        flag_exprs = []
+        quantile_index = 0
+        for image_quality_name, exprs in module_exprs.items():
+            module_quantiles = np.array(
+                quantiles[quantile_index : quantile_index + 2 * len(exprs)],
+                dtype=np.float64,
+            )
+            quantile_index += 2 * len(exprs)
+            lower_quantile, upper_quantile = module_quantiles[0::2], module_quantiles[1::2]
 
             # Define the IQR and the bounds for outliers
             IQR = upper_quantile - lower_quantile
-            lower_threshold = (lower_quantile - multiplier * IQR).to_numpy().min()
-            upper_threshold = (upper_quantile + multiplier * IQR).to_numpy().max()
+            lower_threshold = (lower_quantile - multiplier * IQR).min()
+            upper_threshold = (upper_quantile + multiplier * IQR).max()
 
             # Create a new flag
             new_flag_iqr = f"{outlier_prefix}{image_quality_name}_{round(lower_threshold, 3)}_{round(upper_threshold, 3)}"
-            outliers = [
-                1 if i == True else 0
-                for i in current_dataframe.apply(
-                    lambda row: any(
-                        (val < lower_threshold) | (val > upper_threshold) for val in row
-                    )
-                ).to_series()
-            ]
-
-            qc_data = qc_data.with_columns(pl.lit(outliers).alias(new_flag_iqr))
+            flag_exprs.append(
+                _outlier_flag_expr(exprs, lower_threshold, upper_threshold).alias(
+                    new_flag_iqr
+                )
+            )
 
-        # Identify columns starting with 'OutlierScaled_'
-        outlier_flaged_columns = [
-            item for item in qc_data.columns if item.startswith(outlier_prefix)
-        ]
-        print("New code reached")
-        flagged_qc_data = qc_data.with_columns(
-            pl.max_horizontal(outlier_flaged_columns).alias("outlier_flag")
+    elif method in MULTIVARIATE_METHODS:
+        outlier_prefix = f"Outlier{method.capitalize()}_"
+        if not group_columns and cfg.METADATA_BARCODE_COLUMN in qc_data.columns:
+            group_columns = [cfg.METADATA_BARCODE_COLUMN]
+
+        module_flags = multivariate_outlier_flags(
+            qc_data,
+            module_column_dict,
+            method=method,
+            group_columns=group_columns,
+            threshold=outlier_threshold,
+            max_workers=max_workers,
+        )
+        threshold_name = (
+            outlier_threshold
+            if outlier_threshold is not None
+            else DEFAULT_OUTLIER_THRESHOLDS[method]
         )
+        flag_exprs = [
+            pl.lit(
+                pl.Series(
+                    f"{outlier_prefix}{image_quality_name}_{threshold_name}",
+                    module_flags[image_quality_name],
+                    dtype=pl.Int64,
+                )
+            )
+            for image_quality_name in module_list
+        ]
 
     else:
-        raise ValueError("Method must be either 'zscore' or 'IQR'")
+        raise ValueError(
+            f"Method must be one of {['SD', 'IQR'] + MULTIVARIATE_METHODS}"
+        )
+
+    # Compute the flags of all modules at once
+    qc_data = qc_data.with_columns(scaled_data.select(flag_exprs))
+    outlier_flaged_columns = [
+        item for item in qc_data.columns if item.startswith(outlier_prefix)
+    ]
+    flagged_qc_data = qc_data.with_columns(
+        pl.max_horizontal(outlier_flaged_columns).alias("outlier_flag")
+    )
 
     # Display the number of flagged image based on each quality module'
     outlier_flaged_columns = [
@@ -0,0 +1,379 @@
+import os
+import threading
+import importlib.util
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+import polars as pl
+from typing import Optional, List, Dict, Tuple, Any, Callable
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import SQLAlchemyError
+from .. import config as cfg
+from ..cache import ResultCache, make_cache_key
+from ..logger import (
+    log_debug,
+    log_warning,
+)
+
+QUERY_CACHE_NAMESPACE = "database_query"
+
+# Databases read by connectorx in partitioned reads
+CONNECTORX_BACKENDS = ["postgresql", "mysql", "mssql", "oracle"]
+
+# One engine per process and URI, engines must not be shared with forked processes
+_engines: Dict[Tuple[int, str], Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(uri: Optional[str] = None) -> Engine:
+    """
+    Returns the pooled SQLAlchemy engine for the database URI, creating it on first use.
+
+    The engine is shared by all calls and threads of the process. Its pool is configured with
+    `config.DB_POOL_SIZE`, `DB_POOL_MAX_OVERFLOW`, `DB_POOL_TIMEOUT` and `DB_POOL_RECYCLE`, and
+    connections are checked before use so that connections dropped by the server are replaced.
+
+    Args:
+        uri (str, optional): The database URI. Defaults to `config.DB_URI`.
+
+    Returns:
+        Engine: The SQLAlchemy engine.
+
+    Raises:
+        ValueError: If no URI is given and `config.DB_URI` is not set.
+
+    Example:
+        ```python
+        engine = get_engine()
+        with engine.connect() as connection:
+            df = pl.read_database("SELECT 1 AS one", connection)
+        ```
+    """
+    uri = uri or cfg.DB_URI
+    if uri is None:
+        raise ValueError(
+            "No database URI, please set the DB_URI environment variable (see config)."
+        )
+
+    engine_key = (os.getpid(), uri)
+    with _engines_lock:
+        if engine_key not in _engines:
+            if make_url(uri).get_backend_name() == "sqlite":
+                # SQLite connections are files, pool sizes and timeouts do not apply
+                engine = create_engine(uri)
+            else:
+                engine = create_engine(
+                    uri,
+                    pool_size=cfg.DB_POOL_SIZE,
+                    max_overflow=cfg.DB_POOL_MAX_OVERFLOW,
+                    pool_timeout=cfg.DB_POOL_TIMEOUT,
+                    pool_recycle=cfg.DB_POOL_RECYCLE,
+                    pool_pre_ping=True,
+                )
+            _engines[engine_key] = engine
+            log_debug(f"Created database engine: {engine.url!r}")
+        return _engines[engine_key]
+
+
+def _query_cache_key(query: Any, uri: Optional[str], options: Dict) -> str:
+    """Returns the cache key of a query from its normalized text, bound parameters, options and database."""
+    if isinstance(query, str):
+        query_text, query_params = query, None
+    else:
+        compiled_query = query.compile()
+        query_text, query_params = str(compiled_query), compiled_query.params
+    uri = uri or cfg.DB_URI
+    return make_cache_key(
+        QUERY_CACHE_NAMESPACE,
+        " ".join(query_text.split()),
+        query_params,
+        options,
+        make_url(uri).render_as_string(hide_password=True) if uri else None,
+    )
+
+
+def read_database(
+    query: Any,
+    uri: Optional[str] = None,
+    use_cache: Optional[bool] = None,
+    refresh: bool = False,
+    offline: Optional[bool] = None,
+    ttl: Optional[float] = None,
+    **kwargs,
+) -> pl.DataFrame:
+    """
+    Runs a query on a pooled connection of the shared engine and returns the result as a dataframe.
+
+    With the cache enabled, results are cached on disk (see `pharmbio.cache.ResultCache`), keyed
+    by the query text with normalized whitespace, its bound parameters, the options and the
+    database. A cached result younger than `ttl` is returned without contacting the database,
+    so changes made in the database meanwhile are not seen, and an older one is still returned,
+    with a warning, if the database cannot be reached. The cache is off by default, it suits
+    rarely changing reference tables on a slow database and prepares offline sessions.
+
+    Args:
+        query (Any): The SQL query, as a string or a SQLAlchemy selectable.
+        uri (str, optional): The database URI. Defaults to `config.DB_URI`.
+        use_cache (bool, optional): Whether to read and store the result in the cache. A cached result can be up to `ttl` seconds older than the database. In offline mode the result is always read from the cache. Defaults to None (`config.QUERY_CACHE`, off unless enabled).
+        refresh (bool, optional): Whether to ignore the cached result and query the database again. Defaults to False.
+        offline (bool, optional): Whether to serve the result only from the cache, regardless of its age. Defaults to `config.DB_OFFLINE`.
+        ttl (float, optional): The maximum age of a cached result in seconds. Defaults to `config.QUERY_CACHE_TTL`.
+        **kwargs: Passed on to `pl.read_database`, e.g. `execute_options` or `schema_overrides`.
+
+    Returns:
+        pl.DataFrame: The query result.
+
+    Raises:
+        ConnectionError: In offline mode, if the result is not cached.
+
+    Example:
+        ```python
+        query = experiment_name_sql_query("project", "image_analyses_per_plate")
+        df = read_database(query)
+        df = read_database(query, use_cache=True)  # served from disk for up to an hour
+        df = read_database(query, use_cache=True, refresh=True)  # ask the database, update the cache
+
+        # Work without database, e.g. on a laptop, from results cached earlier
+        from pharmbio import config as cfg
+        cfg.QUERY_CACHE = True  # cache all queries of the session
+        cfg.DB_OFFLINE = True
+        ```
+    """
+    if use_cache is None:
+        use_cache = cfg.QUERY_CACHE
+    # Offline mode always serves from the cache, so the key is needed whatever use_cache says
+    if offline is None:
+        offline = cfg.DB_OFFLINE
+    cache_key = _query_cache_key(query, uri, kwargs) if use_cache or offline else None
+    return _read_through_cache(
+        cache_key,
+        _read_on_connection,
+        (query, uri, kwargs),
+        query,
+        refresh,
+        offline,
+        ttl,
+    )
+
+
+def _read_on_connection(query: Any, uri: Optional[str], kwargs: Dict) -> pl.DataFrame:
+    with get_engine(uri).connect() as connection:
+        return pl.read_database(query, connection, **kwargs)
+
+
+def _read_through_cache(
+    cache_key: Optional[str],
+    read_function: Callable,
+    read_args: Tuple,
+    query: Any,
+    refresh: bool,
+    offline: bool,
+    ttl: Optional[float],
+) -> pl.DataFrame:
+    """Serves a query result from the cache or reads it, following the rules of `read_database`.
+
+    Parameters:
+        cache_key (str, optional): The cache key of the result, None to bypass the cache. Required in offline mode.
+        read_function (Callable): The function that reads the result from the database.
+        read_args (Tuple): The arguments of `read_function`.
+        query (Any): The query or queries, for error messages.
+        refresh (bool): Whether to ignore the cached result.
+        offline (bool): Whether to serve the result only from the cache.
+        ttl (float, optional): The maximum age of a cached result in seconds. Defaults to `config.QUERY_CACHE_TTL`.
+
+    Returns:
+        pl.DataFrame: The query result.
+    """
+    cache = ResultCache() if cache_key is not None else None
+
+    if offline:
+        df = cache.get(cache_key) if cache is not None else None
+        if df is None:
+            raise ConnectionError(
+                f"Offline mode: the result of this query is not cached: {' '.join(str(query).split())}"
+            )
+        return df
+
+    if cache is not None and not refresh:
+        df = cache.get(cache_key, max_age=cfg.QUERY_CACHE_TTL if ttl is None else ttl)
+        if df is not None:
+            return df
+
+    try:
+        df = read_function(*read_args)
+    except SQLAlchemyError as error:
+        df = cache.get(cache_key) if cache is not None else None
+        if df is None:
+            raise
+        log_warning(f"Database query failed, using an older cached result: {error}")
+        return df
+
+    if cache is not None:
+        cache.put(cache_key, df, namespace=QUERY_CACHE_NAMESPACE)
+    return df
+
+
+def _connectorx_uri(uri: str) -> Optional[str]:
+    """Returns the URI in the form connectorx expects, or None if connectorx cannot be used for the database.
+
+    Parameters:
+        uri (str): The SQLAlchemy database URI.
+
+    Returns:
+        Optional[str]: The connectorx URI without SQLAlchemy driver name.
+    """
+    if importlib.util.find_spec("connectorx") is None:
+        return None
+    url = make_url(uri)
+    # Only server databases gain from several connections, SQLite reads go through SQLAlchemy
+    if url.get_backend_name() not in CONNECTORX_BACKENDS:
+        return None
+    return url.set(drivername=url.get_backend_name()).render_as_string(
+        hide_password=False
+    )
+
+
+def _query_text(query: Any, uri: str) -> str:
+    if isinstance(query, str):
+        return query
+    # connectorx takes plain SQL, the bound values are rendered by the dialect of the database
+    return str(
+        query.compile(
+            dialect=get_engine(uri).dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+
+
+def _read_partitions(
+    queries: List[Any], uri: Optional[str], max_workers: Optional[int]
+) -> pl.DataFrame:
+    """Reads the partition queries concurrently and concatenates their results.
+
+    Parameters:
+        queries (List[Any]): The queries of the partitions.
+        uri (str, optional): The database URI. Defaults to `config.DB_URI`.
+        max_workers (int, optional): The maximum number of concurrent connections. Defaults to `config.DB_FETCH_MAX_WORKERS`.
+
+    Returns:
+        pl.DataFrame: The rows of all partitions.
+    """
+    uri = uri or cfg.DB_URI
+    if uri is None:
+        raise ValueError(
+            "No database URI, please set the DB_URI environment variable (see config)."
+        )
+
+    connectorx_uri = _connectorx_uri(uri)
+    if connectorx_uri is not None and len(queries) > 1:
+        try:
+            # One connection per query, the results are read as Arrow without pandas
+            return pl.read_database_uri(
+                [_query_text(query, uri) for query in queries],
+                connectorx_uri,
+                engine="connectorx",
+            )
+        except RuntimeError as error:
+            log_warning(
+                f"Partitioned read with connectorx failed, using pooled connections: {error}"
+            )
+
+    max_workers = min(len(queries), max_workers or cfg.DB_FETCH_MAX_WORKERS)
+    if max_workers <= 1:
+        dfs = [_read_on_connection(query, uri, {}) for query in queries]
+    else:
+        # A pool of its own, callers may already run on the shared fetch pool
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            dfs = list(
+                executor.map(_read_on_connection, queries, repeat(uri), repeat({}))
+            )
+    return pl.concat(dfs, how="vertical_relaxed")
+
+
+def read_database_partitioned(
+    queries: List[Any],
+    uri: Optional[str] = None,
+    use_cache: Optional[bool] = None,
+    refresh: bool = False,
+    offline: Optional[bool] = None,
+    ttl: Optional[float] = None,
+    max_workers: Optional[int] = None,
+) -> pl.DataFrame:
+    """
+    Reads a result split into partition queries over several connections and returns the concatenated rows.
+
+    The queries are typically the same query restricted to disjoint chunks, e.g. of plate
+    barcodes, so a large result is transferred over several streams instead of one. With
+    connectorx installed and a server database, the queries are read by
+    `pl.read_database_uri(..., engine="connectorx")` straight into Arrow. Otherwise they run
+    concurrently on the pooled engine (see `get_engine`). The combined result is cached like
+    the result of `read_database`.
+
+    Args:
+        queries (List[Any]): The partition queries, as strings or SQLAlchemy selectables, with the same columns.
+        uri (str, optional): The database URI. Defaults to `config.DB_URI`.
+        use_cache (bool, optional): Whether to read and store the result in the cache. A cached result can be up to `ttl` seconds older than the database. In offline mode the result is always read from the cache. Defaults to None (`config.QUERY_CACHE`, off unless enabled).
+        refresh (bool, optional): Whether to ignore the cached result and query the database again. Defaults to False.
+        offline (bool, optional): Whether to serve the result only from the cache, regardless of its age. Defaults to `config.DB_OFFLINE`.
+        ttl (float, optional): The maximum age of a cached result in seconds. Defaults to `config.QUERY_CACHE_TTL`.
+        max_workers (int, optional): The maximum number of concurrent connections without connectorx. Defaults to `config.DB_FETCH_MAX_WORKERS`.
+
+    Returns:
+        pl.DataFrame: The rows of all partitions, in the order of the queries.
+
+    Raises:
+        ConnectionError: In offline mode, if the result is not cached.
+
+    Example:
+        ```python
+        barcode_chunks = [barcodes[i : i + 50] for i in range(0, len(barcodes), 50)]
+        queries = [
+            plate_layout_sql_query(cfg.DATABASE_SCHEMA, chunk) for chunk in barcode_chunks
+        ]
+        layout_df = read_database_partitioned(queries)
+        ```
+    """
+    queries = list(queries)
+    if use_cache is None:
+        use_cache = cfg.QUERY_CACHE
+    if offline is None:
+        offline = cfg.DB_OFFLINE
+    if len(queries) == 1:
+        return read_database(
+            queries[0], uri, use_cache=use_cache, refresh=refresh, offline=offline, ttl=ttl
+        )
+
+    cache_key = (
+        make_cache_key(*[_query_cache_key(query, uri, {}) for query in queries])
+        if use_cache or offline
+        else None
+    )
+    return _read_through_cache(
+        cache_key,
+        _read_partitions,
+        (queries, uri, max_workers),
+        queries,
+        refresh,
+        offline,
+        ttl,
+    )
+
+
+def clear_query_cache() -> int:
+    """
+    Removes all cached query results, so the next queries are sent to the database.
+
+    Returns:
+        int: The number of removed results.
+    """
+    return ResultCache().invalidate(namespace=QUERY_CACHE_NAMESPACE)
+
+
+def dispose_engines():
+    """
+    Closes the pooled connections of all engines of the current process, e.g. after the database URI changed.
+    """
+    with _engines_lock:
+        for (pid, _), engine in list(_engines.items()):
+            if pid == os.getpid():
+                engine.dispose()
+        _engines.clear()
@@ -0,0 +1,83 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Dict, Tuple, Any, Callable
+from .. import config as cfg
+
+# One thread pool per process, threads must not be shared with forked processes
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_fetch_executor() -> ThreadPoolExecutor:
+    """
+    Returns the thread pool that runs database fetches in the background, creating it on first use.
+
+    The pool has `config.DB_FETCH_MAX_WORKERS` threads. Queries mostly wait on the server, so
+    the threads overlap their latency while the pooled engine (see `get_engine`) gives each of
+    them its own connection.
+
+    Returns:
+        ThreadPoolExecutor: The thread pool of the current process.
+    """
+    with _executors_lock:
+        if os.getpid() not in _executors:
+            _executors[os.getpid()] = ThreadPoolExecutor(
+                max_workers=cfg.DB_FETCH_MAX_WORKERS,
+                thread_name_prefix="pharmbio-fetch",
+            )
+        return _executors[os.getpid()]
+
+
+def submit_fetch(fetch_function: Callable, *args, **kwargs) -> Future:
+    """
+    Starts a fetch in the background and returns its future.
+
+    Args:
+        fetch_function (Callable): The function that queries the database, e.g. `read_database` or `get_image_quality_ref`.
+        *args: Positional arguments of the function.
+        **kwargs: Keyword arguments of the function.
+
+    Returns:
+        Future: The future of the result, `future.result()` waits for it and raises the error of the fetch if it failed.
+
+    Example:
+        ```python
+        qc_ref_future = submit_fetch(get_image_quality_ref, "AROS-Reproducibility-MoA-Full")
+        cp_ref_future = submit_fetch(get_cell_morphology_ref, "AROS-Reproducibility-MoA-Full")
+        qc_ref_df, cp_ref_df = qc_ref_future.result(), cp_ref_future.result()
+        ```
+    """
+    return get_fetch_executor().submit(fetch_function, *args, **kwargs)
+
+
+def fetch_concurrently(
+    fetches: Dict[str, Tuple[Callable, ...]], timeout: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Runs independent fetches concurrently and waits for all of them.
+
+    Args:
+        fetches (Dict[str, Tuple[Callable, ...]]): The fetches by name, each one a tuple of a function and its positional arguments.
+        timeout (float, optional): The maximum time in seconds to wait for each result. Defaults to None (no limit).
+
+    Returns:
+        Dict[str, Any]: The results by name.
+
+    Raises:
+        Exception: The error of the first failed fetch, in the order of `fetches`.
+
+    Example:
+        ```python
+        results = fetch_concurrently(
+            {
+                "projects": (get_projects_list,),
+                "layout": (get_plate_layout, ["PB000123", "PB000124"]),
+            }
+        )
+        ```
+    """
+    futures = {
+        name: submit_fetch(fetch[0], *fetch[1:]) for name, fetch in fetches.items()
+    }
+    return {name: future.result(timeout=timeout) for name, future in futures.items()}
@@ -0,0 +1,164 @@
+import threading
+import time
+import polars as pl
+from typing import Optional, Dict, Iterable, Tuple
+from .. import config as cfg
+from .connection import read_database_partitioned
+from .queries import plate_layout_sql_query
+from ..logger import (
+    log_info,
+)
+
+
+class PlateLayoutProvider:
+    """
+    Serves plate layout rows from memory, fetching each plate from the database only once.
+
+    The rows of every fetched plate are kept sorted by well, indexed by database URI and barcode,
+    so a merge on (barcode, well_id) only needs the slices of its plates. Barcodes that are not
+    cached yet are fetched together, in partitions of `config.DB_PARTITION_PLATES` plates read
+    concurrently. The database is queried without holding the lock, so cached plates are served
+    while other plates are fetched. A cached plate is fetched again once it is older than
+    `config.QUERY_CACHE_TTL` seconds, or after it was dropped with `invalidate`.
+
+    Args:
+        uri (str, optional): The database URI. Defaults to `config.DB_URI` at the time of the fetch.
+
+    Example:
+        ```python
+        provider = PlateLayoutProvider()
+        provider.fetch(["PB000123", "PB000124"])  # one query
+        layout_df = provider.get(["PB000123"])  # served from memory
+        provider.invalidate(["PB000123"])  # the next get queries the plate again
+        ```
+    """
+
+    def __init__(self, uri: Optional[str] = None):
+        self.uri = uri
+        self._layouts: Dict[Tuple[Optional[str], str], Tuple[float, pl.DataFrame]] = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, barcodes: Iterable[str]):
+        """
+        Fetches the layout of the plates that are not cached yet, see `read_database_partitioned`.
+
+        Args:
+            barcodes (Iterable[str]): The plate barcodes.
+        """
+        self._fetch(barcodes)
+
+    def get(self, barcodes: Iterable[str]) -> pl.DataFrame:
+        """
+        Returns the layout rows of the plates, fetching the plates that are not cached yet.
+
+        Args:
+            barcodes (Iterable[str]): The plate barcodes.
+
+        Returns:
+            pl.DataFrame: The plate layout rows with the columns in `config.PLATE_LAYOUT_INFO`.
+        """
+        barcodes = list(dict.fromkeys(str(barcode) for barcode in barcodes))
+        layouts = self._fetch(barcodes)
+        plate_layouts = [layouts[barcode] for barcode in barcodes]
+        if not plate_layouts:
+            return pl.DataFrame(schema={col: pl.Utf8 for col in cfg.PLATE_LAYOUT_INFO})
+        return pl.concat(plate_layouts) if len(plate_layouts) > 1 else plate_layouts[0]
+
+    def invalidate(self, barcodes: Optional[Iterable[str]] = None):
+        """
+        Drops cached plate layouts of the database, e.g. after a layout was changed in it.
+
+        Args:
+            barcodes (Iterable[str], optional): The plate barcodes to drop. Defaults to None (all plates of the database).
+        """
+        uri = self._uri()
+        with self._lock:
+            if barcodes is None:
+                keys = [key for key in self._layouts if key[0] == uri]
+            else:
+                keys = [(uri, str(barcode)) for barcode in barcodes]
+            for key in keys:
+                self._layouts.pop(key, None)
+
+    def clear(self):
+        """
+        Drops all cached plate layouts, of every database.
+        """
+        with self._lock:
+            self._layouts.clear()
+
+    def _uri(self) -> Optional[str]:
+        return self.uri if self.uri is not None else cfg.DB_URI
+
+    def _fetch(self, barcodes: Iterable[str]) -> Dict[str, pl.DataFrame]:
+        """
+        Returns the layouts of the plates, querying the database for the plates not cached yet.
+
+        Parameters:
+            barcodes (Iterable[str]): The plate barcodes.
+
+        Returns:
+            Dict[str, pl.DataFrame]: The layout rows of every plate, by barcode.
+        """
+        uri = self._uri()
+        barcodes = {str(barcode) for barcode in barcodes}
+        oldest_fetch_time = time.monotonic() - cfg.QUERY_CACHE_TTL
+        layouts = {}
+        with self._lock:
+            for barcode in barcodes:
+                entry = self._layouts.get((uri, barcode))
+                if entry is not None and entry[0] >= oldest_fetch_time:
+                    layouts[barcode] = entry[1]
+        missing_barcodes = sorted(barcodes - set(layouts))
+        if not missing_barcodes:
+            return layouts
+
+        # Large layouts are read in partitions of plates over several connections
+        barcode_chunks = [
+            missing_barcodes[i : i + cfg.DB_PARTITION_PLATES]
+            for i in range(0, len(missing_barcodes), cfg.DB_PARTITION_PLATES)
+        ]
+        queries = [
+            plate_layout_sql_query(cfg.DATABASE_SCHEMA, chunk) for chunk in barcode_chunks
+        ]
+        fetch_time = time.monotonic()
+        df_plates = read_database_partitioned(queries, uri)
+        log_info(
+            f"Fetched plate layout {df_plates.shape} of {len(missing_barcodes)} plates"
+        )
+
+        barcode_column = cfg.DATABASE_SCHEMA["PLATE_LAYOUT_BARCODE_COLUMN"]
+        well_column = cfg.DATABASE_SCHEMA["PLATE_LAYOUT_WELL_COLUMN"]
+        # Plates without layout are cached empty so they are not queried again
+        fetched_layouts = {barcode: df_plates.clear() for barcode in missing_barcodes}
+        for plate_df in df_plates.sort(barcode_column, well_column).partition_by(
+            barcode_column, maintain_order=True
+        ):
+            fetched_layouts[str(plate_df[barcode_column][0])] = plate_df
+        with self._lock:
+            for barcode, plate_df in fetched_layouts.items():
+                self._layouts[(uri, barcode)] = (fetch_time, plate_df)
+        layouts.update(fetched_layouts)
+        return layouts
+
+
+# Shared by all merges of the process
+plate_layout_provider = PlateLayoutProvider()
+
+
+def get_plate_layout(barcodes: Iterable[str]) -> pl.DataFrame:
+    """
+    Returns the layout rows of the plates from the shared `plate_layout_provider`.
+
+    Args:
+        barcodes (Iterable[str]): The plate barcodes.
+
+    Returns:
+        pl.DataFrame: The plate layout rows with the columns in `config.PLATE_LAYOUT_INFO`.
+
+    Example:
+        ```python
+        layout_df = get_plate_layout(["PB000123", "PB000124"])
+        ```
+    """
+    return plate_layout_provider.get(barcodes)
@@ -1,3 +1,4 @@
+from sqlalchemy import sql, JSON, String
 from .. import config as cfg
 
 
@@ -29,17 +30,126 @@ def experiment_name_sql_query(experiment_name, table_name_on_db):
             """
 
 
-def experiment_metadata_sql_query(name, db_schema, experiment_type):
+# Operators of the reference filter, values without operator are matched as regular expressions
+FILTER_OPERATORS = ["regex", "in", "ilike", "like", "eq"]
+
+
+def _filter_value_condition(table_column, operator, value):
+    """Returns the condition of one filter value, compared with a bound parameter.
+
+    Parameters:
+        table_column (ColumnClause): The column to compare.
+        operator (str): One of the operators in `FILTER_OPERATORS`.
+        value (Any): The value to compare with, a list of values for "in".
+
+    Returns:
+        ColumnElement: The SQL condition.
+    """
+    if operator == "in":
+        return table_column.in_(value)
+    if operator == "eq":
+        return table_column == value
+    # Text operators also apply to date and number columns, e.g. {"analysis_date": ["2021"]}
+    text_column = sql.cast(table_column, String)
+    if operator == "ilike":
+        return text_column.ilike(value)
+    if operator == "like":
+        return text_column.like(value)
+    return text_column.regexp_match(value)
+
+
+def reference_filter_clause(filter, table):
+    """
+    Compiles a reference filter dictionary into a parameterized SQL condition.
+
+    Each key is a column name. Its value is either a list of regular expressions, matched anywhere
+    in the column like `pl.col(key).str.contains(value)`, or a dictionary mapping operators of
+    `FILTER_OPERATORS` to a value or a list of values. The conditions of a key are combined with
+    OR, and the keys are combined with AND. All values are sent as bound parameters.
+
+    Args:
+        filter (dict): The filter dictionary.
+        table (Union[str, TableClause]): The filtered table or its name.
+
+    Returns:
+        ColumnElement: The SQL condition, or None if the filter is empty.
+
+    Raises:
+        ValueError: If an operator is not one of `FILTER_OPERATORS`.
+
+    Example:
+        ```python
+        filter = {
+            "plate_barcode": {"in": ["PB000123", "PB000124"]},
+            "project": {"ilike": ["%aros%"]},
+            "plate_acq_name": ["_[0-9]+$"],
+        }
+        condition = reference_filter_clause(filter, "image_analyses_per_plate")
+        ```
     """
-    Executes a SQL query to retrieve experiment metadata from the database.
+    if isinstance(table, str):
+        table = sql.table(table)
+
+    key_conditions = []
+    for key, values in (filter or {}).items():
+        table_column = (
+            table.c[key] if key in table.c else sql.column(key, _selectable=table)
+        )
+        if not isinstance(values, dict):
+            values = {"regex": values}
+
+        value_conditions = []
+        for operator, operator_values in values.items():
+            if operator not in FILTER_OPERATORS:
+                raise ValueError(
+                    f"Unknown filter operator '{operator}' for column '{key}', expected one of {FILTER_OPERATORS}."
+                )
+            if isinstance(operator_values, str) or not isinstance(
+                operator_values, (list, tuple, set)
+            ):
+                operator_values = [operator_values]
+            if operator == "in":
+                value_conditions.append(
+                    _filter_value_condition(table_column, operator, list(operator_values))
+                )
+            else:
+                value_conditions.extend(
+                    _filter_value_condition(table_column, operator, value)
+                    for value in operator_values
+                )
+        if value_conditions:
+            key_conditions.append(sql.or_(*value_conditions))
+    return sql.and_(*key_conditions) if key_conditions else None
+
+
+def experiment_metadata_sql_query(
+    name,
+    db_schema,
+    experiment_type,
+    filter=None,
+    columns=None,
+    limit=None,
+    latest_analysis_per_plate=False,
+):
+    """
+    Builds a parameterized SQL query to retrieve experiment metadata from the database.
+
+    The experiment name, type and filter values are bound parameters, so only the matching rows
+    and the requested columns are transferred from the server. With `latest_analysis_per_plate`,
+    the replicated analyses of a plate are dropped before the filter is applied, so a filter
+    matching only an older analysis of a plate returns no row for that plate.
 
     Args:
         name (str): The name of the experiment to search for.
         db_schema (dict): A dictionary containing the names of the database schema tables.
         experiment_type (str): The type of experiment to filter by.
+        filter (dict, optional): Additional conditions on the rows, see `reference_filter_clause`. Defaults to None.
+        columns (List[str], optional): The columns to select in addition to the experiment columns of `db_schema`, which the loaders rely on. Defaults to None (all columns).
+        limit (int, optional): The maximum number of rows. Defaults to None (all rows).
+        latest_analysis_per_plate (bool, optional): Whether to keep only the analysis with the highest id of each plate. Defaults to False.
 
     Returns:
-        str: The SQL query string.
+        Select: The SQLAlchemy query, it can be passed to `read_database` or printed.
 
     Example:
         ```python
@@ -54,30 +164,82 @@ def experiment_metadata_sql_query(name, db_schema, experiment_type):
         }
         experiment_type = 'cp-features'
 
-        query = experiment_metadata_sql_query(name, db_schema, experiment_type)
+        query = experiment_metadata_sql_query(
+            name, db_schema, experiment_type, filter={'plate_barcode': {'in': ['PB000123']}}
+        )
         print(query)
         ```
     """
-    return f"""
-            SELECT *
-            FROM {db_schema['EXPERIMENT_METADATA_TABLE_NAME_ON_DB']}
-            WHERE {db_schema['EXPERIMENT_NAME_COLUMN']} LIKE '%%{name}%%'
-            AND meta->>'type' = '{experiment_type}'
-            AND {db_schema['EXPERIMENT_ANALYSIS_DATE_COLUMN']} IS NOT NULL
-            ORDER BY {db_schema['EXPERIMENT_PLATE_BARCODE_COLUMN']}, {db_schema['EXPERIMENT_PLATE_ACQID_COLUMN']}, {db_schema['EXPERIMENT_ANALYSIS_ID_COLUMN']}
-            """
+    metadata_table = sql.table(
+        db_schema["EXPERIMENT_METADATA_TABLE_NAME_ON_DB"],
+        sql.column(db_schema["EXPERIMENT_NAME_COLUMN"]),
+        sql.column(db_schema["EXPERIMENT_ANALYSIS_DATE_COLUMN"]),
+        sql.column(db_schema["EXPERIMENT_PLATE_BARCODE_COLUMN"]),
+        sql.column(db_schema["EXPERIMENT_PLATE_ACQID_COLUMN"]),
+        sql.column(db_schema["EXPERIMENT_ANALYSIS_ID_COLUMN"]),
+        sql.column("meta", JSON),
+    )
+    table_columns = metadata_table.c
+
+    if columns is None:
+        query = sql.select(sql.literal_column("*")).select_from(metadata_table)
+    else:
+        schema_columns = [
+            col
+            for key, col in db_schema.items()
+            if key.startswith("EXPERIMENT_") and key.endswith("_COLUMN")
+        ]
+        query = sql.select(
+            *[
+                table_columns[col]
+                if col in table_columns
+                else sql.column(col, _selectable=metadata_table)
+                for col in dict.fromkeys(schema_columns + list(columns))
+            ]
+        )
+    experiment_conditions = [
+        table_columns[db_schema["EXPERIMENT_NAME_COLUMN"]].contains(name),
+        table_columns["meta"]["type"].as_string() == experiment_type,
+        table_columns[db_schema["EXPERIMENT_ANALYSIS_DATE_COLUMN"]].is_not(None),
+    ]
+    query = query.where(*experiment_conditions)
+    if latest_analysis_per_plate:
+        barcode_column = table_columns[db_schema["EXPERIMENT_PLATE_BARCODE_COLUMN"]]
+        analysis_id_column = table_columns[db_schema["EXPERIMENT_ANALYSIS_ID_COLUMN"]]
+        latest_analyses = (
+            sql.select(barcode_column, sql.func.max(analysis_id_column))
+            .where(*experiment_conditions)
+            .group_by(barcode_column)
+        )
+        query = query.where(
+            sql.tuple_(barcode_column, analysis_id_column).in_(latest_analyses)
+        )
+    filter_clause = reference_filter_clause(filter, metadata_table)
+    if filter_clause is not None:
+        query = query.where(filter_clause)
+    query = query.order_by(
+        table_columns[db_schema["EXPERIMENT_PLATE_BARCODE_COLUMN"]],
+        table_columns[db_schema["EXPERIMENT_PLATE_ACQID_COLUMN"]],
+        table_columns[db_schema["EXPERIMENT_ANALYSIS_ID_COLUMN"]],
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return query
 
 
 def plate_layout_sql_query(db_schema, plate_barcode):
     """
-    Executes a SQL query to retrieve plate layout information from the database.
+    Builds a parameterized SQL query to retrieve the plate layout of one or more plates from the database.
+
+    The barcodes are sent as one bound parameter of an IN condition, so barcodes with quotes are
+    matched as they are and the query text is the same for any set of plates.
 
     Args:
         db_schema (dict): A dictionary containing the names of the database schema tables.
-        plate_barcode (str): The barcode of the plate to query.
+        plate_barcode (Union[str, List[str]]): The barcode of the plate to query, or a list of barcodes.
 
     Returns:
-        str: The SQL query string.
+        Select: The SQLAlchemy query, it can be passed to `read_database` or printed.
 
     Example:
         ```python
@@ -86,15 +248,24 @@ def plate_layout_sql_query(db_schema, plate_barcode):
             'PLATE_LAYOUT_BARCODE_COLUMN': 'barcode',
             'PLATE_COMPOUND_NAME_COLUMN': 'batch_id'
         }
-        plate_barcode = 'ABC123'
+        plate_barcode = ['PB000123', 'PB000124']
 
         query = plate_layout_sql_query(db_schema, plate_barcode)
         print(query)
         ```
     """
-    return f"""
-            SELECT {', '.join(cfg.PLATE_LAYOUT_INFO)}
-            FROM {db_schema['PLATE_LAYOUT_TABLE_NAME_ON_DB']}
-            WHERE ({db_schema['PLATE_LAYOUT_BARCODE_COLUMN']} IN ({plate_barcode}))
-            AND {db_schema['PLATE_COMPOUND_NAME_COLUMN']} <> ''
-            """
+    plate_barcodes = [plate_barcode] if isinstance(plate_barcode, str) else list(plate_barcode)
+    barcode_column = db_schema["PLATE_LAYOUT_BARCODE_COLUMN"]
+    compound_column = db_schema["PLATE_COMPOUND_NAME_COLUMN"]
+    layout_table = sql.table(
+        db_schema["PLATE_LAYOUT_TABLE_NAME_ON_DB"],
+        *[
+            sql.column(col)
+            for col in dict.fromkeys([*cfg.PLATE_LAYOUT_INFO, barcode_column, compound_column])
+        ],
+    )
+    table_columns = layout_table.c
+    return sql.select(*[table_columns[col] for col in cfg.PLATE_LAYOUT_INFO]).where(
+        table_columns[barcode_column].in_(plate_barcodes),
+        table_columns[compound_column] != "",
+    )
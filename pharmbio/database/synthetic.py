@@ -0,0 +1,234 @@
+import json
+import sqlite3
+import numpy as np
+import polars as pl
+from pathlib import Path
+from typing import Union
+from .. import config as cfg
+from ..logger import (
+    log_info,
+)
+
+# Rows and columns of the supported plate formats
+PLATE_FORMATS = {96: (8, 12), 384: (16, 24)}
+
+
+def _synthetic_plate_layout(
+    barcodes: list,
+    wells_per_plate: int,
+    n_compounds: int,
+    empty_well_fraction: float,
+    rng: np.random.Generator,
+) -> pl.DataFrame:
+    """Builds the plate layout rows of the synthetic plates.
+
+    Parameters:
+        barcodes (list): The plate barcodes.
+        wells_per_plate (int): The number of wells of each plate, one of `PLATE_FORMATS`.
+        n_compounds (int): The size of the compound library the wells are drawn from.
+        empty_well_fraction (float): The fraction of wells without compound, which the layout query skips.
+        rng (np.random.Generator): The random generator.
+
+    Returns:
+        pl.DataFrame: The rows of the `plate_v1` table.
+    """
+    n_rows, n_columns = PLATE_FORMATS[wells_per_plate]
+    wells = [
+        f"{chr(ord('A') + row)}{column + 1:02d}"
+        for row in range(n_rows)
+        for column in range(n_columns)
+    ]
+    n_wells = len(barcodes) * len(wells)
+
+    compound_ids = rng.integers(0, n_compounds, n_wells)
+    # Compound structures are long text columns, as in the real library
+    smiles = np.array(
+        ["C" * (20 + i % 40) + f"N{i}" for i in range(n_compounds)], dtype=object
+    )
+    batch_ids = np.array([f"CBK{i:06d}" for i in range(n_compounds)], dtype=object)
+    batch_ids = np.where(
+        rng.random(n_wells) < empty_well_fraction, "", batch_ids[compound_ids]
+    )
+
+    return pl.DataFrame(
+        {
+            "barcode": np.repeat(barcodes, len(wells)),
+            "well_id": np.tile(wells, len(barcodes)),
+            "batch_id": batch_ids,
+            "cmpd_conc": rng.choice([0.1, 1.0, 10.0], n_wells),
+            "cell_line": rng.choice(["U2OS", "HepG2", "A549"], n_wells),
+            "compound_name": [f"compound-{i}" for i in compound_ids],
+            "cbkid": [f"CBK{i:06d}" for i in compound_ids],
+            "smiles": smiles[compound_ids],
+            "inchi": ["InChI=1S/" + s for s in smiles[compound_ids]],
+            "inkey": [f"KEY{i:010d}-N" for i in compound_ids],
+        }
+    ).select(cfg.PLATE_LAYOUT_INFO)
+
+
+def _synthetic_analyses(
+    projects: list,
+    barcodes_per_project: list,
+    replicated_fraction: float,
+    unfinished_fraction: float,
+    rng: np.random.Generator,
+) -> pl.DataFrame:
+    """Builds the image analysis rows of the synthetic plates.
+
+    Every plate has one image quality ("cp-qc") and one morphology ("cp-features") analysis,
+    some plates have a replicated analysis and some analyses are not finished (no date).
+
+    Parameters:
+        projects (list): The project names.
+        barcodes_per_project (list): The plate barcodes of each project.
+        replicated_fraction (float): The fraction of plates whose analyses were run twice.
+        unfinished_fraction (float): The fraction of analyses without analysis date.
+        rng (np.random.Generator): The random generator.
+
+    Returns:
+        pl.DataFrame: The rows of the `image_analyses_per_plate` table.
+    """
+    schema = cfg.DATABASE_SCHEMA
+    rows = []
+    analysis_id = 1000
+    acq_id = 3000
+    for project, barcodes in zip(projects, barcodes_per_project):
+        for barcode in barcodes:
+            acq_id += 1
+            runs = 2 if rng.random() < replicated_fraction else 1
+            for analysis_type in [
+                cfg.IMAHGE_QUALITY_METADATA_TYPE,
+                cfg.CELL_MORPHOLOGY_METADATA_TYPE,
+            ]:
+                for _ in range(runs):
+                    analysis_id += 1
+                    finished = rng.random() >= unfinished_fraction
+                    rows.append(
+                        {
+                            schema["EXPERIMENT_NAME_COLUMN"]: project,
+                            schema["EXPERIMENT_PLATE_BARCODE_COLUMN"]: barcode,
+                            schema["EXPERIMENT_PLATE_ACQID_COLUMN"]: acq_id,
+                            schema["EXPERIMENT_PLATE_AQNAME_COLUMN"]: f"{barcode}_{acq_id}",
+                            schema["EXPERIMENT_ANALYSIS_ID_COLUMN"]: analysis_id,
+                            schema["EXPERIMENT_ANALYSIS_DATE_COLUMN"]: f"202{analysis_id % 4}-0{1 + analysis_id % 9}-15"
+                            if finished
+                            else None,
+                            schema["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]: f"/share/data/cellprofiler/automation/results/{barcode}/{acq_id}/{analysis_id}/",
+                            "meta": json.dumps({"type": analysis_type}),
+                        }
+                    )
+    return pl.DataFrame(rows)
+
+
+def _write_sqlite_table(
+    connection: sqlite3.Connection, table_name: str, df: pl.DataFrame, index_column: str
+):
+    """Creates a table from the dataframe, with an index like the one of the server.
+
+    Parameters:
+        connection (sqlite3.Connection): The open database.
+        table_name (str): The name of the table.
+        df (pl.DataFrame): The rows of the table.
+        index_column (str): The column to index.
+    """
+    sqlite_types = {pl.Int64: "INTEGER", pl.Float64: "REAL"}
+    columns = ", ".join(
+        f'"{name}" {sqlite_types.get(dtype, "TEXT")}' for name, dtype in df.schema.items()
+    )
+    connection.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    connection.execute(f'CREATE TABLE "{table_name}" ({columns})')
+    connection.executemany(
+        f'INSERT INTO "{table_name}" VALUES ({", ".join("?" * df.width)})', df.rows()
+    )
+    connection.execute(
+        f'CREATE INDEX "ix_{table_name}_{index_column}" ON "{table_name}" ("{index_column}")'
+    )
+
+
+def create_synthetic_database(
+    path: Union[str, Path],
+    n_projects: int = 4,
+    plates_per_project: int = 20,
+    wells_per_plate: int = 384,
+    n_compounds: int = 5000,
+    replicated_fraction: float = 0.1,
+    unfinished_fraction: float = 0.02,
+    empty_well_fraction: float = 0.02,
+    seed: int = 0,
+) -> str:
+    """
+    Creates a local SQLite database with synthetic `image_analyses_per_plate` and `plate_v1` tables.
+
+    The tables follow `config.DATABASE_SCHEMA` and `config.PLATE_LAYOUT_INFO`, so all metadata
+    functions can run against the file instead of the production server, e.g. to measure query
+    latency and the cost of the layout joins (see `benchmarks/metadata_benchmark.py`). The
+    analyses point to result directories that do not exist, only the metadata is synthetic.
+
+    Args:
+        path (Union[str, Path]): The database file, replaced if it exists.
+        n_projects (int, optional): The number of projects, named "synthetic-project-0" and so on. Defaults to 4.
+        plates_per_project (int, optional): The number of plates of each project. Defaults to 20.
+        wells_per_plate (int, optional): The plate format, 96 or 384. Defaults to 384.
+        n_compounds (int, optional): The size of the compound library. Defaults to 5000.
+        replicated_fraction (float, optional): The fraction of plates analysed twice. Defaults to 0.1.
+        unfinished_fraction (float, optional): The fraction of analyses without analysis date. Defaults to 0.02.
+        empty_well_fraction (float, optional): The fraction of wells without compound. Defaults to 0.02.
+        seed (int, optional): The random seed. Defaults to 0.
+
+    Returns:
+        str: The SQLAlchemy URI of the database.
+
+    Raises:
+        ValueError: If `wells_per_plate` is not a supported plate format.
+
+    Example:
+        ```python
+        from pharmbio import config as cfg
+        from pharmbio.database.synthetic import create_synthetic_database
+
+        cfg.DB_URI = create_synthetic_database("/tmp/pharmbio_synthetic.db", plates_per_project=100)
+        qc_ref_df = get_image_quality_ref("synthetic-project-0")
+        ```
+    """
+    if wells_per_plate not in PLATE_FORMATS:
+        raise ValueError(
+            f"wells_per_plate must be one of {list(PLATE_FORMATS)}, got {wells_per_plate}."
+        )
+
+    rng = np.random.default_rng(seed)
+    projects = [f"synthetic-project-{i}" for i in range(n_projects)]
+    barcodes_per_project = [
+        [f"PB{i * plates_per_project + j:06d}" for j in range(plates_per_project)]
+        for i in range(n_projects)
+    ]
+    barcodes = [barcode for barcodes in barcodes_per_project for barcode in barcodes]
+
+    analyses_df = _synthetic_analyses(
+        projects, barcodes_per_project, replicated_fraction, unfinished_fraction, rng
+    )
+    layout_df = _synthetic_plate_layout(
+        barcodes, wells_per_plate, n_compounds, empty_well_fraction, rng
+    )
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+    with sqlite3.connect(path) as connection:
+        _write_sqlite_table(
+            connection,
+            cfg.DATABASE_SCHEMA["EXPERIMENT_METADATA_TABLE_NAME_ON_DB"],
+            analyses_df,
+            cfg.DATABASE_SCHEMA["EXPERIMENT_NAME_COLUMN"],
+        )
+        _write_sqlite_table(
+            connection,
+            cfg.DATABASE_SCHEMA["PLATE_LAYOUT_TABLE_NAME_ON_DB"],
+            layout_df,
+            cfg.DATABASE_SCHEMA["PLATE_LAYOUT_BARCODE_COLUMN"],
+        )
+    connection.close()
+
+    log_info(
+        f"Created synthetic database with {analyses_df.height} analyses and {layout_df.height} layout rows: {path}"
+    )
+    return f"sqlite:///{path.resolve()}"
@@ -1,34 +1,66 @@
 import os
 import re
+import shutil
+import tempfile
+import multiprocessing as mp
 import polars as pl
 import pandas as pd
 import polars.selectors as cs
 from pathlib import Path
-from typing import Union, Optional, List, Dict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union, Optional, List, Dict, Tuple, Iterator
 from tqdm.notebook import tqdm
 from .. import config as cfg
+from .. import __version__
+from ..cache import ResultCache, file_fingerprint, make_cache_key
+from .morphology_dataset import (
+    has_plate_partition,
+    upsert_plate_partitions,
+    scan_morphology_dataset,
+)
 from ..utils import has_gpu
 from ..data_processing import feature_aggregation as fa
+from ..data_processing.dtype_policy import (
+    compact_float_columns,
+    categorical_metadata_columns,
+)
+from ..database.connection import read_database
+from ..database.fetch import submit_fetch
+from ..database.plate_layout import get_plate_layout, plate_layout_provider
 from ..database.queries import (
     experiment_metadata_sql_query,
-    plate_layout_sql_query,
 )
 from ..logger import (
     log_info,
     log_warning,
 )
 
+# Levels aggregated within a plate, the compound level is aggregated across plates
+PLATE_AGGREGATION_LEVELS = ["cell", "site", "well", "plate"]
+
+# The object file whose object number is packed into the cell key
+_CELLS_OBJECT_FILE_NAME = next(
+    name for name in cfg.OBJECT_FILE_NAMES if name.split("_")[-1] == "cells"
+)
+
 
 def get_cell_morphology_ref(
     name: str,
-    filter: Optional[Dict[str, str]] = None,
+    filter: Optional[Dict[str, Union[List[str], Dict[str, List[str]]]]] = None,
+    columns: Optional[List[str]] = None,
+    limit: Optional[int] = None,
 ):
     """
     Retrieves cell morphology references from the database based on the specified name and optional filter to select desired rows.
 
+    The filter is compiled into the WHERE clause of the query (see `reference_filter_clause`), so only the matching rows are transferred.
+
     Args:
         name (str): The name of the cell morphology reference.
-        filter (dict, optional): A dictionary specifying the filter conditions. Each key represents a column name, and the corresponding value is a list of values to match. Defaults to None.
+        filter (dict, optional): A dictionary specifying the filter conditions. Each key represents a column name, and the corresponding value is a list of regular expressions to match, or a dictionary of operators ("regex", "in", "ilike", "like", "eq") and values. Defaults to None.
+        columns (List[str], optional): Additional columns to select besides the experiment columns of the schema. Defaults to None (all columns).
+        limit (int, optional): The maximum number of rows. Defaults to None (all rows).
 
     Returns:
         pl.DataFrame: The filtered cell morphology references DataFrame.
@@ -38,7 +70,7 @@ def get_cell_morphology_ref(
         name = "example_reference"
         filter = {
             "column1": ["value_1", "value2"],  # values are combined with OR, and key-values are combined with AND
-            "column2": ["value3"]
+            "column2": {"in": ["value3", "value4"]},
         }
         filtered_df = get_cell_morphology_ref(name, filter)
         display(filtered_df)
@@ -49,26 +81,11 @@ def get_cell_morphology_ref(
         name,
         cfg.DATABASE_SCHEMA,
         cfg.CELL_MORPHOLOGY_METADATA_TYPE,
+        filter=filter,
+        columns=columns,
+        limit=limit,
     )
-    df = pl.read_database(query, cfg.DB_URI)
-
-    if filter is None:
-        return df
-    conditions = []
-    # Iterate over each key-value pair in the filter dictionary
-    for key, values in filter.items():
-        # Create an OR condition for each value associated with a key
-        key_conditions = [pl.col(key).str.contains(val) for val in values]
-        combined_key_condition = key_conditions[0]
-        for condition in key_conditions[1:]:
-            combined_key_condition = combined_key_condition | condition
-        conditions.append(combined_key_condition)
-    # Combine all conditions with AND
-    final_condition = conditions[0]
-    for condition in conditions[1:]:
-        final_condition = final_condition & condition
-    # Apply the condition to the DataFrame
-    return df.filter(final_condition)
+    return read_database(query)
 
 
 def _get_join_columns(object_type: str) -> list:
@@ -111,43 +128,99 @@ def _get_join_columns(object_type: str) -> list:
     return join_columns + [specific_column]
 
 
-def _join_object_dataframes(dfs: Dict[str, pl.DataFrame]) -> pl.DataFrame:
+def _join_object_dataframes(
+    dfs: Dict[str, Union[pl.DataFrame, pl.LazyFrame]]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
     """Merges multiple object-related dataframes based on specified columns.
 
     Parameters:
-        dfs (Dict[str, pl.DataFrame]): Dictionary containing dataframes keyed by object type ('cells', 'cytoplasm', 'nuclei').
+        dfs (Dict[str, Union[pl.DataFrame, pl.LazyFrame]]): Dictionary containing (lazy) dataframes keyed by object type ('cells', 'cytoplasm', 'nuclei').
 
     Returns:
-        pl.DataFrame: The joined dataframe.
+        Union[pl.DataFrame, pl.LazyFrame]: The joined dataframe.
     """
     log_info("Merging the data")
-    # Join nuclei and cell data on specified columns
-    combined_df = dfs["cells"].join(
-        dfs["nuclei"],
-        left_on=_get_join_columns("cells"),
-        right_on=_get_join_columns("nuclei"),
-        how="left",
-        suffix="_nuclei",
-    )
+    # Join nuclei and then cytoplasm data to the cell data on specified columns,
+    # a compartment can be missing if none of its features were selected
+    combined_df = dfs["cells"]
+    for object_type in ["nuclei", "cytoplasm"]:
+        if object_type not in dfs:
+            continue
+        combined_df = combined_df.join(
+            dfs[object_type],
+            left_on=_get_join_columns("cells"),
+            right_on=_get_join_columns(object_type),
+            how="left",
+            suffix=f"_{object_type}",
+        )
 
-    # Further join with cytoplasm data on specified columns and return it
-    return combined_df.join(
-        dfs["cytoplasm"],
-        left_on=_get_join_columns("cells"),
-        right_on=_get_join_columns("cytoplasm"),
-        how="left",
-        suffix="_cytoplasm",
-    )
+    return combined_df
+
+
+def _select_object_columns(
+    object_type: str,
+    column_names: List[str],
+    features: Optional[List[str]] = None,
+) -> List[str]:
+    """Resolves the columns to read from an object feature file against its schema.
+
+    Parameters:
+        object_type (str): The type of the object, one of 'cells', 'cytoplasm', 'nuclei'.
+        column_names (List[str]): The column names in the object feature file.
+        features (List[str], optional): Compartment names (e.g. 'nuclei') selecting all features of that compartment, or regular expressions searched in the feature names with the compartment suffix (e.g. 'AreaShape_Area_cells' or '^Intensity_.*_nuclei$'). Defaults to None which selects all features.
+
+    Returns:
+        List[str]: The columns to read. Empty if no feature of a 'nuclei' or 'cytoplasm' file was selected, in which case the file is not read at all.
+    """
+    unusful_col_pattern = r"^(FileName|PathName|ImageNumber|Number_Object_Number)"
+    useful_columns = [
+        col for col in column_names if not re.match(unusful_col_pattern, col)
+    ]
+    if features is None or object_type in features:
+        return useful_columns
+
+    # Join and metadata keys are always read
+    key_columns = [
+        cfg.METADATA_ACQID_COLUMN,
+        cfg.METADATA_BARCODE_COLUMN,
+        cfg.METADATA_WELL_COLUMN,
+        cfg.METADATA_SITE_COLUMN,
+    ]
+    if object_type == "cells":
+        key_columns += [
+            cfg.OBJECT_ID_COLUMN,
+            cfg.CELL_CYTOPLASM_COUNT_COLUMN,
+            cfg.CELL_NUCLEI_COUNT_COLUMN,
+        ]
+    else:
+        key_columns += [cfg.OBJECT_PARENT_CELL_COLUMN]
+
+    feature_patterns = [
+        re.compile(feature)
+        for feature in features
+        if feature not in {name.split("_")[-1] for name in cfg.OBJECT_FILE_NAMES}
+    ]
+    selected_features = [
+        col
+        for col in useful_columns
+        if col not in key_columns
+        and any(pattern.search(f"{col}_{object_type}") for pattern in feature_patterns)
+    ]
+    if not selected_features and object_type != "cells":
+        return []
+    return [col for col in useful_columns if col in key_columns] + selected_features
 
 
-def _rename_joined_df_columns(df: pl.DataFrame) -> pl.DataFrame:
+def _rename_joined_df_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
     """Renames specific columns in the dataframe by removing the last part after the last underscore or '_cells' that was attached during joining dfs.
 
     Parameters:
-        df (pl.DataFrame): The original joined dataframe with columns to rename.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original joined dataframe with columns to rename.
 
     Returns:
-        pl.DataFrame: The dataframe with renamed columns.
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with renamed columns.
     """
     specific_columns = [
         cfg.METADATA_ACQID_COLUMN,
@@ -163,44 +236,156 @@ def _rename_joined_df_columns(df: pl.DataFrame) -> pl.DataFrame:
     return df.rename(rename_map)
 
 
-def _add_image_cell_id_columns(df: pl.DataFrame) -> pl.DataFrame:
-    """Adds unique Image ID and Cell ID columns to the dataframe by concatenating existing metadata columns.
+def _add_image_cell_key_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
+    """Adds the integer well, image and cell key columns used for joins, filters and groupings.
 
     Parameters:
-        df (pl.DataFrame): The original dataframe.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original dataframe.
 
     Returns:
-        pl.DataFrame: The dataframe with added columns.
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with added columns.
     """
-    # Create ImageID column by concatenating other columns
-    image_id = (
-        df[cfg.METADATA_ACQID_COLUMN]
-        + "_"
-        + df[cfg.METADATA_BARCODE_COLUMN]
-        + "_"
-        + df[cfg.METADATA_WELL_COLUMN]
-        + "_"
-        + df[cfg.METADATA_SITE_COLUMN]
-    ).alias("image_id")
-
-    df = df.with_columns([image_id])
-
-    # Create CellID column by adding ImageID and cell object number
-    cell_id = (df["image_id"] + "_" + df[f"{cfg.OBJECT_ID_COLUMN}_cells"]).alias(
-        "cell_id"
+    # Create well and image keys by packing the metadata columns
+    df = df.with_columns([cfg.CONSTRUCTING_WELL_KEY, cfg.CONSTRUCTING_IMAGE_KEY])
+
+    # Create cell key by adding the cell object number to the image key
+    return df.with_columns([cfg.CONSTRUCTING_CELL_KEY])
+
+
+def _check_key_fields(df: Union[pl.DataFrame, pl.LazyFrame], source: str):
+    """Checks that the metadata packed into the integer keys fits the key fields.
+
+    Values outside their field would overflow the key or bleed into the neighbouring field, and
+    unparsable values would give null keys, so images or cells would be merged or lose their
+    outlier filtering without error. Only the fields whose columns are in `df` are checked, from
+    the minimum, maximum and null count of each field, in one pass.
+
+    Parameters:
+        df (Union[pl.DataFrame, pl.LazyFrame]): The metadata columns of the images or objects.
+        source (str): The data the values come from, for the error message.
+
+    Raises:
+        ValueError: If a value is missing or does not fit its field of `config.KEY_FIELD_BITS`.
+    """
+    fields = {
+        field: (expr, bits)
+        for field, (column, expr, bits) in cfg.KEY_FIELD_BITS.items()
+        if column in df.columns
+    }
+    if not fields:
+        return
+    statistics = (
+        df.lazy()
+        .select(
+            [
+                statistic
+                for field, (expr, _) in fields.items()
+                for statistic in [
+                    expr.min().alias(f"{field}_min"),
+                    expr.max().alias(f"{field}_max"),
+                    expr.null_count().alias(f"{field}_nulls"),
+                ]
+            ]
+        )
+        .collect()
+        .row(0, named=True)
     )
+    for field, (_, bits) in fields.items():
+        if statistics[f"{field}_nulls"]:
+            raise ValueError(
+                f"{statistics[f'{field}_nulls']} rows of {source} have no valid {field}, they cannot be given a key."
+            )
+        if statistics[f"{field}_min"] is None:
+            continue
+        if statistics[f"{field}_min"] < 0 or statistics[f"{field}_max"] >= 2**bits:
+            raise ValueError(
+                f"The {field} of {source} ranges from {statistics[f'{field}_min']} to {statistics[f'{field}_max']}, "
+                f"the keys only hold values from 0 to {2**bits - 1} ({bits} bits)."
+            )
+
+
+def _add_image_cell_id_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
+    """Adds human-readable Image ID and Cell ID columns to the dataframe by concatenating existing metadata columns.
+
+    The Cell ID is only added if the dataframe still has a cell key, i.e. at cell level.
+
+    Parameters:
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original dataframe.
+
+    Returns:
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with added columns.
+    """
+    # Create ImageID column by concatenating other columns
+    df = df.with_columns([cfg.CONSTRUCTING_IMAGE_ID])
+
+    if cfg.CELL_KEY_COLUMN_NAME not in df.columns:
+        return df
 
-    return df.with_columns([cell_id])
+    # Create CellID column by adding ImageID and the cell object number stored in the key
+    return df.with_columns([cfg.CONSTRUCTING_CELL_ID])
 
 
-def _drop_unwanted_columns(df: pl.DataFrame) -> pl.DataFrame:
+def _finalize_aggregated_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame],
+    aggregation_level: str,
+    add_string_ids: bool = False,
+) -> Union[pl.DataFrame, pl.LazyFrame]:
+    """Drops the keys finer than the aggregation level, optionally adds string IDs and puts the identifiers first.
+
+    Parameters:
+        df (Union[pl.DataFrame, pl.LazyFrame]): The aggregated dataframe.
+        aggregation_level (str): The level the dataframe was aggregated to.
+        add_string_ids (bool, optional): Whether to add the "image_id" (cell and site level) and "cell_id" (cell level) string columns. Defaults to False.
+
+    Returns:
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe ready to be returned.
+    """
+    key_columns = [
+        cfg.CELL_KEY_COLUMN_NAME,
+        cfg.IMAGE_KEY_COLUMN_NAME,
+        cfg.WELL_KEY_COLUMN_NAME,
+    ]
+    kept_keys = {
+        "cell": key_columns,
+        "site": key_columns[1:],
+        "well": key_columns[2:],
+    }.get(aggregation_level, [])
+    df = df.drop([col for col in key_columns if col in df.columns and col not in kept_keys])
+
+    if add_string_ids and aggregation_level in ["cell", "site"]:
+        df = _add_image_cell_id_columns(df)
+
+    leading_columns = [
+        col
+        for col in [
+            cfg.CELL_ID_COLUMN_NAME,
+            cfg.IMAGE_ID_COLUMN_NAME,
+            *key_columns,
+            cfg.METADATA_ACQID_COLUMN,
+            cfg.METADATA_BARCODE_COLUMN,
+            cfg.METADATA_WELL_COLUMN,
+            cfg.METADATA_SITE_COLUMN,
+            cfg.DATABASE_SCHEMA["PLATE_COMPOUND_NAME_COLUMN"],
+        ]
+        if col in df.columns
+    ]
+    return df.select(pl.col(leading_columns), pl.exclude(leading_columns))
+
+
+def _drop_unwanted_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
     """Drops specified columns if they exist in the dataframe.
 
     Parameters:
-        df (pl.DataFrame): The original dataframe.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original dataframe.
 
     Returns:
-        pl.DataFrame: The dataframe with specified columns dropped.
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with specified columns dropped.
     """
     # List of columns to drop
     drop_map = [
@@ -219,14 +404,16 @@ def _drop_unwanted_columns(df: pl.DataFrame) -> pl.DataFrame:
     return df.drop([col for col in drop_map if col in df.columns])
 
 
-def _cast_metadata_type_columns(df: pl.DataFrame) -> pl.DataFrame:
+def _cast_metadata_type_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
     """Ensures data type consistency for specified metadata columns.
 
     Parameters:
-        df (pl.DataFrame): The original dataframe.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original dataframe.
 
     Returns:
-        pl.DataFrame: The dataframe with specified columns cast to the correct data type.
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with specified columns cast to the correct data type.
     """
     # Define metadata columns to cast
     metadata_columns = [
@@ -242,34 +429,53 @@ def _cast_metadata_type_columns(df: pl.DataFrame) -> pl.DataFrame:
     return df.with_columns(cast_cols)
 
 
-def _get_morphology_feature_cols(df: pl.DataFrame) -> List:
+def _get_morphology_feature_cols(df: Union[pl.DataFrame, pl.LazyFrame]) -> List:
     """Returnd the columns in the dataframe that are morphology features.
 
     Parameters:
-        df (pl.DataFrame): The original dataframe.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original dataframe.
 
     Returns:
-        pl.DataFrame: The dataframe with reordered columns.
+        List: The names of the morphology feature columns.
     """
-    morphology_feature_cols_list = df.select(cs.by_dtype(pl.NUMERIC_DTYPES)).columns
+    morphology_feature_cols_list = df.select(
+        cs.by_dtype(pl.NUMERIC_DTYPES)
+        - cs.by_name(
+            cfg.CELL_KEY_COLUMN_NAME,
+            cfg.IMAGE_KEY_COLUMN_NAME,
+            cfg.WELL_KEY_COLUMN_NAME,
+        )
+    ).columns
     morphology_feature_cols_list.remove(cfg.CELL_NUCLEI_COUNT_COLUMN)
     morphology_feature_cols_list.remove(cfg.CELL_CYTOPLASM_COUNT_COLUMN)
     return morphology_feature_cols_list
 
 
-def _reorder_dataframe_columns(df: pl.DataFrame) -> pl.DataFrame:
+def _reorder_dataframe_columns(
+    df: Union[pl.DataFrame, pl.LazyFrame]
+) -> Union[pl.DataFrame, pl.LazyFrame]:
     """Reorders the columns in the dataframe based on data types and specific columns.
 
     Parameters:
-        df (pl.DataFrame): The original dataframe.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The original dataframe.
 
     Returns:
-        pl.DataFrame: The dataframe with reordered columns.
+        Union[pl.DataFrame, pl.LazyFrame]: The dataframe with reordered columns.
     """
     morphology_feature_cols = _get_morphology_feature_cols(df)
     non_numeric_cols = df.select(cs.by_dtype(pl.Utf8)).columns
+    key_cols = [
+        col
+        for col in [
+            cfg.CELL_KEY_COLUMN_NAME,
+            cfg.IMAGE_KEY_COLUMN_NAME,
+            cfg.WELL_KEY_COLUMN_NAME,
+        ]
+        if col in df.columns
+    ]
     new_order = (
         sorted(non_numeric_cols)
+        + key_cols
         + [
             cfg.CELL_NUCLEI_COUNT_COLUMN,
             cfg.CELL_CYTOPLASM_COUNT_COLUMN,
@@ -280,28 +486,37 @@ def _reorder_dataframe_columns(df: pl.DataFrame) -> pl.DataFrame:
     return df.select(new_order)
 
 
-def _merge_with_plate_info(df: pl.DataFrame) -> pl.DataFrame:
+def _merge_with_plate_info(
+    df: Union[pl.DataFrame, pl.LazyFrame],
+    barcode_list: Optional[List[str]] = None,
+    df_plates: Optional[pl.DataFrame] = None,
+) -> Union[pl.DataFrame, pl.LazyFrame]:
     """Merges the object dataframe with plate information.
 
     Parameters:
-        df (pl.DataFrame): The object dataframe containing cellular morphology features.
-        plate_layout_sql_query (callable): A function that returns SQL query for fetching plate layout info.
+        df (Union[pl.DataFrame, pl.LazyFrame]): The object dataframe containing cellular morphology features.
+        barcode_list (List[str], optional): The plate barcodes to get the layout for. Defaults to the unique barcodes in `df`, which requires collecting that column when `df` is lazy.
+        df_plates (pl.DataFrame, optional): The plate layout rows to merge with. Defaults to the layout of `barcode_list` from the shared plate layout provider, which only queries the database for plates it has not seen yet.
 
     Returns:
-        pl.DataFrame: Dataframe with merged plate information.
+        Union[pl.DataFrame, pl.LazyFrame]: Dataframe with merged plate information.
     """
 
-    # Extract unique barcodes
-    barcode_list = df[cfg.METADATA_BARCODE_COLUMN].unique().to_list()
-    barcode_str = ", ".join([f"'{item}'" for item in barcode_list])
-
-    # Fetch plate layout data from db
-    query = plate_layout_sql_query(cfg.DATABASE_SCHEMA, barcode_str)
-    df_plates = pl.read_database(query, cfg.DB_URI)
+    if df_plates is None:
+        # Extract unique barcodes
+        if barcode_list is None:
+            barcode_list = (
+                df.select(pl.col(cfg.METADATA_BARCODE_COLUMN).unique())
+                .lazy()
+                .collect()
+                .to_series()
+                .to_list()
+            )
+        df_plates = get_plate_layout(barcode_list)
 
     # Merge dataframes
     df = df.join(
-        df_plates,
+        df_plates.lazy() if isinstance(df, pl.LazyFrame) else df_plates,
         how="left",
         left_on=[
             cfg.METADATA_BARCODE_COLUMN,
@@ -368,7 +583,7 @@ def _outlier_series_to_delete(
     flagged_qc_df: pl.DataFrame,
     site_threshold: int = 6,
     compound_threshold: float = 0.7,
-) -> (pl.Series, pl.Series, pl.DataFrame):
+) -> Tuple[pl.Series, pl.Series, pl.Series, pl.Series]:
     """
     Identifies and flags outliers in a Polars DataFrame of cell morphology data.
 
@@ -378,7 +593,8 @@ def _outlier_series_to_delete(
         compound_threshold (float): The threshold for the percentage of data loss at which a compound is considered for deletion (range 0-1).
 
     Returns:
-        tuple of pl.Series: Two series, one with the identifiers of the compounds to be deleted, and another with image IDs of sites to be deleted.
+        tuple of pl.Series: Four series with the identifiers of the compounds to be deleted, the image keys of sites to be deleted,
+        the well keys of wells that only hold deleted compounds and the acquisition IDs of plates that only hold deleted compounds.
     """
     outlier_df = get_outlier_df(flagged_qc_df)
 
@@ -389,6 +605,7 @@ def _outlier_series_to_delete(
         .alias(cfg.METADATA_SITE_COLUMN)
     )
 
+    _check_key_fields(flagged_qc_df, "the image quality data")
     df_to_delete = _cast_metadata_type_columns(
         outlier_df.with_columns(filtered_site_columns)
         .select(
@@ -400,18 +617,10 @@ def _outlier_series_to_delete(
             ]
         )
         .explode(cfg.METADATA_SITE_COLUMN)
-    ).with_columns(
-        (
-            pl.col(cfg.METADATA_ACQID_COLUMN)
-            + "_"
-            + pl.col(cfg.METADATA_BARCODE_COLUMN)
-            + "_"
-            + pl.col(cfg.METADATA_WELL_COLUMN)
-            + "_"
-            + pl.col(cfg.METADATA_SITE_COLUMN)
-        ).alias("image_id")
+    ).with_columns(cfg.CONSTRUCTING_IMAGE_KEY)
+    img_series_to_delete = (
+        df_to_delete.select(cfg.IMAGE_KEY_COLUMN_NAME).to_series().unique().sort()
     )
-    img_series_to_delete = df_to_delete.select("image_id").to_series().sort()
     df_to_delete_with_comp = _merge_with_plate_info(flagged_qc_df)
 
     df_comp_to_delet = (
@@ -436,7 +645,36 @@ def _outlier_series_to_delete(
 
     comp_series_to_delete = df_comp_to_delet.select("batch_id").to_series()
 
-    return comp_series_to_delete, img_series_to_delete
+    # Wells and plates left without compounds are not read from the object files at all
+    df_wells = (
+        _cast_metadata_type_columns(df_to_delete_with_comp)
+        .group_by(cfg.CONSTRUCTING_WELL_KEY)
+        .agg(pl.col("batch_id").is_in(comp_series_to_delete).all().alias("deleted"))
+        .with_columns(
+            (pl.col(cfg.WELL_KEY_COLUMN_NAME) // 2**cfg.WELL_KEY_ACQID_SHIFT).alias(cfg.METADATA_ACQID_COLUMN)
+        )
+    )
+    well_series_to_delete = (
+        df_wells.filter(pl.col("deleted"))
+        .select(cfg.WELL_KEY_COLUMN_NAME)
+        .to_series()
+        .sort()
+    )
+    plate_series_to_delete = (
+        df_wells.group_by(cfg.METADATA_ACQID_COLUMN)
+        .agg(pl.col("deleted").all())
+        .filter(pl.col("deleted"))
+        .select(cfg.METADATA_ACQID_COLUMN)
+        .to_series()
+        .sort()
+    )
+
+    return (
+        comp_series_to_delete,
+        img_series_to_delete,
+        well_series_to_delete,
+        plate_series_to_delete,
+    )
 
 
 def get_comp_outlier_info(flagged_df: pl.DataFrame) -> pl.DataFrame:
@@ -473,16 +711,350 @@ def get_comp_outlier_info(flagged_df: pl.DataFrame) -> pl.DataFrame:
         )
     )
 
+
+def _keys_of_plate(keys: pl.Series, plate_metadata: Dict) -> pl.Series:
+    """Returns the well or image keys that belong to the plate.
+
+    Parameters:
+        keys (pl.Series): Well or image keys of all plates.
+        plate_metadata (Dict): One row of the cell morphology reference dataframe.
+
+    Returns:
+        pl.Series: The keys of the plate.
+    """
+    # The AcqID is stored above the well bits of the well key and the well and site bits of the image key
+    acq_id_shift = (
+        cfg.IMAGE_KEY_ACQID_SHIFT
+        if keys.name == cfg.IMAGE_KEY_COLUMN_NAME
+        else cfg.WELL_KEY_ACQID_SHIFT
+    )
+    acq_id = int(plate_metadata[cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_ACQID_COLUMN"]])
+    return keys.filter(keys // 2**acq_id_shift == acq_id)
+
+
+def _plate_cache_key(
+    plate_metadata: Dict,
+    img_series_to_delete: pl.Series,
+    well_series_to_delete: pl.Series,
+    df_plates: pl.DataFrame,
+    settings: Dict,
+) -> str:
+    """Returns the cache key of a processed plate.
+
+    The key covers the size and modification time of the plate's object files, the outlier
+    image and well keys that belong to the plate, the plate layout rows merged into the plate
+    and the processing settings.
+
+    Parameters:
+        plate_metadata (Dict): One row of the cell morphology reference dataframe.
+        img_series_to_delete (pl.Series): Image keys of the outlier sites of all plates.
+        well_series_to_delete (pl.Series): Well keys of the wells of deleted compounds of all plates.
+        df_plates (pl.DataFrame): The layout rows of the plate.
+        settings (Dict): The settings that change the processed plate.
+
+    Returns:
+        str: The cache key.
+    """
+    result_directory = plate_metadata[
+        cfg.DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]
+    ]
+    file_fingerprints = [
+        file_fingerprint(f"{result_directory}{object_file_name}.parquet")
+        for object_file_name in cfg.OBJECT_FILE_NAMES
+    ]
+
+    plate_outliers = _keys_of_plate(img_series_to_delete, plate_metadata).to_list()
+    plate_deleted_wells = _keys_of_plate(well_series_to_delete, plate_metadata).to_list()
+
+    # A layout edited in the database changes the key, the rows are sorted by the provider
+    plate_layout_rows = df_plates.write_csv()
+
+    return make_cache_key(
+        "cell_morphology_plate",
+        file_fingerprints,
+        plate_outliers,
+        plate_deleted_wells,
+        plate_layout_rows,
+        settings,
+    )
+
+
+def _plates_in_memory_budget(
+    cell_morphology_ref_df: pl.DataFrame, memory_budget_gb: float
+) -> int:
+    """Returns how many plates can be processed at the same time within the memory budget.
+
+    The memory of a plate is estimated from the size of its object files on disk, scaled by
+    `config.PLATE_MEMORY_EXPANSION_FACTOR`, and the largest plate of the experiment is used.
+
+    Parameters:
+        cell_morphology_ref_df (pl.DataFrame): The cell morphology reference dataframe.
+        memory_budget_gb (float): The memory budget in GB.
+
+    Returns:
+        int: The number of plates that fit in the budget, at least 1.
+    """
+    largest_plate_size = max(
+        sum(
+            os.path.getsize(f"{result_directory}{object_file_name}.parquet")
+            for object_file_name in cfg.OBJECT_FILE_NAMES
+        )
+        for result_directory in cell_morphology_ref_df[
+            cfg.DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]
+        ]
+    )
+    plate_memory_gb = largest_plate_size * cfg.PLATE_MEMORY_EXPANSION_FACTOR / 1024**3
+    if plate_memory_gb > memory_budget_gb:
+        log_warning(
+            f"A single plate is estimated to need {plate_memory_gb:.1f} GB, more than the memory budget of {memory_budget_gb} GB."
+        )
+    return max(int(memory_budget_gb // plate_memory_gb), 1) if plate_memory_gb else 1
+
+
+def _sink_parquet(lf: pl.LazyFrame, file_path: str):
+    """Writes a lazy plan to a parquet file with the streaming engine, collecting it if the engine cannot run the plan.
+
+    Parameters:
+        lf (pl.LazyFrame): The plan to write.
+        file_path (str): The parquet file.
+    """
+    try:
+        lf.sink_parquet(file_path)
+    except pl.InvalidOperationError:
+        # Sorted group-by aggregations are not supported by the streaming sinks of every Polars version
+        lf.collect().write_parquet(file_path)
+
+
+def _process_plate(
+    plate_metadata: Dict,
+    img_series_to_delete: pl.Series,
+    well_series_to_delete: pl.Series,
+    aggregation_level: Union[str, List[str]],
+    aggregation_method: Dict[str, str],
+    df_plates: Optional[pl.DataFrame] = None,
+    features: Optional[List[str]] = None,
+    add_string_ids: bool = False,
+    compact_dtypes: bool = False,
+    use_gpu: bool = False,
+    output_filename_per_plate: Optional[Dict[str, str]] = None,
+    return_paths: bool = False,
+) -> Dict[str, Union[pl.DataFrame, str]]:
+    """Reads, joins and aggregates the object feature files of a single plate.
+
+    The function is self-contained so it can run either in the calling process or
+    in a worker of a process pool (see `max_workers` in `get_cell_morphology_data`).
+    When several levels are requested, each one is aggregated from the collected
+    result of the previous one, so the object files are read only once.
+    With `return_paths`, only the paths of the written files are returned, so no
+    dataframe is sent back to the calling process.
+
+    Parameters:
+        plate_metadata (Dict): One row of the cell morphology reference dataframe.
+        img_series_to_delete (pl.Series): Image keys of the outlier sites to remove.
+        well_series_to_delete (pl.Series): Well keys of the wells of deleted compounds to remove.
+        aggregation_level (Union[str, List[str]]): The level or levels ("cell", "site", "well", "plate") to return.
+        aggregation_method (Dict[str, str]): The aggregation method for each level.
+        df_plates (pl.DataFrame, optional): The layout rows of the plate, so that workers do not query the database. Defaults to None (fetched by the plate layout provider).
+        features (List[str], optional): The feature selection passed to `_select_object_columns`. Defaults to None (all features).
+        add_string_ids (bool, optional): Whether to add the string "image_id" and "cell_id" columns to the result. Defaults to False.
+        compact_dtypes (bool, optional): Whether to read the Float64 features as `config.COMPACT_FLOAT_DTYPE`. Defaults to False.
+        use_gpu (bool, optional): Whether to use GPU acceleration. Defaults to False.
+        output_filename_per_plate (Dict[str, str], optional): If given, the aggregated plate of each level in the dictionary is also written to its parquet file.
+        return_paths (bool, optional): Whether to return the file of each level instead of its dataframe. The last level is sunk to its file without being collected when the streaming engine supports the plan. Requires a file in `output_filename_per_plate` for every requested level. Defaults to False.
+
+    Returns:
+        Dict[str, Union[pl.DataFrame, str]]: The aggregated plate dataframe, or its file with `return_paths`, for each requested level.
+    """
+    aggregation_levels = (
+        [aggregation_level] if isinstance(aggregation_level, str) else aggregation_level
+    )
+    aggregation_func = fa.aggregate_data_gpu if use_gpu else fa.aggregate_data_cpu
+
+    # Outlier sites and wells of deleted compounds are dropped from each object file at scan time
+    plate_img_series_to_delete = _keys_of_plate(img_series_to_delete, plate_metadata)
+    plate_well_series_to_delete = _keys_of_plate(well_series_to_delete, plate_metadata)
+    outlier_filter = (
+        ~cfg.CONSTRUCTING_WELL_KEY.is_in(plate_well_series_to_delete)
+        & ~cfg.CONSTRUCTING_IMAGE_KEY.is_in(plate_img_series_to_delete)
+    )
+
+    # The keys are built from the metadata of the cells, only those columns are read for the check
+    _check_key_fields(
+        pl.scan_parquet(
+            f"{plate_metadata[cfg.DATABASE_SCHEMA['EXPERIMENT_RESULT_DIRECTORY_COLUMN']]}{_CELLS_OBJECT_FILE_NAME}.parquet"
+        ),
+        f"plate {plate_metadata[cfg.DATABASE_SCHEMA['EXPERIMENT_PLATE_ACQID_COLUMN']]}",
+    )
+
+    # Build one lazy plan per object file, only the selected columns are read from parquet
+    object_feature_lazyframes = {}
+    for object_file_name in cfg.OBJECT_FILE_NAMES:
+        object_feature_file_path = f"{plate_metadata[cfg.DATABASE_SCHEMA['EXPERIMENT_RESULT_DIRECTORY_COLUMN']]}{object_file_name}.parquet"
+
+        # Resolve the columns against the parquet schema before reading any data
+        object_feature_lf = pl.scan_parquet(object_feature_file_path)
+        object_name = object_file_name.split("_")[-1]
+        columns_names = _select_object_columns(
+            object_name, object_feature_lf.columns, features
+        )
+        if not columns_names:
+            log_info(f"\tSkipping {object_name}, none of its features were selected")
+            continue
+
+        if len(plate_img_series_to_delete) or len(plate_well_series_to_delete):
+            object_feature_lf = object_feature_lf.filter(outlier_filter)
+
+        # Adding object type name to the end of column name
+        object_feature_lazyframes[object_name] = object_feature_lf.select(
+            [pl.col(col).alias(f"{col}_{object_name}") for col in columns_names]
+        )
+        if compact_dtypes:
+            object_feature_lazyframes[object_name] = compact_float_columns(
+                object_feature_lazyframes[object_name]
+            )
+        log_info(
+            f"\tScanning features ({len(columns_names)} columns) - {object_name}: \t{object_feature_file_path}"
+        )
+
+    # Join df dictionary (first cell -> nuclei and then -> cytoplasm)
+    joined_object_lf = _join_object_dataframes(object_feature_lazyframes)
+
+    # Remove '_cells' from metadata columns' name for better consistency and clarity
+    joined_object_lf = _rename_joined_df_columns(joined_object_lf)
+
+    # Create compact integer well, image and cell keys from the metadata columns
+    joined_object_lf = _add_image_cell_key_columns(joined_object_lf)
+
+    # Clean df from temporary, unused or unwanted columns
+    joined_object_lf = _drop_unwanted_columns(joined_object_lf)
+
+    # Ensure data type consistency for Metadata columns
+    joined_object_lf = _cast_metadata_type_columns(joined_object_lf)
+
+    # Ordering the columns
+    joined_object_lf = _reorder_dataframe_columns(joined_object_lf)
+
+    # List of morphology columns
+    morphology_feature_cols = _get_morphology_feature_cols(joined_object_lf)
+    if not morphology_feature_cols:
+        raise ValueError(f"None of the requested features were found: {features}")
+
+    # Adding plate layout data to df
+    aggregated_data = _merge_with_plate_info(
+        joined_object_lf,
+        barcode_list=[
+            plate_metadata[cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"]]
+        ],
+        df_plates=df_plates,
+    )
+
+    # The CPU aggregation extends the lazy plan, the GPU one collects at each level.
+    # The plan is executed once per requested level, each from the previous result.
+    aggregated_levels = {}
+    for level in PLATE_AGGREGATION_LEVELS:
+        aggregated_data = aggregation_func(
+            df=aggregated_data,
+            columns_to_aggregate=morphology_feature_cols,
+            groupby_columns=cfg.GROUPING_COLUMN_MAP[level],
+            aggregation_function=aggregation_method[level],
+        )
+        if level not in aggregation_levels:
+            continue
+
+        if return_paths and len(aggregated_levels) + 1 == len(aggregation_levels):
+            # No level is aggregated from the last one, it does not need to be collected
+            _sink_parquet(
+                _finalize_aggregated_columns(aggregated_data.lazy(), level, add_string_ids),
+                output_filename_per_plate[level],
+            )
+            aggregated_levels[level] = output_filename_per_plate[level]
+            log_info(
+                f"\tAggregated features at {level} level: {output_filename_per_plate[level]}"
+            )
+            break
+
+        level_data = aggregated_data.lazy().collect()
+        aggregated_levels[level] = _finalize_aggregated_columns(
+            level_data, level, add_string_ids
+        )
+        log_info(
+            f"\tAggregated features {aggregated_levels[level].shape} at {level} level"
+        )
+
+        # Write the aggregated data to a parquet file
+        if output_filename_per_plate is not None and level in output_filename_per_plate:
+            aggregated_levels[level].write_parquet(output_filename_per_plate[level])
+            if return_paths:
+                aggregated_levels[level] = output_filename_per_plate[level]
+
+        if len(aggregated_levels) == len(aggregation_levels):
+            break
+        aggregated_data = level_data.lazy()
+
+    return aggregated_levels
+
+
+def _iterate_processed_plates(
+    plate_jobs: List[Dict],
+    max_workers: int = 1,
+    max_plates_in_flight: Optional[int] = None,
+) -> Iterator[Dict[str, Union[pl.DataFrame, str]]]:
+    """Runs `_process_plate` for each job and yields the results in the order of the jobs.
+
+    With `max_workers` greater than 1 the plates are processed in a process pool. At most
+    `max_plates_in_flight` plates are submitted at any time, so only that many per-plate
+    results can be held in memory while waiting for the oldest plate to finish.
+
+    Parameters:
+        plate_jobs (List[Dict]): Keyword arguments for `_process_plate`, one dictionary per plate.
+        max_workers (int, optional): The number of worker processes. Defaults to 1 (no pool).
+        max_plates_in_flight (int, optional): The maximum number of submitted but not yet consumed plates. Defaults to `max_workers`.
+
+    Yields:
+        Dict[str, Union[pl.DataFrame, str]]: The result of `_process_plate` for each job.
+    """
+    if max_workers <= 1:
+        for job in plate_jobs:
+            yield _process_plate(**job)
+        return
+
+    if max_plates_in_flight is None:
+        max_plates_in_flight = max_workers
+    max_plates_in_flight = max(max_plates_in_flight, 1)
+
+    # "spawn" avoids forking a process that already holds polars' thread pool
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=mp.get_context("spawn")
+    ) as executor:
+        in_flight = deque()
+        for job in plate_jobs:
+            if len(in_flight) >= max_plates_in_flight:
+                yield in_flight.popleft().result()
+            in_flight.append(executor.submit(_process_plate, **job))
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
 def get_cell_morphology_data(
     cell_morphology_ref_df: Union[pl.DataFrame, pd.DataFrame],
     flagged_qc_df: Union[pl.DataFrame, pd.DataFrame] = None,
     site_threshold: int = 6,
     compound_threshold: float = 0.7,
-    aggregation_level: str = "cell",
+    aggregation_level: Union[str, List[str]] = "cell",
     aggregation_method: Optional[Dict[str, str]] = None,
+    features: Optional[List[str]] = None,
+    add_string_ids: bool = False,
+    compact_dtypes: bool = False,
     path_to_save: str = "data",
     use_gpu: bool = False,
     save_plate_separately: bool = False,
+    save_as_dataset: bool = False,
+    max_workers: int = 1,
+    max_plates_in_flight: Optional[int] = None,
+    streaming: bool = False,
+    memory_budget_gb: Optional[float] = None,
+    use_cache: bool = False,
+    cache_dir: Optional[str] = None,
 ):
     """
     Retrieves cell morphology data from the specified cell morphology reference DataFrame and performs aggregation at the specified level.
@@ -492,14 +1064,27 @@ def get_cell_morphology_data(
         flagged_qc_df(Union[pl.DataFrame, pd.DataFrame]): QC dataframe flagged by outlier images. (Optional)
         site_threshold (int): If number of sites in a well that have been flagged goes above this number the whole well will be removed. Default to 6,
         compound_threshold (float): The amount of lost information needed in order to delete the compound from df. Value should be between 0 and 1. Default to 0.7.
-        aggregation_level (str, optional): The level at which to perform aggregation. Defaults to "cell". It can be one of the following: "cell", "site", "well", "plate", "compound".
+        aggregation_level (Union[str, List[str]], optional): The level at which to perform aggregation. Defaults to "cell". It can be one of the following: "cell", "site", "well", "plate", "compound".
+        A list of levels, e.g. ["site", "well", "plate"], returns all of them from a single read of the object files. Each level is aggregated from the previous one and written to its own output, with the level in the file name (e.g. `{experiment}_well_all_plates.parquet`).
         aggregation_method (Dict[str, str], optional): The aggregation method for each level. Defaults to None.
         You shoul set the aggregation method for each level in a dictionary. Possible values are: "mean", "median", "sum", "min", "max", "first", "last".
+        features (List[str], optional): The features to load. Defaults to None (all features). Each item is either a compartment name ("cells", "nuclei", "cytoplasm") selecting all of its features, or a regular expression searched in the feature names as they appear in the output, e.g. "^Intensity_.*_cells$", "AreaShape_" or an explicit name like "AreaShape_Area_nuclei". Only the selected columns plus the join and metadata keys are read from the parquet files.
+        add_string_ids (bool, optional): Whether to add the human-readable "image_id" (cell and site level) and "cell_id" (cell level) string columns to the output. The data is always identified by the integer "cell_key", "image_key" and "well_key" columns (see config). Defaults to False.
+        compact_dtypes (bool, optional): Whether to apply the compact dtype policy: features are read as Float32 (`config.COMPACT_FLOAT_DTYPE`) and the string metadata in `config.CATEGORICAL_METADATA_COLUMNS` is returned as Categorical, which roughly halves the memory and the cache size of cell level data. Use `dtype_policy.get_dtype_report` on data loaded without it to see the memory saved and the precision lost per feature. Defaults to False.
         path_to_save (str, optional): The path to save the aggregated data. Defaults to "data".
         use_gpu (bool, optional): Whether to use GPU acceleration. Defaults to False.
+        save_plate_separately (bool, optional): Whether to write each plate to its own parquet file instead of one combined file. Defaults to False.
+        save_as_dataset (bool, optional): Whether to write the plates to a Hive-partitioned parquet dataset in `{path_to_save}/{experiment_name}_dataset` (see `morphology_dataset.upsert_plate_partitions`) instead of one combined file. Plates whose partition was written with the same input files, outliers and settings are skipped, so adding plates to an experiment only processes the new ones. A LazyFrame over the dataset is returned. Defaults to False.
+        max_workers (int, optional): The number of processes used to load and aggregate plates concurrently. Defaults to 1 (plates are processed one after another in the current process).
+        max_plates_in_flight (int, optional): The maximum number of plates being processed or waiting to be collected at the same time, which bounds the memory used by the pool. Defaults to `max_workers`.
+        streaming (bool, optional): Whether to keep the experiment out of memory. Each processed plate is written to disk as soon as it is done, the plates are combined into the output file with Polars' streaming engine and the compound level is aggregated out of core. A LazyFrame over the output file is returned. Defaults to False.
+        memory_budget_gb (float, optional): The memory in GB that the plates being processed may use. It lowers `max_workers` and `max_plates_in_flight` so that the estimated memory of the plates in flight fits the budget, see `config.PLATE_MEMORY_EXPANSION_FACTOR`. Defaults to None (no limit).
+        use_cache (bool, optional): Whether to reuse per-plate and combined results from the on-disk cache. Entries are keyed by the size and modification time of the plate's object files, the outlier sites and the layout rows of the plate and all aggregation settings, so changing any of them recomputes the affected plates. The cache stores every processed plate, for cell level data about the size of the experiment's output, up to `config.CACHE_MAX_SIZE_GB` (50 GB by default) in `cache_dir`. Defaults to False.
+        cache_dir (str, optional): The cache directory. Defaults to `config.CACHE_DIRECTORY`.
 
     Returns:
-        pl.DataFrame: The aggregated cell morphology data.
+        Union[pl.DataFrame, pl.LazyFrame]: The aggregated cell morphology data, lazy if `save_as_dataset` or `streaming` is True.
+        If `aggregation_level` is a list, a dictionary with the data of each level is returned.
 
     Raises:
         EnvironmentError: Raised when GPU is not available on the machine ans use_gpu is True.
@@ -507,8 +1092,23 @@ def get_cell_morphology_data(
     Example:
         ```python
         cell_morphology_ref_df = get_cell_morphology_ref("example_reference", filter)
-        aggregated_df = get_cell_morphology_data(cell_morphology_ref_df, aggregation_level='plate')
+        aggregated_df = get_cell_morphology_data(cell_morphology_ref_df, aggregation_level='plate', max_workers=8)
+        intensity_df = get_cell_morphology_data(cell_morphology_ref_df, features=["^Intensity_.*_cells$", "^AreaShape_.*_cells$"])
         display(aggregated_df)
+
+        # Several levels from one pass over the cells
+        level_dfs = get_cell_morphology_data(cell_morphology_ref_df, aggregation_level=["site", "well", "plate"])
+        display(level_dfs["well"])
+
+        # Large experiments, at most about 64 GB of plates in memory
+        cell_lf = get_cell_morphology_data(cell_morphology_ref_df, streaming=True, max_workers=16, memory_budget_gb=64)
+
+        # Reuse the plates processed by earlier sessions from the on-disk cache
+        aggregated_df = get_cell_morphology_data(cell_morphology_ref_df, aggregation_level='plate', use_cache=True)
+
+        # Incremental processing, only new or changed plates are aggregated
+        well_lf = get_cell_morphology_data(cell_morphology_ref_df, aggregation_level='well', save_as_dataset=True)
+        well_df = well_lf.filter(pl.col("Metadata_Barcode") == "PB000123").collect()
         ```
     """
 
@@ -521,20 +1121,54 @@ def get_cell_morphology_data(
         raise ValueError("site_threshold must be an integer between 1 and 9.")
     if not 0 < compound_threshold <= 1:
         raise ValueError("compound_threshold must be a float between 0 and 1.")
+    if max_workers < 1:
+        raise ValueError("max_workers must be a positive integer.")
+    if memory_budget_gb is not None and memory_budget_gb <= 0:
+        raise ValueError("memory_budget_gb must be a positive number.")
+
+    return_level_dict = not isinstance(aggregation_level, str)
+    aggregation_levels = (
+        list(dict.fromkeys(aggregation_level))
+        if return_level_dict
+        else [aggregation_level]
+    )
+    if not aggregation_levels or any(
+        level not in cfg.GROUPING_COLUMN_MAP for level in aggregation_levels
+    ):
+        raise ValueError(
+            f"aggregation_level must be one or more of {list(cfg.GROUPING_COLUMN_MAP)}."
+        )
 
     if isinstance(flagged_qc_df, pd.DataFrame):
         flagged_qc_df = pl.from_pandas(flagged_qc_df)
 
+    # The layout of all plates, including the flagged ones, is fetched in one query in the
+    # background, the merges below are served from memory
+    plate_barcode = cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"]
+    layout_barcodes = cell_morphology_ref_df[plate_barcode].to_list()
+    if isinstance(flagged_qc_df, pl.DataFrame):
+        layout_barcodes += (
+            flagged_qc_df[cfg.METADATA_BARCODE_COLUMN].unique().to_list()
+        )
+    plate_layout_future = submit_fetch(plate_layout_provider.fetch, layout_barcodes)
+
     if isinstance(flagged_qc_df, pl.DataFrame):
-        comp_series_to_delete, img_series_to_delete = _outlier_series_to_delete(
+        (
+            comp_series_to_delete,
+            img_series_to_delete,
+            well_series_to_delete,
+            plate_series_to_delete,
+        ) = _outlier_series_to_delete(
             flagged_qc_df,
             site_threshold=site_threshold,
             compound_threshold=compound_threshold,
         )
     else:
-        comp_series_to_delete, img_series_to_delete = pl.Series(
-            "batch_id", []
-        ), pl.Series("image_id", [])
+        comp_series_to_delete = pl.Series("batch_id", [])
+        img_series_to_delete = pl.Series(cfg.IMAGE_KEY_COLUMN_NAME, [], dtype=pl.UInt64)
+        well_series_to_delete = pl.Series(cfg.WELL_KEY_COLUMN_NAME, [], dtype=pl.UInt64)
+        plate_series_to_delete = pl.Series(cfg.METADATA_ACQID_COLUMN, [], dtype=pl.UInt64)
+    plate_layout_future.result()
 
     if aggregation_method is None:
         aggregation_method = cfg.AGGREGATION_METHOD_DICT
@@ -552,152 +1186,359 @@ def get_cell_morphology_data(
     saving_dir = Path(path_to_save)
     saving_dir.mkdir(parents=True, exist_ok=True)
 
-    # Set up progress bar for feedback
-    total_iterations = cell_morphology_ref_df.height * len(object_file_names)
-    progress_bar = tqdm(total=total_iterations, desc="Processing")
-
     # Check for typpe of aggregation function ans gpu
     if use_gpu and not has_gpu():
         raise EnvironmentError("GPU is not available on this machine.")
     aggregation_func = fa.aggregate_data_gpu if use_gpu else fa.aggregate_data_cpu
 
-    per_plate_dataframe_list = []
-
-    # Check if 'all_plates' file exists before entering the loop
-    output_filename_all_plates = f"{saving_dir}/{experiment_name}_all_plates.parquet"
-    if os.path.exists(output_filename_all_plates):
+    # Limit the plates held by the pool to what fits in the memory budget
+    if memory_budget_gb is not None:
+        plates_in_budget = _plates_in_memory_budget(
+            cell_morphology_ref_df, memory_budget_gb
+        )
+        max_workers = min(max_workers, plates_in_budget)
+        max_plates_in_flight = min(max_plates_in_flight or max_workers, plates_in_budget)
         log_info(
-            f"Combined plates file exists, reading data from: {output_filename_all_plates}"
+            f"Processing at most {max_plates_in_flight} plates at a time with {max_workers} workers to fit {memory_budget_gb} GB"
         )
-        return pl.read_parquet(output_filename_all_plates)
-    else:
-        for index, plate_metadata in enumerate(
-            cell_morphology_ref_df.iter_rows(named=True)
-        ):
-            # Print separator and progress info
-            separator = "\n" if index else ""
-            log_info(
-                (
-                    f"{separator}{'_'*50}"
-                    f"\nProcessing plate {plate_metadata[plate_acq_name]} ({index + 1} of {cell_morphology_ref_df.height}):"
+
+    # The compound level is aggregated from the plate level of every plate
+    plate_levels = {
+        level: "plate" if level == "compound" else level for level in aggregation_levels
+    }
+    processed_levels = [
+        level for level in PLATE_AGGREGATION_LEVELS if level in plate_levels.values()
+    ]
+
+    # The layout rows of each plate are merged into its output and are part of its cache key
+    plate_layouts = [
+        get_plate_layout([barcode])
+        for barcode in cell_morphology_ref_df[plate_barcode].to_list()
+    ]
+
+    # Results are reused only if the source files, the outliers, the layout and all settings match
+    cache = ResultCache(cache_dir) if use_cache else None
+    settings = {
+        "aggregation_method": aggregation_method,
+        "features": features,
+        "add_string_ids": add_string_ids,
+        "compact_dtypes": compact_dtypes,
+        "version": __version__,
+    }
+    # The keys stat the object files and hash the layout and outliers of every plate, they are
+    # only built for the cache and for the partition tags of the dataset
+    plate_cache_keys = (
+        {
+            level: [
+                _plate_cache_key(
+                    plate_metadata,
+                    img_series_to_delete,
+                    well_series_to_delete,
+                    plate_layouts[index],
+                    {**settings, "aggregation_level": level},
                 )
+                for index, plate_metadata in enumerate(
+                    cell_morphology_ref_df.iter_rows(named=True)
+                )
+            ]
+            for level in processed_levels
+        }
+        if cache is not None or save_as_dataset
+        else None
+    )
+    all_plates_cache_keys = (
+        {
+            level: make_cache_key(
+                "cell_morphology_all_plates",
+                plate_cache_keys[plate_levels[level]],
+                {**settings, "aggregation_level": level},
             )
+            for level in aggregation_levels
+        }
+        if cache is not None
+        else None
+    )
 
-            # Define and check for existing output files
-            output_filename_per_plate = f"{saving_dir}/{plate_metadata[plate_acq_id]}_{plate_metadata[plate_acq_name]}.parquet"
-            if os.path.exists(output_filename_per_plate):
+    # With several levels, the level is added to every output file name
+    level_suffixes = {
+        level: f"_{level}" if return_level_dict else ""
+        for level in [*aggregation_levels, *processed_levels]
+    }
+    output_filenames_all_plates = {
+        level: f"{saving_dir}/{experiment_name}{level_suffixes[level]}_all_plates.parquet"
+        for level in aggregation_levels
+    }
+    dataset_dir = saving_dir / f"{experiment_name}_dataset"
+
+    # Combined results are not reused in streaming mode, as they would be read into memory
+    if (
+        cache is not None
+        and not save_plate_separately
+        and not save_as_dataset
+        and not streaming
+    ):
+        cached_dfs = {
+            level: cache.get(all_plates_cache_keys[level]) for level in aggregation_levels
+        }
+        if all(df is not None for df in cached_dfs.values()):
+            for level, df in cached_dfs.items():
                 log_info(
-                    f"File already exists, reading data from: {output_filename_per_plate}"
+                    f"Combined plates found in cache, writing data to: {output_filenames_all_plates[level]}"
                 )
-                per_plate_dataframe_list.append(
-                    pl.read_parquet(output_filename_per_plate)
+                df.write_parquet(output_filenames_all_plates[level])
+                cached_dfs[level] = df.filter(
+                    ~pl.col("batch_id").is_in(comp_series_to_delete)
                 )
-                progress_bar.update(len(object_file_names))
-                continue
+            return cached_dfs if return_level_dict else cached_dfs[aggregation_level]
 
-            # Load and process feature datasets
-            object_feature_dataframes = {}
-            unusful_col_pattern = (
-                r"^(FileName|PathName|ImageNumber|Number_Object_Number)"
-            )
-            for object_file_name in object_file_names:
-                object_feature_file_path = f"{plate_metadata[cfg.DATABASE_SCHEMA['EXPERIMENT_RESULT_DIRECTORY_COLUMN']]}{object_file_name}.parquet"
-
-                # Read the parquet file and adjust column names
-                columns_names = pl.scan_parquet(object_feature_file_path).columns
-                object_feature_df = pl.read_parquet(
-                    object_feature_file_path,
-                    columns=[
-                        col
-                        for col in columns_names
-                        if not re.match(unusful_col_pattern, col)
-                    ],
-                )
+    # Set up progress bar for feedback
+    total_iterations = cell_morphology_ref_df.height * len(object_file_names)
+    progress_bar = tqdm(total=total_iterations, desc="Processing")
 
-                # Adding object type name to the end of column name
-                object_name = object_file_name.split("_")[-1]
-                object_feature_df.columns = [
-                    f"{col}_{object_name}" for col in object_feature_df.columns
-                ]
+    # In streaming mode this holds the paths of the plates written to disk instead of the plates
+    per_plate_dataframes = {
+        level: [None] * cell_morphology_ref_df.height for level in processed_levels
+    }
+    output_filenames_per_plate = [
+        {
+            level: f"{saving_dir}/{plate_metadata[plate_acq_id]}_{plate_metadata[plate_acq_name]}{level_suffixes[level]}.parquet"
+            for level in processed_levels
+        }
+        for plate_metadata in cell_morphology_ref_df.iter_rows(named=True)
+    ]
+    spill_dir = (
+        Path(tempfile.mkdtemp(prefix=f".{experiment_name}_", dir=saving_dir))
+        if streaming and not save_plate_separately and not save_as_dataset
+        else None
+    )
+    per_plate_paths = [
+        {
+            level: output_filenames_per_plate[index][level]
+            if spill_dir is None
+            else f"{spill_dir}/{index}{level_suffixes[level]}.parquet"
+            for level in processed_levels
+        }
+        for index in range(cell_morphology_ref_df.height)
+    ]
+    # Plates streamed to disk are passed around as files, they never enter this process
+    return_paths = streaming and not save_as_dataset
 
-                object_feature_dataframes[object_name] = object_feature_df
+    # Plates found in the dataset or the cache are reused, the others are queued for processing
+    plate_jobs, plate_job_indices = [], []
+    for index, plate_metadata in enumerate(cell_morphology_ref_df.iter_rows(named=True)):
+        if int(plate_metadata[plate_acq_id]) in plate_series_to_delete:
+            log_info(
+                f"Plate {plate_metadata[plate_acq_name]} only holds deleted compounds and is skipped ({index + 1} of {cell_morphology_ref_df.height})"
+            )
+            progress_bar.update(len(object_file_names))
+            continue
+
+        levels_to_process = []
+        for level in processed_levels:
+            if save_as_dataset and has_plate_partition(
+                dataset_dir,
+                level,
+                plate_metadata[plate_barcode],
+                plate_metadata[plate_acq_id],
+                partition_tag=plate_cache_keys[level][index],
+            ):
                 log_info(
-                    f"\tReading features {object_feature_df.shape} - {object_name}: \t{object_feature_file_path}"
+                    f"Plate {plate_metadata[plate_acq_name]} ({level}) is up to date in the dataset ({index + 1} of {cell_morphology_ref_df.height})"
                 )
+                continue
 
-                progress_bar.update(1)
-
-            # Join df dictionary (first cell -> nuclei and then -> cytoplasm)
-            joined_object_df = _join_object_dataframes(object_feature_dataframes)
-
-            # Remove '_cells' from metadata columns' name for better consistency and clarity
-            joined_object_df = _rename_joined_df_columns(joined_object_df)
-
-            # Create unique image_id and cell_id column by concatenating other columns
-            joined_object_df = _add_image_cell_id_columns(joined_object_df)
-
-            # Clean df from temporary, unused or unwanted columns
-            joined_object_df = _drop_unwanted_columns(joined_object_df)
-
-            # Ensure data type consistency for Metadata columns
-            joined_object_df = _cast_metadata_type_columns(joined_object_df)
+            if return_paths:
+                cached_plate_path = (
+                    cache.get_path(plate_cache_keys[level][index])
+                    if cache is not None
+                    else None
+                )
+                if cached_plate_path is None:
+                    levels_to_process.append(level)
+                    continue
 
-            # Ordering the columns
-            joined_object_df = _reorder_dataframe_columns(joined_object_df)
+                log_info(
+                    f"Plate {plate_metadata[plate_acq_name]} ({level}) found in cache ({index + 1} of {cell_morphology_ref_df.height})"
+                )
+                shutil.copyfile(cached_plate_path, per_plate_paths[index][level])
+                per_plate_dataframes[level][index] = per_plate_paths[index][level]
+                continue
 
-            # List of morphology columns
-            morphology_feature_cols = _get_morphology_feature_cols(joined_object_df)
+            cached_plate_df = (
+                cache.get(plate_cache_keys[level][index]) if cache is not None else None
+            )
+            if cached_plate_df is None:
+                levels_to_process.append(level)
+                continue
 
-            # Adding plate layout data to df
-            aggregated_data = _merge_with_plate_info(joined_object_df).filter(
-                ~pl.col("image_id").is_in(img_series_to_delete)
+            log_info(
+                f"Plate {plate_metadata[plate_acq_name]} ({level}) found in cache ({index + 1} of {cell_morphology_ref_df.height})"
             )
+            if save_plate_separately or spill_dir is not None:
+                cached_plate_df.write_parquet(per_plate_paths[index][level])
+            if save_as_dataset:
+                upsert_plate_partitions(
+                    cached_plate_df,
+                    dataset_dir,
+                    level,
+                    partition_tag=plate_cache_keys[level][index],
+                )
+            else:
+                per_plate_dataframes[level][index] = cached_plate_df
+
+        if not levels_to_process:
+            progress_bar.update(len(object_file_names))
+            continue
+
+        plate_jobs.append(
+            {
+                "plate_metadata": plate_metadata,
+                "img_series_to_delete": img_series_to_delete,
+                "well_series_to_delete": well_series_to_delete,
+                "aggregation_level": levels_to_process,
+                "aggregation_method": aggregation_method,
+                "df_plates": plate_layouts[index],
+                "features": features,
+                "add_string_ids": add_string_ids,
+                "compact_dtypes": compact_dtypes,
+                "use_gpu": use_gpu,
+                "output_filename_per_plate": per_plate_paths[index]
+                if save_plate_separately or spill_dir is not None
+                else None,
+                "return_paths": return_paths,
+            }
+        )
+        plate_job_indices.append(index)
+
+    for job_number, (index, aggregated_levels) in enumerate(
+        zip(
+            plate_job_indices,
+            _iterate_processed_plates(
+                plate_jobs,
+                max_workers=max_workers,
+                max_plates_in_flight=max_plates_in_flight,
+            ),
+        )
+    ):
+        plate_metadata = plate_jobs[job_number]["plate_metadata"]
+        log_info(
+            (
+                f"{'_'*50}"
+                f"\nProcessed plate {plate_metadata[plate_acq_name]} ({index + 1} of {cell_morphology_ref_df.height})"
+            )
+        )
+        for level, aggregated_data in aggregated_levels.items():
+            if cache is not None and return_paths:
+                cache.put_file(
+                    plate_cache_keys[level][index],
+                    aggregated_data,
+                    namespace="cell_morphology_plate",
+                )
+            elif cache is not None:
+                cache.put(
+                    plate_cache_keys[level][index],
+                    aggregated_data,
+                    namespace="cell_morphology_plate",
+                )
+            if save_as_dataset:
+                # Plates are written as they finish, so they are not held in memory
+                upsert_plate_partitions(
+                    aggregated_data,
+                    dataset_dir,
+                    level,
+                    partition_tag=plate_cache_keys[level][index],
+                )
+            else:
+                # In streaming mode the plate was written to disk by `_process_plate`, which only returned its path
+                per_plate_dataframes[level][index] = aggregated_data
+        progress_bar.update(len(object_file_names))
 
-            # Mapping of aggregation levels to their grouping columns
-            grouping_columns_map = cfg.GROUPING_COLUMN_MAP
+    progress_bar.close()
 
-            for level in ["cell", "site", "well", "plate"]:
-                aggregated_data = aggregation_func(
-                    df=aggregated_data,
-                    columns_to_aggregate=morphology_feature_cols,
-                    groupby_columns=grouping_columns_map[level],
-                    aggregation_function=aggregation_method[level],
-                )
-                if aggregation_level == level:
-                    break
+    results = {}
+    # Categories of all levels share one string cache so the levels can be joined
+    with pl.StringCache():
+        for level in aggregation_levels:
+            plate_level = plate_levels[level]
+            if save_as_dataset:
+                log_info(f"Reading dataset: {dataset_dir}")
+                try:
+                    dataset_lf = scan_morphology_dataset(
+                        dataset_dir,
+                        plate_level,
+                        acq_ids=cell_morphology_ref_df[plate_acq_id].to_list(),
+                    )
+                except FileNotFoundError:
+                    # Plates skipped by the quality control have no partition
+                    log_warning("All plates were removed by the quality control.")
+                    results[level] = pl.LazyFrame()
+                    continue
+                level_df = _finalize_aggregated_columns(dataset_lf, plate_level)
+            else:
+                # Skipped plates have no result
+                plate_results = [
+                    plate_result
+                    for plate_result in per_plate_dataframes[plate_level]
+                    if plate_result is not None
+                ]
+                if not plate_results:
+                    log_warning("All plates were removed by the quality control.")
+                    results[level] = pl.LazyFrame() if streaming else pl.DataFrame()
+                    continue
+                if streaming:
+                    level_df = pl.scan_parquet(plate_results)
+                else:
+                    level_df = (
+                        pl.concat(plate_results)
+                        if len(plate_results) > 1
+                        else plate_results[0]
+                    )
+
+            if compact_dtypes:
+                level_df = categorical_metadata_columns(level_df)
 
-            # Write the aggregated data to a parquet file
             if save_plate_separately:
-                aggregated_data.write_parquet(output_filename_per_plate)
-            per_plate_dataframe_list.append(aggregated_data)
-
-        if not save_plate_separately:
-            concatenated_dfs = (
-                pl.concat(per_plate_dataframe_list)
-                if len(per_plate_dataframe_list) > 1
-                else per_plate_dataframe_list[0]
-            )
-            if aggregation_level == "compound":
-                concatenated_dfs = aggregation_func(
-                    df=concatenated_dfs,
-                    columns_to_aggregate=morphology_feature_cols,
-                    groupby_columns=grouping_columns_map[aggregation_level],
-                    aggregation_function=aggregation_method[aggregation_level],
+                results[level] = level_df.filter(
+                    ~pl.col("batch_id").is_in(comp_series_to_delete)
+                )
+                continue
+
+            if level == "compound":
+                # The features are taken from the schema, as cached plates carry no feature list
+                level_df = aggregation_func(
+                    df=level_df,
+                    columns_to_aggregate=_get_morphology_feature_cols(
+                        level_df.select(pl.exclude(cfg.PLATE_LAYOUT_INFO))
+                    ),
+                    groupby_columns=cfg.GROUPING_COLUMN_MAP[level],
+                    aggregation_function=aggregation_method[level],
                 )
-            concatenated_dfs.write_parquet(output_filename_all_plates)
-            progress_bar.close()
-            return concatenated_dfs.filter(
+                if save_as_dataset or streaming:
+                    level_df = level_df.lazy()
+
+            if streaming and not save_as_dataset:
+                log_info(f"Streaming data to: {output_filenames_all_plates[level]}")
+                if level == "compound":
+                    # Not every aggregation can be sunk, the compound level is small once collected
+                    level_df.collect(streaming=True).write_parquet(
+                        output_filenames_all_plates[level]
+                    )
+                else:
+                    level_df.sink_parquet(output_filenames_all_plates[level])
+                level_df = pl.scan_parquet(output_filenames_all_plates[level])
+            elif not save_as_dataset:
+                level_df.write_parquet(output_filenames_all_plates[level])
+                if cache is not None:
+                    cache.put(
+                        all_plates_cache_keys[level],
+                        level_df,
+                        namespace="cell_morphology_all_plates",
+                    )
+            results[level] = level_df.filter(
                 ~pl.col("batch_id").is_in(comp_series_to_delete)
             )
 
-    progress_bar.close()
+    if spill_dir is not None:
+        shutil.rmtree(spill_dir)
 
-    return (
-        pl.concat(per_plate_dataframe_list).filter(
-            ~pl.col("batch_id").is_in(comp_series_to_delete)
-        )
-        if len(per_plate_dataframe_list) > 1
-        else per_plate_dataframe_list[0].filter(
-            ~pl.col("batch_id").is_in(comp_series_to_delete)
-        )
-    )
+    return results if return_level_dict else results[aggregation_level]
@@ -1,5 +1,8 @@
 import polars as pl
-from ..config import DB_URI, DATABASE_SCHEMA
+from ..config import DATABASE_SCHEMA
+from ..database.connection import read_database
+from ..database.fetch import submit_fetch
+from ..database.plate_layout import plate_layout_provider
 from ..database.queries import experiment_name_sql_query
 import json
 from .image_quality import get_image_quality_ref, get_image_quality_data
@@ -8,6 +11,7 @@ from ..data_processing.quality_control import (
     get_qc_data_dict,
     flag_outlier_images,
 )
+from ..data_processing.qc_model import QCModel
 from .cell_morphology import (
     get_cell_morphology_ref,
     get_cell_morphology_data,
@@ -17,6 +21,9 @@ from .cell_morphology import (
 from ..visualization import plots
 from typing import Union, Literal, Tuple, Set, List, Dict
 from ..config import COLORS
+from ..logger import (
+    log_warning,
+)
 
 
 def get_projects_list(lookup: str = None):
@@ -45,7 +52,7 @@ def get_projects_list(lookup: str = None):
         DATABASE_SCHEMA["EXPERIMENT_NAME_COLUMN"],
         DATABASE_SCHEMA["EXPERIMENT_METADATA_TABLE_NAME_ON_DB"],
     )
-    project_list = pl.read_database(query, DB_URI).to_dict(as_series=False)[
+    project_list = read_database(query).to_dict(as_series=False)[
         DATABASE_SCHEMA["EXPERIMENT_NAME_COLUMN"]
     ]
 
@@ -56,6 +63,26 @@ def get_projects_list(lookup: str = None):
     return project_list
 
 
+def _parse_bool_setting(name: str, value: Union[bool, str]) -> bool:
+    """Parses a boolean setting of the experiment file, a JSON boolean or "True"/"False".
+
+    Parameters:
+        name (str): The name of the setting, for the error message.
+        value (Union[bool, str]): The value of the setting.
+
+    Returns:
+        bool: The parsed value.
+
+    Raises:
+        ValueError: If the value is neither a boolean nor "true" or "false" in any case.
+    """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ["true", "false"]:
+        return value.strip().lower() == "true"
+    raise ValueError(f"{name} must be true or false, got {value!r}")
+
+
 class Experiment:
     """
     Represents an experiment with various data and functionality.
@@ -75,12 +102,38 @@ class Experiment:
         with open(json_file, "r") as file:
             data = json.load(file)
             self.__dict__.update(data)
-        self.image_quality_data = self.get_image_quality_data()
+        if self.__dict__.get("qc_model_path", None):
+            # Fail before the data is read rather than when the model is fitted
+            self._check_qc_model_settings()
+
+        # The references are independent queries, they are fetched concurrently
+        image_quality_ref_future = submit_fetch(self.get_image_quality_reference_data)
+        cell_morphology_ref_future = submit_fetch(
+            self.get_cell_morphology_reference_data
+        )
+        image_quality_ref_df = image_quality_ref_future.result()
+        cell_morphology_ref_df = cell_morphology_ref_future.result()
+
+        # The layout of all plates is fetched once in the background while the image quality
+        # files are read, every later merge is served from memory
+        plate_barcode = DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"]
+        plate_layout_future = submit_fetch(
+            plate_layout_provider.fetch,
+            image_quality_ref_df[plate_barcode].to_list()
+            + cell_morphology_ref_df[plate_barcode].to_list(),
+        )
+
+        self.image_quality_data = self.get_image_quality_data(image_quality_ref_df)
+        plate_layout_future.result()
         self.flagged_image_quality_data = self.flag_outlier_images()
-        self.cell_morphology_data = self.get_cell_morphology_data()
+        self.cell_morphology_data = self.get_cell_morphology_data(
+            cell_morphology_ref_df
+        )
         self.compound_batch_ids = (
-            self.cell_morphology_data.select("batch_id")
+            self.cell_morphology_data.lazy()
+            .select("batch_id")
             .unique("batch_id")
+            .collect()
             .to_series()
             .to_list()
         )
@@ -100,9 +153,11 @@ class Experiment:
             filter=self.__dict__.get("filter", None),
         )
 
-    def get_image_quality_data(self):
+    def get_image_quality_data(self, image_quality_ref_df: pl.DataFrame = None):
+        if image_quality_ref_df is None:
+            image_quality_ref_df = self.get_image_quality_reference_data()
         return get_image_quality_data(
-            self.get_image_quality_reference_data(),
+            image_quality_ref_df,
             force_merging_columns=self.__dict__.get("force_merging_columns", False),
         )
 
@@ -112,17 +167,29 @@ class Experiment:
             filter=self.__dict__.get("filter_cp", None),
         )
 
-    def get_cell_morphology_data(self):
+    def get_cell_morphology_data(self, cell_morphology_ref_df: pl.DataFrame = None):
+        if cell_morphology_ref_df is None:
+            cell_morphology_ref_df = self.get_cell_morphology_reference_data()
         return get_cell_morphology_data(
-            cell_morphology_ref_df=self.get_cell_morphology_reference_data(),
+            cell_morphology_ref_df=cell_morphology_ref_df,
             flagged_qc_df=self.flagged_image_quality_data,
             site_threshold=self.__dict__.get("site_threshold", 6),
             compound_threshold=self.__dict__.get("compound_threshold", 0.7),
             aggregation_level=self.__dict__.get("aggregation_level", "cell"),
             aggregation_method=self.__dict__.get("aggregation_method", None),
+            features=self.__dict__.get("features", None),
+            add_string_ids=self.__dict__.get("add_string_ids", False),
+            compact_dtypes=self.__dict__.get("compact_dtypes", False),
             path_to_save=self.__dict__.get("path_to_save", "data"),
             use_gpu=self.__dict__.get("use_gpu", False),
             save_plate_separately=self.__dict__.get("save_plate_separately", False),
+            save_as_dataset=self.__dict__.get("save_as_dataset", False),
+            max_workers=self.__dict__.get("max_workers", 1),
+            max_plates_in_flight=self.__dict__.get("max_plates_in_flight", None),
+            streaming=self.__dict__.get("streaming", False),
+            memory_budget_gb=self.__dict__.get("memory_budget_gb", None),
+            use_cache=self.__dict__.get("use_cache", False),
+            cache_dir=self.__dict__.get("cache_dir", None),
         )
 
     def get_image_guality_modules(self):
@@ -136,21 +203,99 @@ class Experiment:
         )
 
     def flag_outlier_images(self):
+        if self.__dict__.get("qc_model_path", None):
+            return self.apply_qc_model()
         return flag_outlier_images(
             qc_data=self.image_quality_data,
             module_to_keep=self.__dict__.get("module_to_keep", None),
             module_to_drop=self.__dict__.get("module_to_drop", None),
             method=self.__dict__.get("method", "SD"),
-            IQR_normalization=eval(self.__dict__.get("IQR_normalization", "True")),
+            IQR_normalization=_parse_bool_setting(
+                "IQR_normalization", self.__dict__.get("IQR_normalization", True)
+            ),
             normalization=self.__dict__.get("normalization", "zscore"),
+            normalize_by=self.__dict__.get("normalize_by", None),
             sd_step_dict=self.__dict__.get("sd_step_dict", None),
             default_sd_step=tuple(self.__dict__.get("default_sd_step"))
             if self.__dict__.get("default_sd_step", None)
             else (-4.5, 4.5),
             quantile_limit=self.__dict__.get("quantile_limit", 0.25),
             multiplier=self.__dict__.get("quantile_limit", 1.5),
+            outlier_threshold=self.__dict__.get("outlier_threshold", None),
+            # max_workers sets the processes of the cell morphology, the QC threads are separate
+            max_workers=self.__dict__.get("qc_max_workers", None),
         )
 
+    def apply_qc_model(self):
+        """
+        Flags the outlier images with the persisted QC model of `qc_model_path`.
+
+        The model is fitted on the image quality data and saved if the file does not exist yet,
+        so later runs flag new plates with the same thresholds. With `update_qc_model` set, the
+        statistics of the model are updated with the current data after flagging and saved.
+
+        The model only supports the "SD" and "IQR" methods and the "zscore" and "minmax"
+        normalizations, and normalizes over all images it was fitted on, so `normalize_by` is
+        ignored with a warning. Once the model file exists, its own settings are used.
+
+        Returns:
+            pl.DataFrame: The flagged image quality data.
+
+        Raises:
+            ValueError: If `method` or `normalization` is not supported by `QCModel`.
+        """
+        self._check_qc_model_settings()
+        if self.__dict__.get("normalize_by", None) is not None:
+            log_warning(
+                "normalize_by is ignored with qc_model_path, the QC model normalizes over all images it was fitted on."
+            )
+        qc_model_path = self.__dict__["qc_model_path"]
+        try:
+            qc_model = QCModel.load(qc_model_path)
+        except FileNotFoundError:
+            qc_model = QCModel(
+                module_to_keep=self.__dict__.get("module_to_keep", None),
+                module_to_drop=self.__dict__.get("module_to_drop", None),
+                method=self.__dict__.get("method", "SD"),
+                IQR_normalization=_parse_bool_setting(
+                    "IQR_normalization", self.__dict__.get("IQR_normalization", True)
+                ),
+                normalization=self.__dict__.get("normalization", "zscore"),
+                sd_step_dict=self.__dict__.get("sd_step_dict", None),
+                default_sd_step=tuple(self.__dict__.get("default_sd_step"))
+                if self.__dict__.get("default_sd_step", None)
+                else (-4.5, 4.5),
+                quantile_limit=self.__dict__.get("quantile_limit", 0.25),
+                multiplier=self.__dict__.get("multiplier", 1.5),
+            ).fit(self.image_quality_data)
+            qc_model.save(qc_model_path)
+            return qc_model.apply(self.image_quality_data)
+
+        flagged_qc_data = qc_model.apply(self.image_quality_data)
+        if self.__dict__.get("update_qc_model", False):
+            qc_model.update(self.image_quality_data).save(qc_model_path)
+        return flagged_qc_data
+
+    def _check_qc_model_settings(self):
+        """Checks that the flagging settings can be used with `qc_model_path`.
+
+        Raises:
+            ValueError: If `method` or `normalization` is not supported by `QCModel`, or if `IQR_normalization` is not a boolean.
+        """
+        method = self.__dict__.get("method", "SD")
+        if method not in ["SD", "IQR"]:
+            raise ValueError(
+                f"qc_model_path only supports the 'SD' and 'IQR' methods, got method '{method}'. "
+                "Remove qc_model_path to flag the images with this method."
+            )
+        normalization = self.__dict__.get("normalization", "zscore")
+        if normalization not in ["zscore", "minmax"]:
+            raise ValueError(
+                f"qc_model_path only supports the 'zscore' and 'minmax' normalizations, got normalization '{normalization}'. "
+                "Remove qc_model_path to flag the images with this normalization."
+            )
+        _parse_bool_setting("IQR_normalization", self.__dict__.get("IQR_normalization", True))
+
     def plate_heatmap(
         self,
         plate_names: List[str] = None,
@@ -177,7 +322,8 @@ class Experiment:
         title: str = "Unnamed",
         plot_size: int = 1400,
         normalization: bool = True,
-        normalization_method: Literal["zscore", "minmax"] = "zscore",
+        normalization_method: Literal["zscore", "minmax", "robust"] = "zscore",
+        normalize_by: Union[str, List[str]] = None,
         y_axis_range: Tuple = (-5, 5),
         colors: List[str] = COLORS,
     ):
@@ -188,6 +334,7 @@ class Experiment:
             plot_size=plot_size,
             normalization=normalization,
             normalization_method=normalization_method,
+            normalize_by=normalize_by,
             y_axis_range=y_axis_range,
             colors=colors,
         )
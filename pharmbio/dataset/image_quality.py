@@ -1,7 +1,8 @@
 import os
 import glob
 import polars as pl
-from typing import Union, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Optional, List, Dict, Tuple
 from .. import config as cfg
 from ..config import DATABASE_SCHEMA
 
@@ -10,6 +11,7 @@ from ..logger import (
     log_warning,
 )
 
+from ..database.connection import read_database
 from ..database.queries import (
     experiment_metadata_sql_query,
 )
@@ -17,10 +19,17 @@ from ..database.queries import (
 from ..utils import (
     get_file_extension,
     read_file,
+    read_file_schema,
 )
 
 
-def _get_image_quality_refrence_df(experiment_name: str):
+def _get_image_quality_refrence_df(
+    experiment_name: str,
+    filter: Optional[Dict] = None,
+    columns: Optional[List[str]] = None,
+    limit: Optional[int] = None,
+    latest_analysis_per_plate: bool = False,
+):
     """
     Gets an image quality reference dataframe and associated data dictionary from the database for a given experiment name.
 
@@ -28,6 +37,10 @@ def _get_image_quality_refrence_df(experiment_name: str):
 
     Args:
     experiment_name: The name of the experiment to retrieve data for
+    filter: Conditions on the rows, applied by the database (see `reference_filter_clause`)
+    columns: Additional columns to select besides the experiment columns of the schema
+    limit: The maximum number of rows
+    latest_analysis_per_plate: Whether to keep only the latest analysis of each plate, before the filter is applied
 
     Returns:
     image_quality_reference_df: A dataframe containing image quality metadata
@@ -35,9 +48,15 @@ def _get_image_quality_refrence_df(experiment_name: str):
     """
 
     query = experiment_metadata_sql_query(
-        experiment_name, DATABASE_SCHEMA, cfg.IMAHGE_QUALITY_METADATA_TYPE
+        experiment_name,
+        DATABASE_SCHEMA,
+        cfg.IMAHGE_QUALITY_METADATA_TYPE,
+        filter=filter,
+        columns=columns,
+        limit=limit,
+        latest_analysis_per_plate=latest_analysis_per_plate,
     )
-    image_quality_reference_df = pl.read_database(query, cfg.DB_URI)
+    image_quality_reference_df = read_database(query)
     data_dict = (
         image_quality_reference_df.select(
             [
@@ -114,6 +133,8 @@ def get_image_quality_ref(
     drop_replication: Union[str, List[int]] = "Auto",
     keep_replication: Union[str, List[int]] = "None",
     filter: dict = None,
+    columns: Optional[List[str]] = None,
+    limit: Optional[int] = None,
 ):
     """
     Retrieves the image quality reference data from the database based on the provided name and optional filters.
@@ -122,7 +143,9 @@ def get_image_quality_ref(
         name (str): The name of experiment for the image quality reference.
         drop_replication (Union[str, List[int]], optional): The replication(s) to drop. Default is set to "Auto" which keep the experiment with highest id number (latest experiment). It can be "None" or a list of analysis_id.
         keep_replication (Union[str, List[int]], optional): The replication(s) to keep. Defaults to "None".
-        filter (dict, optional): Filters to apply to the data. Defaults to None.
+        filter (dict, optional): Filters to apply to the data, applied by the database after the replications are handled. Each key is a column name and the value a list of regular expressions, or a dictionary of operators ("regex", "in", "ilike", "like", "eq") and values. Defaults to None.
+        columns (List[str], optional): Additional columns to select besides the experiment columns of the schema. Defaults to None (all columns).
+        limit (int, optional): The maximum number of rows fetched from the database. Defaults to None (all rows).
 
     Returns:
         polars.DataFrame: The image quality reference data.
@@ -138,7 +161,16 @@ def get_image_quality_ref(
         ```
     """
 
-    image_quality_reference, data_dict = _get_image_quality_refrence_df(name)
+    auto_replication = drop_replication == "Auto" and keep_replication == "None"
+    # The latest analyses are selected by the database before the filter, the filter must not
+    # bring back an older analysis of a plate whose latest one does not match
+    image_quality_reference, data_dict = _get_image_quality_refrence_df(
+        name,
+        filter=filter,
+        columns=columns,
+        limit=limit,
+        latest_analysis_per_plate=auto_replication and filter is not None,
+    )
     unique_project_count = image_quality_reference.unique(
         DATABASE_SCHEMA["EXPERIMENT_NAME_COLUMN"]
     ).height
@@ -147,7 +179,7 @@ def get_image_quality_ref(
         image_quality_reference, data_dict, name, unique_project_count
     )
 
-    if drop_replication == "Auto" and keep_replication == "None":
+    if auto_replication:
         # keeping the highest analysis_id value of replicated rows
         image_quality_reference = (
             image_quality_reference.sort(
@@ -171,35 +203,73 @@ def get_image_quality_ref(
             )
         )
 
-    if filter is None:
-        return image_quality_reference
-
-    conditions = []
-    for key, values in filter.items():
-        # Create an OR condition for each value associated with a key
-        key_conditions = [pl.col(key).str.contains(val) for val in values]
-        combined_key_condition = key_conditions[0]
-        for condition in key_conditions[1:]:
-            combined_key_condition = combined_key_condition | condition
-        conditions.append(combined_key_condition)
-    # Combine all conditions with AND
-    final_condition = conditions[0]
-    for condition in conditions[1:]:
-        final_condition = final_condition & condition
-    # Apply the condition to the DataFrame
-    return image_quality_reference.filter(final_condition)
+    return image_quality_reference
+
+
+def _locate_image_quality_file(
+    result_directory: str, plate_barcode: str
+) -> Optional[Tuple[str, str, Dict[str, pl.DataType]]]:
+    """Finds the image quality file of a plate and reads its schema.
+
+    Parameters:
+        result_directory (str): The result directory of the analysis.
+        plate_barcode (str): The plate barcode.
+
+    Returns:
+        Optional[Tuple[str, str, Dict[str, pl.DataType]]]: The file path without extension, the extension and the schema, or None if no file was found.
+    """
+    file_path_name_schemes = [
+        # Original naming scheme (file path + file prefix + plate barcode)
+        result_directory + cfg.IMAGE_QUALITY_FILE_PREFIX + "_" + plate_barcode,
+        # Alternative naming scheme without plate barcode (file path + file prefix)
+        result_directory + cfg.IMAGE_QUALITY_FILE_PREFIX,
+    ]
+    for file_path_name_scheme in file_path_name_schemes:
+        if ext := get_file_extension(file_path_name_scheme):
+            return (
+                file_path_name_scheme,
+                ext,
+                read_file_schema(file_path_name_scheme, ext),
+            )
+    log_warning(f"No image quality file was found in: {file_path_name_schemes}")
+    return None
+
+
+def _read_image_quality_file(
+    image_quality_data_file: str, ext: str, columns: Optional[List[str]]
+) -> pl.DataFrame:
+    """Reads the selected columns of an image quality file.
+
+    Parameters:
+        image_quality_data_file (str): The file path without extension.
+        ext (str): The extension of the file.
+        columns (Optional[List[str]]): The columns to read, None for all columns.
+
+    Returns:
+        pl.DataFrame: The image quality data of the plate.
+    """
+    # Cast all numerical f64 columns to f32 and i64 columns to i32 while reading
+    df = read_file(image_quality_data_file, ext, columns=columns, compact_dtypes=True)
+    log_info(f"Successfully imported {df.shape}: {image_quality_data_file}{ext}")
+    return df
 
 
 def get_image_quality_data(
     filtered_image_quality_info: pl.DataFrame,
     force_merging_columns: Union[bool, str] = False,
+    max_workers: Optional[int] = None,
 ):
     """
     Retrieves and processes image quality data based on the provided filtered image quality information.
 
+    The plate files are located and their schemas read (parquet footers, CSV headers) in a
+    thread pool first, so the columns to keep are known before any data is decoded. The files
+    are then read concurrently, each one only with the kept columns.
+
     Args:
         filtered_image_quality_info (polars.DataFrame): The filtered image quality information.
         force_merging_columns (Union[bool, str], optional): Specifies how to handle merging columns. Defaults to False. 'keep' will keep all columns and fill missing values with null, 'drop' will merge dfs horizontally, only keeps matching columns, False will return None.
+        max_workers (int, optional): The number of files read concurrently. Defaults to None (`config.IMAGE_QUALITY_READ_MAX_WORKERS`).
 
     Returns:
         polars.DataFrame: The concatenated and processed image quality data.
@@ -212,57 +282,58 @@ def get_image_quality_data(
         result = get_image_quality_data(filtered_image_quality_ref, force_merging_columns)
         ```
     """
+    plate_files = filtered_image_quality_info.select(
+        DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"],
+        DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"],
+    )
 
-    # Read and process all the files in a list, skipping files not found
-    dfs = []
-    for row in filtered_image_quality_info.iter_rows(named=True):
-        file_path_name_schemes = [
-            # Original naming scheme (file path + file prefix + plate barcode)
-            row[DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]]
-            + cfg.IMAGE_QUALITY_FILE_PREFIX
-            + "_"
-            + row[DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"]],
-            # Alternative naming scheme without plate barcode (file path + file prefix)
-            row[DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]]
-            + cfg.IMAGE_QUALITY_FILE_PREFIX,
+    # Parquet and CSV decoding release the GIL, the files are read in threads
+    with ThreadPoolExecutor(
+        max_workers=max_workers or cfg.IMAGE_QUALITY_READ_MAX_WORKERS,
+        thread_name_prefix="pharmbio-image-quality",
+    ) as executor:
+        # Locate the files and read their schemas, skipping files not found
+        located_files = [
+            located_file
+            for located_file in executor.map(
+                _locate_image_quality_file,
+                plate_files.to_series(0).to_list(),
+                plate_files.to_series(1).to_list(),
+            )
+            if located_file is not None
         ]
-
-        for file_path_name_scheme in file_path_name_schemes:
-            if ext := get_file_extension(file_path_name_scheme):
-                image_quality_data_file = file_path_name_scheme
-                df = read_file(image_quality_data_file, ext)
-                # Cast all numerical f64 columns to f32
-                for name, dtype in zip(df.columns, df.dtypes):
-                    if dtype == pl.Float64:
-                        df = df.with_columns(pl.col(name).cast(pl.Float32))
-                    elif dtype == pl.Int64:
-                        df = df.with_columns(pl.col(name).cast(pl.Int32))
-                dfs.append(df)
-                log_info(
-                    f"Successfully imported {df.shape}: {image_quality_data_file}{ext}"
-                )
-                break
+        schemas = [schema for _, _, schema in located_files]
+
+        columns = None
+        if force_merging_columns == "keep":
+            concat_method = "diagonal"  # keep all columns and fill missing values with null
+        elif force_merging_columns == "drop":
+            concat_method = (
+                "vertical"  # merge dfs horizontally, only keeps matching columns
+            )
+            common_columns = set(schemas[0]) if schemas else set()
+            for schema in schemas[1:]:
+                common_columns.intersection_update(schema)
+            columns = sorted(common_columns)
         else:
-            log_warning(f"No image quality file was found in: {file_path_name_schemes}")
-
-    if force_merging_columns == "keep":
-        concat_method = "diagonal"  # keep all columns and fill missing values with null
-    elif force_merging_columns == "drop":
-        concat_method = (
-            "vertical"  # merge dfs horizontally, only keeps matching columns
-        )
-        common_columns = set(dfs[0].columns)
-        for df in dfs[1:]:
-            common_columns.intersection_update(df.columns)
-        dfs = [df.select(sorted(common_columns)) for df in dfs]
-    else:
-        # Check if all dataframes have the same shape, if not print a message
-        if len({df.shape[1] for df in dfs}) > 1:
-            log_warning(
-                "\nDataframes have different shapes and cannot be stacked together!"
+            # Check if all files have the same columns, if not print a message
+            if len({frozenset(schema) for schema in schemas}) > 1:
+                log_warning(
+                    "\nDataframes have different shapes and cannot be stacked together!"
+                )
+                return None
+            concat_method = "vertical"  # standard vertical concatenation
+            # Files with the same columns in another order are stacked in the order of the first one
+            columns = list(schemas[0]) if schemas else None
+
+        dfs = list(
+            executor.map(
+                _read_image_quality_file,
+                [image_quality_data_file for image_quality_data_file, _, _ in located_files],
+                [ext for _, ext, _ in located_files],
+                [columns] * len(located_files),
             )
-            return None
-        concat_method = "vertical"  # standard vertical concatenation
+        )
 
     log_info(f"\n{'_'*50}\nQuality control data of {len(dfs)} plates imported!\n")
 
@@ -0,0 +1,201 @@
+import os
+import polars as pl
+from pathlib import Path
+from typing import Union, Optional, List, Dict
+from .. import config as cfg
+from ..logger import (
+    log_info,
+)
+
+# Hive-style partition columns, from the outermost to the innermost directory
+AGGREGATION_LEVEL_PARTITION = "aggregation_level"
+PLATE_PARTITION_COLUMNS = [
+    cfg.METADATA_BARCODE_COLUMN,
+    cfg.METADATA_ACQID_COLUMN,
+]
+
+
+def get_partition_dir(
+    dataset_dir: Union[str, Path],
+    aggregation_level: str,
+    barcode: str,
+    acq_id: Union[str, int],
+) -> Path:
+    """
+    Returns the directory of a plate partition in a morphology dataset.
+
+    Args:
+        dataset_dir (Union[str, Path]): The root directory of the dataset.
+        aggregation_level (str): The aggregation level of the data.
+        barcode (str): The plate barcode.
+        acq_id (Union[str, int]): The plate acquisition ID.
+
+    Returns:
+        Path: The partition directory, e.g. `dataset/aggregation_level=well/Metadata_Barcode=PB1/Metadata_AcqID=3001`.
+    """
+    return (
+        Path(dataset_dir)
+        / f"{AGGREGATION_LEVEL_PARTITION}={aggregation_level}"
+        / f"{cfg.METADATA_BARCODE_COLUMN}={barcode}"
+        / f"{cfg.METADATA_ACQID_COLUMN}={acq_id}"
+    )
+
+
+def has_plate_partition(
+    dataset_dir: Union[str, Path],
+    aggregation_level: str,
+    barcode: str,
+    acq_id: Union[str, int],
+    partition_tag: Optional[str] = None,
+) -> bool:
+    """
+    Checks if a plate partition exists, optionally written with a specific tag.
+
+    Args:
+        dataset_dir (Union[str, Path]): The root directory of the dataset.
+        aggregation_level (str): The aggregation level of the data.
+        barcode (str): The plate barcode.
+        acq_id (Union[str, int]): The plate acquisition ID.
+        partition_tag (str, optional): The tag the partition was written with (see `upsert_plate_partitions`). Defaults to None which accepts any tag.
+
+    Returns:
+        bool: True if the partition exists.
+    """
+    partition_dir = get_partition_dir(dataset_dir, aggregation_level, barcode, acq_id)
+    if partition_tag is not None:
+        return (partition_dir / f"part-{partition_tag}.parquet").exists()
+    return partition_dir.is_dir() and any(partition_dir.glob("*.parquet"))
+
+
+def upsert_plate_partitions(
+    df: pl.DataFrame,
+    dataset_dir: Union[str, Path],
+    aggregation_level: str,
+    partition_tag: str = "0",
+) -> List[Path]:
+    """
+    Writes the plates in the dataframe to a Hive-partitioned parquet dataset, replacing the existing partitions of these plates.
+
+    The dataset is partitioned by aggregation level, barcode and acquisition ID. The partition
+    columns are encoded in the directory names and are not stored in the files. Partitions of
+    other plates are not touched, so new plates can be appended without rewriting the dataset.
+
+    Args:
+        df (pl.DataFrame): Aggregated morphology data of one or more plates.
+        dataset_dir (Union[str, Path]): The root directory of the dataset.
+        aggregation_level (str): The aggregation level of the data.
+        partition_tag (str, optional): A tag in the file name, e.g. the cache key of the plate, so that `has_plate_partition` can check if a partition is up to date. Defaults to "0".
+
+    Returns:
+        List[Path]: The written files.
+
+    Example:
+        ```python
+        upsert_plate_partitions(new_plate_df, "data/my_experiment_dataset", aggregation_level="well")
+        df = scan_morphology_dataset("data/my_experiment_dataset", aggregation_level="well").collect()
+        ```
+    """
+    written_files = []
+    for plate_df in df.partition_by(PLATE_PARTITION_COLUMNS, maintain_order=True):
+        barcode, acq_id = plate_df.select(PLATE_PARTITION_COLUMNS).row(0)
+        partition_dir = get_partition_dir(
+            dataset_dir, aggregation_level, barcode, acq_id
+        )
+        partition_dir.mkdir(parents=True, exist_ok=True)
+
+        # Write next to the old files first, so readers never see an empty partition
+        file_path = partition_dir / f"part-{partition_tag}.parquet"
+        temporary_path = partition_dir / f".part-{partition_tag}.{os.getpid()}.tmp"
+        plate_df.drop(PLATE_PARTITION_COLUMNS).write_parquet(temporary_path)
+        for old_file in partition_dir.glob("*.parquet"):
+            if old_file != file_path:
+                old_file.unlink()
+        os.replace(temporary_path, file_path)
+
+        written_files.append(file_path)
+        log_info(f"\tWrote partition {plate_df.shape}: {file_path}")
+    return written_files
+
+
+def _parse_partition_path(file_path: Path, dataset_dir: Path) -> Dict[str, str]:
+    parts = file_path.parent.relative_to(dataset_dir).parts
+    return dict(part.split("=", 1) for part in parts if "=" in part)
+
+
+def scan_morphology_dataset(
+    dataset_dir: Union[str, Path],
+    aggregation_level: Optional[str] = None,
+    barcodes: Optional[List[str]] = None,
+    acq_ids: Optional[List[Union[str, int]]] = None,
+) -> pl.LazyFrame:
+    """
+    Lazily scans a morphology dataset written by `upsert_plate_partitions`.
+
+    Partitions that do not match the requested aggregation level, barcodes or acquisition IDs
+    are pruned from the directory listing, so their files are never opened.
+
+    Args:
+        dataset_dir (Union[str, Path]): The root directory of the dataset.
+        aggregation_level (str, optional): The aggregation level to read. Defaults to None, which is only allowed if the dataset holds a single level.
+        barcodes (List[str], optional): The plate barcodes to read. Defaults to None (all plates).
+        acq_ids (List[Union[str, int]], optional): The plate acquisition IDs to read. Defaults to None (all acquisitions).
+
+    Returns:
+        pl.LazyFrame: The dataset with the partition columns restored.
+
+    Raises:
+        ValueError: If no aggregation level is given and the dataset holds several levels.
+        FileNotFoundError: If no partition matches the request.
+
+    Example:
+        ```python
+        lf = scan_morphology_dataset("data/my_experiment_dataset", aggregation_level="well", barcodes=["PB000123"])
+        df = lf.filter(pl.col("batch_id") == "CBK000001").collect()
+        ```
+    """
+    dataset_dir = Path(dataset_dir)
+    if aggregation_level is None:
+        levels = sorted(
+            path.name.split("=", 1)[1]
+            for path in dataset_dir.glob(f"{AGGREGATION_LEVEL_PARTITION}=*")
+        )
+        if len(levels) > 1:
+            raise ValueError(
+                f"The dataset holds several aggregation levels {levels}, please select one."
+            )
+        aggregation_level = levels[0] if levels else "*"
+
+    requested_values = {
+        cfg.METADATA_BARCODE_COLUMN: None
+        if barcodes is None
+        else {str(barcode) for barcode in barcodes},
+        cfg.METADATA_ACQID_COLUMN: None
+        if acq_ids is None
+        else {str(acq_id) for acq_id in acq_ids},
+    }
+
+    lazyframes = []
+    for file_path in sorted(
+        dataset_dir.glob(f"{AGGREGATION_LEVEL_PARTITION}={aggregation_level}/*/*/*.parquet")
+    ):
+        partition_values = _parse_partition_path(file_path, dataset_dir)
+        if any(
+            values is not None and partition_values.get(column) not in values
+            for column, values in requested_values.items()
+        ):
+            continue
+        lazyframes.append(
+            pl.scan_parquet(file_path, hive_partitioning=False).select(
+                [
+                    pl.lit(partition_values[column], dtype=pl.Utf8).alias(column)
+                    for column in PLATE_PARTITION_COLUMNS
+                ]
+                + [pl.all()]
+            )
+        )
+
+    if not lazyframes:
+        raise FileNotFoundError(
+            f"No partition in {dataset_dir} matches aggregation_level={aggregation_level}, barcodes={barcodes}, acq_ids={acq_ids}"
+        )
+    return pl.concat(lazyframes, how="diagonal")
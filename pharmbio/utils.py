@@ -2,7 +2,11 @@ import os
 import subprocess
 import polars as pl
 import pandas as pd
-from typing import Union, Literal
+import pyarrow.parquet as pq
+from collections import defaultdict
+from typing import Union, Optional, List, Dict, Set, Literal
+from . import config as cfg
+from .conversion import convert_csv_to_parquet, get_converted_csv
 from .logger import (
     log_error,
     log_info,
@@ -35,13 +39,117 @@ def get_file_extension(file_path_name):
     return None
 
 
-def read_file(filename, extension):
+def read_file_schema(filename, extension):
+    """
+    Reads the column names and types of a file without decoding its data.
+
+    Parquet schemas come from the file footer, CSV/TSV schemas from the footer of their
+    converted parquet copy (see `read_file`) or else from the header and the rows that the
+    types are inferred from.
+
+    Args:
+        filename (str): The name of the file without extension.
+        extension (str): The extension of the file.
+
+    Returns:
+        Union[Dict[str, pl.DataType], None]: The schema of the file, or None if the extension is not supported.
+
+    Example:
+        ```python
+        schema = read_file_schema("data/qcRAW_images_PB000123", ".parquet")
+        print(list(schema))
+        ```
+    """
+    if extension in [".csv", ".tsv"] and cfg.CSV_CONVERSION_CACHE:
+        # Served from the footer of the parquet copy if the file was converted
+        if converted_path := get_converted_csv(filename + extension):
+            return pl.read_parquet_schema(converted_path)
+
+    if extension == ".parquet":
+        return pl.read_parquet_schema(filename + extension)
+    elif extension in [".csv", ".tsv"]:
+        delimiter = "," if extension == ".csv" else "\t"
+        return dict(pl.scan_csv(filename + extension, separator=delimiter).schema)
+    return None
+
+
+def _parquet_null_columns(path: str):
+    """Returns the columns of a parquet file whose footer statistics count only nulls.
+
+    Parameters:
+        path (str): The parquet file.
+
+    Returns:
+        Tuple[Set[str], Set[str]]: The all-null columns, and the columns without null count statistics.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    null_counts = defaultdict(int)
+    unknown_columns = set()
+    for row_group_index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(row_group_index)
+        for column_index in range(row_group.num_columns):
+            column = row_group.column(column_index)
+            if column.statistics is None or not column.statistics.has_null_count:
+                unknown_columns.add(column.path_in_schema)
+            else:
+                null_counts[column.path_in_schema] += column.statistics.null_count
+    null_columns = {
+        name
+        for name, null_count in null_counts.items()
+        if null_count == metadata.num_rows and name not in unknown_columns
+    }
+    return null_columns, unknown_columns
+
+
+def _dtype_normalization_exprs(
+    schema: Dict[str, pl.DataType], null_columns: Set[str], compact_dtypes: bool
+) -> List[pl.Expr]:
+    """Returns the casts of the dtype normalization of `read_file`, one expression per changed column.
+
+    Parameters:
+        schema (Dict[str, pl.DataType]): The columns to consider and their dtypes.
+        null_columns (Set[str]): The columns without any value, cast to Float32.
+        compact_dtypes (bool): Whether Float64 columns are cast to Float32 and Int64 columns to Int32.
+
+    Returns:
+        List[pl.Expr]: The cast expressions.
+    """
+    cast_exprs = []
+    for name, dtype in schema.items():
+        if name in null_columns:
+            target_dtype = pl.Float32
+        elif compact_dtypes and dtype == pl.Float64:
+            target_dtype = pl.Float32
+        elif compact_dtypes and dtype == pl.Int64:
+            target_dtype = pl.Int32
+        else:
+            continue
+        if dtype != target_dtype:
+            cast_exprs.append(pl.col(name).cast(target_dtype))
+    return cast_exprs
+
+
+def read_file(
+    filename,
+    extension,
+    columns: Optional[List[str]] = None,
+    compact_dtypes: bool = False,
+    use_cache: Optional[bool] = None,
+):
     """
     Reads a file with the specified filename and extension and returns a DataFrame.
 
+    Columns without any value are cast to Float32 (they would otherwise be read as strings or
+    nulls). All casts are computed from the schema and applied as one expression list while the
+    file is scanned; for parquet files the all-null columns are known from the null counts in
+    the footer, other columns are checked once they are decoded.
+
     Args:
         filename (str): The name of the file to be read.
         extension (str): The extension of the file.
+        columns (List[str], optional): The columns to read, the others are not decoded. Defaults to None (all columns).
+        compact_dtypes (bool, optional): Whether to also cast Float64 columns to Float32 and Int64 columns to Int32. Defaults to False.
+        use_cache (bool, optional): Whether CSV/TSV files are converted to a parquet copy in the cache on first read and later read from it (see `pharmbio.conversion.convert_csv_to_parquet`). Defaults to None (`config.CSV_CONVERSION_CACHE`).
 
     Returns:
         Union[pl.DataFrame, None]: The DataFrame read from the file, or None if the extension is not supported.
@@ -55,34 +163,121 @@ def read_file(filename, extension):
         ```
     """
 
+    file_path = filename + extension
+    if use_cache is None:
+        use_cache = cfg.CSV_CONVERSION_CACHE
+    if extension in [".csv", ".tsv"] and use_cache:
+        # The text is parsed once, later reads are served from the parquet copy
+        file_path, extension = str(convert_csv_to_parquet(file_path)), ".parquet"
+
     if extension == ".parquet":
-        df = pl.read_parquet(filename + extension)
+        lf = pl.scan_parquet(file_path)
+        null_columns, unknown_columns = _parquet_null_columns(file_path)
     elif extension in [".csv", ".tsv"]:
         delimiter = "," if extension == ".csv" else "\t"
-        df = pl.read_csv(filename + extension, separator=delimiter)
+        lf = pl.scan_csv(file_path, separator=delimiter)
+        null_columns, unknown_columns = set(), None
     else:
         return None
-    # Change column type to float32 if all values are null (unless in some case it changes to str)
-    for name in df.columns:
-        if df[name].is_null().sum() == len(df[name]):
-            df = df.with_columns(df[name].cast(pl.Float32))
+    if columns is not None:
+        lf = lf.select(columns)
+
+    schema = lf.schema
+    null_columns = {
+        name
+        for name, dtype in schema.items()
+        if name in null_columns or dtype == pl.Null
+    }
+    df = lf.with_columns(
+        _dtype_normalization_exprs(schema, null_columns, compact_dtypes)
+    ).collect()
+
+    # Columns whose null count is only known once decoded (CSV, parquet without statistics)
+    unchecked_columns = [
+        name
+        for name in df.columns
+        if name not in null_columns
+        and (unknown_columns is None or name in unknown_columns)
+    ]
+    if unchecked_columns:
+        null_counts = df.select(pl.col(unchecked_columns).null_count()).row(0)
+        late_null_columns = {
+            name
+            for name, null_count in zip(unchecked_columns, null_counts)
+            if null_count == df.height
+        }
+        df = df.with_columns(
+            _dtype_normalization_exprs(
+                {name: df.schema[name] for name in late_null_columns},
+                late_null_columns,
+                compact_dtypes,
+            )
+        )
     return df
 
 
+# Center and scale statistics of the normalization methods, written to work on both
+# pl.Series and pl.Expr (also inside a group_by aggregation)
+NORMALIZATION_STATISTICS = {
+    "minmax": (lambda x: x.min(), lambda x: x.max() - x.min()),
+    "zscore": (lambda x: x.mean(), lambda x: x.std(ddof=1)),
+    # Median and median absolute deviation, scaled to match the SD of normal data
+    "robust": (lambda x: x.median(), lambda x: 1.4826 * (x - x.median()).abs().median()),
+}
+NORMALIZED_DTYPES = [pl.Float32, pl.Float64, pl.Int32, pl.Int64]
+
+# Names of normalize_by groups and their grouping columns
+NORMALIZATION_GROUPS = {
+    "plate": [cfg.METADATA_BARCODE_COLUMN],
+    "acquisition": [cfg.METADATA_ACQID_COLUMN],
+}
+
+
+def get_normalization_group_columns(
+    normalize_by: Optional[Union[str, List[str]]]
+) -> List[str]:
+    """
+    Resolves the `normalize_by` option into grouping columns.
+
+    Args:
+        normalize_by (Union[str, List[str]], optional): "plate", "acquisition", a column name, or a list of them.
+
+    Returns:
+        List[str]: The grouping columns, empty if `normalize_by` is None.
+    """
+    if normalize_by is None:
+        return []
+    if isinstance(normalize_by, str):
+        normalize_by = [normalize_by]
+    group_columns = []
+    for group in normalize_by:
+        group_columns.extend(NORMALIZATION_GROUPS.get(group, [group]))
+    return list(dict.fromkeys(group_columns))
+
+
 def normalize_df(
     df: Union[pl.DataFrame, pd.DataFrame],
-    method: Literal["zscore", "minmax"] = "zscore",
+    method: Literal["zscore", "minmax", "robust"] = "zscore",
+    normalize_by: Optional[Union[str, List[str]]] = None,
 ):
     """
     Normalizes the values in the DataFrame using the specified normalization method.
 
+    With `normalize_by`, every group, e.g. every plate, is normalized with its own statistics,
+    which removes plate-to-plate shifts. The statistics of all columns and groups are computed
+    in a single `group_by(...).agg` and joined back to the rows.
+
     Args:
         df (Union[pl.DataFrame, pd.DataFrame]): The input DataFrame to be normalized.
-        method (Literal["zscore", "minmax"], optional): The normalization method to be applied. Defaults to "zscore".
+        method (Literal["zscore", "minmax", "robust"], optional): The normalization method to be applied, "robust" uses the median and the scaled median absolute deviation. Defaults to "zscore".
+        normalize_by (Union[str, List[str]], optional): The groups to normalize separately: "plate", "acquisition", any grouping column, or a list of them. The grouping columns are kept as they are. Defaults to None (the whole DataFrame).
 
     Returns:
         pl.DataFrame: The normalized DataFrame.
 
+    Raises:
+        ValueError: If the method is unknown or a grouping column is missing.
+
     Example:
         ```python
         df = pd.DataFrame({
@@ -92,6 +287,9 @@ def normalize_df(
         })
         normalized_df = normalize_df(df, method='minmax')
         print(normalized_df)
+
+        # Per plate z-scores of the image quality data
+        normalized_qc_df = normalize_df(qc_df, normalize_by="plate")
         ```
     """
 
@@ -99,22 +297,53 @@ def normalize_df(
     if isinstance(df, pd.DataFrame):
         df = pl.from_pandas(df)
 
-    methods = {
-        "minmax": lambda x: (x - x.min()) / (x.max() - x.min()),
-        "zscore": lambda x: (x - x.mean()) / x.std(ddof=1),
-    }
+    if method not in NORMALIZATION_STATISTICS:
+        raise ValueError(
+            f"Unknown normalization method '{method}', expected one of {list(NORMALIZATION_STATISTICS)}."
+        )
+    center, scale = NORMALIZATION_STATISTICS[method]
+
+    group_columns = get_normalization_group_columns(normalize_by)
+    missing_columns = [col for col in group_columns if col not in df.columns]
+    if missing_columns:
+        raise ValueError(f"normalize_by columns {missing_columns} are not in the DataFrame.")
+
+    normalized_columns = [
+        col
+        for col, dtype in df.schema.items()
+        if dtype in NORMALIZED_DTYPES and col not in group_columns
+    ]
+
+    if not group_columns:
+        return df.select(
+            [
+                (
+                    (pl.col(col) - center(pl.col(col))) / scale(pl.col(col))
+                    if col in normalized_columns
+                    else pl.col(col)
+                ).alias(col)
+                for col in df.columns
+            ]
+        )
 
-    df = df.select(
+    # One pass for the statistics of all columns and groups, joined back to the rows
+    group_statistics = df.group_by(group_columns).agg(
+        [center(pl.col(col)).alias(f"__center_{col}") for col in normalized_columns]
+        + [scale(pl.col(col)).alias(f"__scale_{col}") for col in normalized_columns]
+    )
+    return df.join(
+        group_statistics, on=group_columns, how="left", join_nulls=True
+    ).select(
         [
             (
-                methods[method](df[col])
-                if df[col].dtype in [pl.Float32, pl.Float64, pl.Int32, pl.Int64]
-                else df[col]
+                (pl.col(col) - pl.col(f"__center_{col}")) / pl.col(f"__scale_{col}")
+                if col in normalized_columns
+                else pl.col(col)
             ).alias(col)
             for col in df.columns
         ]
     )
-    return df
+
 
 def pretty_print_channel_dict(d):
     for module, data in d.items():
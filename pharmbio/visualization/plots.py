@@ -6,8 +6,8 @@ import plotly.graph_objects as go
 import numpy as np
 from collections import defaultdict
 from typing import Union, Literal, Tuple, Set, List, Dict
-from ..data_processing.quality_control import get_channels, get_qc_data_dict
-from ..utils import normalize_df
+from ..data_processing.quality_control import get_channels, get_qc_column_index
+from ..utils import normalize_df, get_normalization_group_columns
 from ..config import COLORS, DEFAULT_QC_MODULES
 
 
@@ -151,7 +151,6 @@ def _lineplot(
     plate_names: List[str],
     plot_size: int = 1400,
     normalization: bool = True,
-    normalization_method: Literal["zscore", "minmax"] = "zscore",
     y_axis_range: Tuple = (-5, 5),
 ):
     fig = sp.make_subplots(
@@ -162,12 +161,8 @@ def _lineplot(
     )
 
     for x in range(len(data_frames)):
-        _, channel_names, raw_data = data_frames[x]
-        CurrentDataFrame = (
-            normalize_df(raw_data, method=normalization_method)
-            if normalization
-            else raw_data
-        )
+        # The data of the modules is normalized beforehand by quality_module_lineplot
+        _, channel_names, CurrentDataFrame = data_frames[x]
 
         min_val = CurrentDataFrame.min().to_numpy().min()  # minimum of all columns
         max_val = CurrentDataFrame.max().to_numpy().max()  # maximum of all columns
@@ -266,7 +261,8 @@ def quality_module_lineplot(
     title: str = "Unnamed",
     plot_size: int = 1400,
     normalization: bool = True,
-    normalization_method: Literal["zscore", "minmax"] = "zscore",
+    normalization_method: Literal["zscore", "minmax", "robust"] = "zscore",
+    normalize_by: Union[str, List[str]] = None,
     y_axis_range: Tuple = (-5, 5),
     colors: List[str] = COLORS,
 ):
@@ -278,7 +274,20 @@ def quality_module_lineplot(
 
     title = f"{title} scaled" if normalization else f"{title} raw data"
     image_quality_measures = sorted(list(qc_module_to_plot))
-    data_frame_dictionary = get_qc_data_dict(df, module_to_keep=qc_module_to_plot)
+    # Parsed once per schema and shared with get_channels
+    qc_column_index = get_qc_column_index(df)
+    plot_df = df
+    if normalization:
+        # All QC columns are normalized in one pass, per group with normalize_by (e.g. "plate")
+        plot_df = normalize_df(
+            df.select(get_normalization_group_columns(normalize_by) + qc_column_index.columns),
+            method=normalization_method,
+            normalize_by=normalize_by,
+        )
+    data_frame_dictionary = {
+        module: plot_df.select(qc_column_index.module_columns[module])
+        for module in qc_column_index.select_modules(module_to_keep=qc_module_to_plot)
+    }
     channel_dict = get_channels(df, qc_module_list=image_quality_measures)
     plate_names_list = (
         df.unique("Metadata_Barcode").select("Metadata_Barcode").to_series().to_list()
@@ -307,7 +316,6 @@ def quality_module_lineplot(
             title=title,
             plot_size=plot_size,
             normalization=normalization,
-            normalization_method=normalization_method,
             y_axis_range=y_axis_range,
             plate_names=plate_names_list,
         )
@@ -319,7 +327,6 @@ def quality_module_lineplot(
             title=title,
             plot_size=plot_size,
             normalization=normalization,
-            normalization_method=normalization_method,
             y_axis_range=y_axis_range,
             plate_names=plate_names_list,
         )
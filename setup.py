@@ -10,7 +10,7 @@ setup(
     packages=find_packages(),
     install_requires=[
         "pandas",
-        "polars>=0.19.5",
+        "polars>=0.20",
         "pyarrow",
         "ipywidgets",
         "sqlalchemy",
@@ -0,0 +1,43 @@
+import sqlite3
+
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.database.connection import dispose_engines
+from pharmbio.database.synthetic import create_synthetic_database
+
+# A plate whose barcode needs quoting in SQL
+QUOTED_BARCODE = "PB'000099"
+
+
+@pytest.fixture(scope="session")
+def synthetic_db_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("database") / "synthetic.db"
+    create_synthetic_database(
+        path, n_projects=2, plates_per_project=5, wells_per_plate=96, n_compounds=50
+    )
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            f'INSERT INTO "{cfg.DATABASE_SCHEMA["PLATE_LAYOUT_TABLE_NAME_ON_DB"]}" '
+            f"({', '.join(cfg.PLATE_LAYOUT_INFO)}) "
+            f"VALUES ({', '.join('?' * len(cfg.PLATE_LAYOUT_INFO))})",
+            [QUOTED_BARCODE, "A01", "CBK000001", 1.0, "U2OS", "c", "c", "CC", "InChI", "K"],
+        )
+    connection.close()
+    return path
+
+
+@pytest.fixture
+def quoted_barcode():
+    return QUOTED_BARCODE
+
+
+@pytest.fixture
+def synthetic_db(synthetic_db_path, tmp_path, monkeypatch):
+    """Points the package at the synthetic database, with an empty query cache."""
+    monkeypatch.setattr(cfg, "DB_URI", f"sqlite:///{synthetic_db_path}")
+    monkeypatch.setattr(cfg, "CACHE_DIRECTORY", str(tmp_path / "cache"))
+    monkeypatch.setattr(cfg, "DB_OFFLINE", False)
+    monkeypatch.setattr(cfg, "QUERY_CACHE", False)
+    yield cfg.DB_URI
+    dispose_engines()
@@ -0,0 +1,123 @@
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+import polars as pl
+
+from pharmbio.cache import ResultCache, file_fingerprint, make_cache_key
+
+
+def _entry_df(rows=100):
+    return pl.DataFrame({"a": range(rows), "b": [float(i) for i in range(rows)]})
+
+
+def _put_entries(directory, worker, n_entries):
+    cache = ResultCache(directory)
+    for i in range(n_entries):
+        cache.put(f"worker{worker}-{i}", _entry_df(), namespace=f"worker{worker}")
+
+
+def test_make_cache_key_is_stable_and_order_independent():
+    key = make_cache_key("plate", {"level": "well", "method": "median"}, [1, 2])
+    assert key == make_cache_key("plate", {"method": "median", "level": "well"}, [1, 2])
+    assert key != make_cache_key("plate", {"level": "site", "method": "median"}, [1, 2])
+    assert key != make_cache_key("plate", {"level": "well", "method": "median"}, [2, 1])
+
+
+def test_file_fingerprint_changes_with_the_file(tmp_path):
+    path = tmp_path / "featICF_cells.parquet"
+    _entry_df().write_parquet(path)
+    fingerprint = file_fingerprint(str(path))
+    assert fingerprint == file_fingerprint(str(path))
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert make_cache_key(fingerprint) != make_cache_key(file_fingerprint(str(path)))
+
+
+def test_put_and_get(tmp_path):
+    cache = ResultCache(tmp_path)
+    df = _entry_df()
+    assert cache.get("key") is None
+
+    path = cache.put("key", df, namespace="test")
+    assert "key" in cache
+    assert cache.get("key").equals(df)
+    assert cache.get_path("key") == path
+    # A new instance, e.g. of another session, finds the entry
+    assert ResultCache(tmp_path).get("key").equals(df)
+
+
+def test_max_age(tmp_path):
+    cache = ResultCache(tmp_path)
+    cache.put("key", _entry_df())
+    assert cache.get("key", max_age=3600) is not None
+    time.sleep(0.05)
+    assert cache.get("key", max_age=0.01) is None
+    # Expired entries are kept, e.g. for offline use
+    assert cache.get("key") is not None
+
+
+def test_get_does_not_rewrite_metadata(tmp_path):
+    cache = ResultCache(tmp_path)
+    cache.put("key", _entry_df())
+    metadata_mtime = os.stat(tmp_path / "key.json").st_mtime_ns
+    time.sleep(0.01)
+    cache.get("key")
+    cache.get_path("key")
+    assert os.stat(tmp_path / "key.json").st_mtime_ns == metadata_mtime
+
+
+def test_invalidate_and_clear(tmp_path):
+    cache = ResultCache(tmp_path)
+    cache.put("a", _entry_df(), namespace="plates")
+    cache.put("b", _entry_df(), namespace="plates")
+    cache.put("c", _entry_df(), namespace="queries")
+
+    assert cache.invalidate(namespace="plates") == 2
+    assert "a" not in cache and "b" not in cache and "c" in cache
+    assert not (tmp_path / "a.parquet").exists()
+
+    assert cache.invalidate(key="c") == 1
+    cache.put("d", _entry_df())
+    assert cache.clear() == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    entry_size = ResultCache(tmp_path / "size").put("key", _entry_df()).stat().st_size
+    cache = ResultCache(tmp_path / "cache", max_size_gb=2.5 * entry_size / 1024**3)
+
+    cache.put("a", _entry_df())
+    cache.put("b", _entry_df())
+    # "a" is older than "b", reading it makes "b" the least recently used entry
+    now = time.time()
+    os.utime(tmp_path / "cache" / "a.parquet", (now - 20, now - 20))
+    os.utime(tmp_path / "cache" / "b.parquet", (now - 10, now - 10))
+    assert cache.get("a") is not None
+
+    cache.put("c", _entry_df())
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+
+
+def test_concurrent_puts_from_processes_keep_all_entries(tmp_path):
+    n_workers, n_entries = 4, 5
+    with ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=mp.get_context("spawn")
+    ) as executor:
+        futures = [
+            executor.submit(_put_entries, str(tmp_path), worker, n_entries)
+            for worker in range(n_workers)
+        ]
+        for future in futures:
+            future.result()
+
+    cache = ResultCache(tmp_path)
+    for worker in range(n_workers):
+        for i in range(n_entries):
+            assert cache.get(f"worker{worker}-{i}").equals(_entry_df())
+    assert cache.invalidate(namespace="worker0") == n_entries
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,285 @@
+import os
+
+import numpy as np
+import polars as pl
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.dataset.cell_morphology import (
+    _check_key_fields,
+    _plate_cache_key,
+    _process_plate,
+    get_cell_morphology_data,
+)
+
+ACQ_ID = 3001
+BARCODE = "PB000001"
+WELLS = ["A01", "A02", "B01"]
+
+
+@pytest.fixture
+def plate_metadata(tmp_path):
+    for object_file_name in cfg.OBJECT_FILE_NAMES:
+        pl.DataFrame({cfg.OBJECT_ID_COLUMN: [1, 2, 3]}).write_parquet(
+            tmp_path / f"{object_file_name}.parquet"
+        )
+    return {
+        cfg.DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]: f"{tmp_path}/",
+        cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_ACQID_COLUMN"]: ACQ_ID,
+    }
+
+
+def _plate_layout(batch_id="CBK000001"):
+    return pl.DataFrame(
+        {
+            "barcode": ["PB000001", "PB000001"],
+            "well_id": ["A01", "A02"],
+            "batch_id": [batch_id, "CBK000002"],
+        }
+    )
+
+
+def _image_keys(acq_ids):
+    # The AcqID is stored above the bits of the well and site
+    return pl.Series(
+        cfg.IMAGE_KEY_COLUMN_NAME,
+        [acq_id * 2**cfg.IMAGE_KEY_ACQID_SHIFT + 5 for acq_id in acq_ids],
+        dtype=pl.UInt64,
+    )
+
+
+def _well_keys():
+    return pl.Series(cfg.WELL_KEY_COLUMN_NAME, [], dtype=pl.UInt64)
+
+
+def _key(plate_metadata, image_keys=None, df_plates=None, settings=None):
+    return _plate_cache_key(
+        plate_metadata,
+        _image_keys([]) if image_keys is None else image_keys,
+        _well_keys(),
+        _plate_layout() if df_plates is None else df_plates,
+        {"aggregation_level": "well"} if settings is None else settings,
+    )
+
+
+def test_plate_cache_key_is_stable(plate_metadata):
+    assert _key(plate_metadata) == _key(plate_metadata)
+
+
+def test_plate_cache_key_changes_with_the_plate_layout(plate_metadata):
+    assert _key(plate_metadata) != _key(
+        plate_metadata, df_plates=_plate_layout(batch_id="CBK999999")
+    )
+
+
+def test_plate_cache_key_changes_with_the_object_files(plate_metadata):
+    key = _key(plate_metadata)
+    object_file_path = (
+        f"{plate_metadata[cfg.DATABASE_SCHEMA['EXPERIMENT_RESULT_DIRECTORY_COLUMN']]}"
+        f"{cfg.OBJECT_FILE_NAMES[0]}.parquet"
+    )
+    stat = os.stat(object_file_path)
+    os.utime(object_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert _key(plate_metadata) != key
+
+
+def test_plate_cache_key_only_depends_on_outliers_of_the_plate(plate_metadata):
+    key = _key(plate_metadata)
+    assert _key(plate_metadata, image_keys=_image_keys([ACQ_ID + 1])) == key
+    assert _key(plate_metadata, image_keys=_image_keys([ACQ_ID])) != key
+
+
+def test_plate_cache_key_changes_with_the_settings(plate_metadata):
+    assert _key(plate_metadata) != _key(
+        plate_metadata, settings={"aggregation_level": "site"}
+    )
+
+
+def _key_metadata(**columns):
+    metadata = {
+        cfg.METADATA_ACQID_COLUMN: ["3001", "3002"],
+        cfg.METADATA_WELL_COLUMN: ["A01", "AF48"],
+        cfg.METADATA_SITE_COLUMN: [1, 9],
+        cfg.OBJECT_ID_COLUMN: [1, 2],
+    }
+    metadata.update(columns)
+    return pl.DataFrame(metadata)
+
+
+def test_key_fields_within_their_bits_pass():
+    _check_key_fields(_key_metadata(), "test data")
+    _check_key_fields(_key_metadata().lazy(), "test data")
+    _check_key_fields(
+        _key_metadata(
+            **{
+                cfg.METADATA_ACQID_COLUMN: [str(2**cfg.KEY_ACQID_BITS - 1), "1"],
+                cfg.METADATA_SITE_COLUMN: [2**cfg.KEY_SITE_BITS - 1, 1],
+                cfg.OBJECT_ID_COLUMN: [2**cfg.KEY_OBJECT_NUMBER_BITS - 1, 1],
+            }
+        ),
+        "test data",
+    )
+
+
+@pytest.mark.parametrize(
+    "columns",
+    [
+        {cfg.METADATA_ACQID_COLUMN: [str(2**cfg.KEY_ACQID_BITS), "3001"]},
+        {cfg.METADATA_WELL_COLUMN: ["A01", "AG01"]},
+        {cfg.METADATA_WELL_COLUMN: ["A01", "A64"]},
+        {cfg.METADATA_WELL_COLUMN: ["A01", "unknown"]},
+        {cfg.METADATA_SITE_COLUMN: [1, 2**cfg.KEY_SITE_BITS]},
+        {cfg.OBJECT_ID_COLUMN: [1, 2**cfg.KEY_OBJECT_NUMBER_BITS]},
+        {cfg.OBJECT_ID_COLUMN: [1, None]},
+    ],
+)
+def test_key_fields_out_of_their_bits_raise(columns):
+    with pytest.raises(ValueError):
+        _check_key_fields(_key_metadata(**columns), "test data")
+
+
+def _write_object_files(result_directory, n_sites=2, n_cells=4, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = [
+        (well, site, cell)
+        for well in WELLS
+        for site in range(1, n_sites + 1)
+        for cell in range(1, n_cells + 1)
+    ]
+    n = len(rows)
+    metadata = {
+        cfg.METADATA_ACQID_COLUMN: [ACQ_ID] * n,
+        cfg.METADATA_BARCODE_COLUMN: [BARCODE] * n,
+        cfg.METADATA_WELL_COLUMN: [row[0] for row in rows],
+        cfg.METADATA_SITE_COLUMN: [row[1] for row in rows],
+        cfg.OBJECT_ID_COLUMN: [row[2] for row in rows],
+        cfg.METADATA_IMAGE_NUMBER_COLUMN: list(range(n)),
+    }
+    pl.DataFrame(
+        {
+            **metadata,
+            cfg.CELL_CYTOPLASM_COUNT_COLUMN: [1] * n,
+            cfg.CELL_NUCLEI_COUNT_COLUMN: [1] * n,
+            "AreaShape_Area": rng.random(n),
+        }
+    ).write_parquet(result_directory / "featICF_cells.parquet")
+    pl.DataFrame(
+        {
+            **metadata,
+            cfg.OBJECT_PARENT_CELL_COLUMN: metadata[cfg.OBJECT_ID_COLUMN],
+            "AreaShape_Area": rng.random(n),
+        }
+    ).write_parquet(result_directory / "featICF_nuclei.parquet")
+    pl.DataFrame(
+        {
+            **metadata,
+            cfg.OBJECT_PARENT_CELL_COLUMN: metadata[cfg.OBJECT_ID_COLUMN],
+            "Parent_nuclei": metadata[cfg.OBJECT_ID_COLUMN],
+            "AreaShape_Area": rng.random(n),
+        }
+    ).write_parquet(result_directory / "featICF_cytoplasm.parquet")
+
+
+def _process_plate_job(result_directory, **kwargs):
+    df_plates = pl.DataFrame(
+        {col: [""] * len(WELLS) for col in cfg.PLATE_LAYOUT_INFO}
+    ).with_columns(
+        pl.lit(BARCODE).alias(cfg.DATABASE_SCHEMA["PLATE_LAYOUT_BARCODE_COLUMN"]),
+        pl.Series(cfg.DATABASE_SCHEMA["PLATE_LAYOUT_WELL_COLUMN"], WELLS),
+        pl.Series(cfg.DATABASE_SCHEMA["PLATE_COMPOUND_NAME_COLUMN"], ["CBK1", "CBK2", "CBK1"]),
+    )
+    return _process_plate(
+        plate_metadata={
+            cfg.DATABASE_SCHEMA["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]: f"{result_directory}/",
+            cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_ACQID_COLUMN"]: ACQ_ID,
+            cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"]: BARCODE,
+        },
+        img_series_to_delete=_image_keys([]),
+        well_series_to_delete=_well_keys(),
+        aggregation_method=cfg.AGGREGATION_METHOD_DICT,
+        df_plates=df_plates,
+        **kwargs,
+    )
+
+
+def test_process_plate_returns_paths_of_written_levels(tmp_path):
+    _write_object_files(tmp_path)
+    levels = ["cell", "site", "well"]
+    aggregated_levels = _process_plate_job(tmp_path, aggregation_level=levels)
+
+    output_filenames = {level: str(tmp_path / f"out_{level}.parquet") for level in levels}
+    level_paths = _process_plate_job(
+        tmp_path,
+        aggregation_level=levels,
+        output_filename_per_plate=output_filenames,
+        return_paths=True,
+    )
+
+    assert level_paths == output_filenames
+    assert aggregated_levels["cell"].height == len(WELLS) * 2 * 4
+    assert aggregated_levels["well"].height == len(WELLS)
+    for level in levels:
+        assert pl.read_parquet(level_paths[level]).equals(aggregated_levels[level])
+
+
+def test_process_plate_rejects_object_numbers_outside_the_cell_key(tmp_path):
+    _write_object_files(tmp_path)
+    cells_file = tmp_path / "featICF_cells.parquet"
+    pl.read_parquet(cells_file).with_columns(
+        (pl.col(cfg.OBJECT_ID_COLUMN) + 2**cfg.KEY_OBJECT_NUMBER_BITS).alias(
+            cfg.OBJECT_ID_COLUMN
+        )
+    ).write_parquet(cells_file)
+    with pytest.raises(ValueError, match="object number"):
+        _process_plate_job(tmp_path, aggregation_level="cell")
+
+
+def _all_outliers_qc_df(n_sites=2):
+    return pl.DataFrame(
+        [
+            {
+                cfg.METADATA_ACQID_COLUMN: ACQ_ID,
+                cfg.METADATA_BARCODE_COLUMN: BARCODE,
+                cfg.METADATA_WELL_COLUMN: well,
+                cfg.METADATA_SITE_COLUMN: site,
+                "outlier_flag": 1,
+            }
+            for well in WELLS
+            for site in range(1, n_sites + 1)
+        ]
+    ).with_columns(cfg.CONSTRUCTING_IMAGE_ID)
+
+
+@pytest.mark.parametrize(
+    "mode", [{}, {"streaming": True}, {"save_as_dataset": True}]
+)
+def test_all_plates_removed_by_quality_control_give_an_empty_result(
+    synthetic_db, tmp_path, mode
+):
+    result_directory = tmp_path / "results"
+    result_directory.mkdir()
+    _write_object_files(result_directory)
+    schema = cfg.DATABASE_SCHEMA
+    cell_morphology_ref_df = pl.DataFrame(
+        {
+            schema["EXPERIMENT_NAME_COLUMN"]: ["synthetic-project-0"],
+            schema["EXPERIMENT_PLATE_BARCODE_COLUMN"]: [BARCODE],
+            schema["EXPERIMENT_PLATE_ACQID_COLUMN"]: [ACQ_ID],
+            schema["EXPERIMENT_PLATE_AQNAME_COLUMN"]: [f"{BARCODE}_{ACQ_ID}"],
+            schema["EXPERIMENT_RESULT_DIRECTORY_COLUMN"]: [f"{result_directory}/"],
+        }
+    )
+
+    result = get_cell_morphology_data(
+        cell_morphology_ref_df,
+        flagged_qc_df=_all_outliers_qc_df(),
+        site_threshold=1,
+        compound_threshold=0.5,
+        aggregation_level="well",
+        path_to_save=str(tmp_path / "output"),
+        **mode,
+    )
+
+    if isinstance(result, pl.LazyFrame):
+        result = result.collect()
+    assert result.is_empty()
@@ -0,0 +1,161 @@
+import sqlite3
+import threading
+
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.database.connection import read_database, read_database_partitioned
+from pharmbio.database import plate_layout
+from pharmbio.database.plate_layout import PlateLayoutProvider
+from pharmbio.database.queries import plate_layout_sql_query
+
+
+def _layout_rows(db_path, barcodes):
+    schema = cfg.DATABASE_SCHEMA
+    with sqlite3.connect(db_path) as connection:
+        rows = connection.execute(
+            f"SELECT {', '.join(cfg.PLATE_LAYOUT_INFO)} FROM {schema['PLATE_LAYOUT_TABLE_NAME_ON_DB']} "
+            f"WHERE {schema['PLATE_LAYOUT_BARCODE_COLUMN']} IN ({', '.join('?' * len(barcodes))}) "
+            f"AND {schema['PLATE_COMPOUND_NAME_COLUMN']} <> ''",
+            barcodes,
+        ).fetchall()
+    connection.close()
+    return sorted(rows)
+
+
+def test_plate_layout_query_binds_the_barcodes(quoted_barcode):
+    query = plate_layout_sql_query(cfg.DATABASE_SCHEMA, ["PB000001", quoted_barcode])
+    other_query = plate_layout_sql_query(cfg.DATABASE_SCHEMA, "PB000002")
+
+    compiled_query = query.compile()
+    assert quoted_barcode not in str(compiled_query)
+    assert list(compiled_query.params.values())[0] == ["PB000001", quoted_barcode]
+    # Partitions of different plates share one query text
+    assert str(compiled_query) == str(other_query.compile())
+
+
+def test_plate_layout_provider_fetches_partitions(
+    synthetic_db, synthetic_db_path, quoted_barcode, monkeypatch
+):
+    monkeypatch.setattr(cfg, "DB_PARTITION_PLATES", 2)
+    barcodes = ["PB000000", "PB000001", "PB000007", quoted_barcode, "PB999999"]
+
+    provider = PlateLayoutProvider()
+    layout_df = provider.get(barcodes)
+
+    assert sorted(layout_df.select(cfg.PLATE_LAYOUT_INFO).rows()) == _layout_rows(
+        synthetic_db_path, barcodes
+    )
+    assert provider.get([quoted_barcode]).height == 1
+    # Plates without layout are served empty
+    assert provider.get(["PB999999"]).is_empty()
+
+
+def test_offline_read_without_use_cache_serves_the_cached_result(synthetic_db, monkeypatch):
+    query = "SELECT 1 AS a"
+    queries = ["SELECT 1 AS a", "SELECT 2 AS a"]
+    online_df = read_database(query, use_cache=True)
+    online_partitioned_df = read_database_partitioned(queries, use_cache=True)
+
+    monkeypatch.setattr(cfg, "DB_OFFLINE", True)
+    assert read_database(query, use_cache=False).equals(online_df)
+    assert read_database_partitioned(queries, use_cache=False).equals(online_partitioned_df)
+
+
+def test_offline_read_without_use_cache_raises_when_not_cached(synthetic_db, monkeypatch):
+    monkeypatch.setattr(cfg, "DB_OFFLINE", True)
+    with pytest.raises(ConnectionError):
+        read_database("SELECT 3 AS a", use_cache=False)
+    with pytest.raises(ConnectionError):
+        read_database_partitioned(["SELECT 3 AS a", "SELECT 4 AS a"], use_cache=False)
+
+
+def test_query_results_are_not_cached_by_default(synthetic_db, monkeypatch):
+    read_database("SELECT 5 AS a")
+    read_database_partitioned(["SELECT 5 AS a", "SELECT 6 AS a"])
+
+    monkeypatch.setattr(cfg, "DB_OFFLINE", True)
+    with pytest.raises(ConnectionError):
+        read_database("SELECT 5 AS a")
+    with pytest.raises(ConnectionError):
+        read_database_partitioned(["SELECT 5 AS a", "SELECT 6 AS a"])
+
+
+def test_cached_results_are_served_until_they_expire(synthetic_db, tmp_path, monkeypatch):
+    db_path = tmp_path / "plates.db"
+    with sqlite3.connect(db_path) as connection:
+        connection.execute("CREATE TABLE plates (barcode TEXT)")
+        connection.execute("INSERT INTO plates VALUES ('PB000001')")
+    connection.close()
+    uri = f"sqlite:///{db_path}"
+    query = "SELECT COUNT(*) AS n FROM plates"
+    monkeypatch.setattr(cfg, "QUERY_CACHE", True)
+    assert read_database(query, uri)["n"][0] == 1
+
+    # A plate added after the result was cached is only seen once the result expires
+    with sqlite3.connect(db_path) as connection:
+        connection.execute("INSERT INTO plates VALUES ('PB000002')")
+    connection.close()
+    assert read_database(query, uri)["n"][0] == 1
+    assert read_database(query, uri, use_cache=False)["n"][0] == 2
+    assert read_database(query, uri, ttl=0)["n"][0] == 2
+
+
+def test_plate_layout_provider_refetches_expired_and_invalidated_plates(
+    synthetic_db, synthetic_db_path, monkeypatch
+):
+    fetched = []
+    read_partitioned = plate_layout.read_database_partitioned
+
+    def counting_read(queries, uri=None):
+        fetched.append(uri)
+        return read_partitioned(queries, uri)
+
+    monkeypatch.setattr(plate_layout, "read_database_partitioned", counting_read)
+    provider = PlateLayoutProvider()
+    layout_df = provider.get(["PB000000"])
+    assert provider.get(["PB000000"]).equals(layout_df)
+    assert len(fetched) == 1
+
+    provider.invalidate(["PB000000"])
+    assert provider.get(["PB000000"]).equals(layout_df)
+    assert len(fetched) == 2
+
+    monkeypatch.setattr(cfg, "QUERY_CACHE_TTL", 0)
+    provider.get(["PB000000"])
+    assert len(fetched) == 3
+
+    # Plates are cached per database
+    monkeypatch.setattr(cfg, "QUERY_CACHE_TTL", 3600)
+    directory, file_name = synthetic_db_path.parent, synthetic_db_path.name
+    monkeypatch.setattr(cfg, "DB_URI", f"sqlite:///{directory}/./{file_name}")
+    assert provider.get(["PB000000"]).equals(layout_df)
+    assert fetched[3:] == [cfg.DB_URI]
+
+
+def test_plate_layout_provider_serves_cached_plates_during_a_fetch(synthetic_db, monkeypatch):
+    provider = PlateLayoutProvider()
+    cached_df = provider.get(["PB000000"])
+
+    fetch_started = threading.Event()
+    release_fetch = threading.Event()
+    fetch_timed_out = []
+    read_partitioned = plate_layout.read_database_partitioned
+
+    def blocking_read(queries, uri=None):
+        fetch_started.set()
+        fetch_timed_out.append(not release_fetch.wait(timeout=5))
+        return read_partitioned(queries, uri)
+
+    monkeypatch.setattr(plate_layout, "read_database_partitioned", blocking_read)
+    fetch_thread = threading.Thread(target=provider.fetch, args=(["PB000001"],))
+    fetch_thread.start()
+    try:
+        assert fetch_started.wait(timeout=10)
+        assert provider.get(["PB000000"]).equals(cached_df)
+    finally:
+        release_fetch.set()
+        fetch_thread.join()
+    # The cached plate was served before the fetch was released
+    assert fetch_timed_out == [False]
+    assert not provider.get(["PB000001"]).is_empty()
@@ -0,0 +1,88 @@
+import json
+import logging
+
+import numpy as np
+import polars as pl
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.dataset import experiment as experiment_module
+from pharmbio.dataset.experiment import Experiment
+
+QC_COLUMNS = [
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}FocusScore_CONC",
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}FocusScore_HOECHST",
+]
+
+
+def _qc_data():
+    values = np.random.default_rng(0).normal(loc=10.0, scale=2.0, size=(500, len(QC_COLUMNS)))
+    values[:5] += 30.0
+    return pl.DataFrame(
+        {
+            cfg.METADATA_BARCODE_COLUMN: ["PB000000"] * 500,
+            **{col: values[:, i] for i, col in enumerate(QC_COLUMNS)},
+        }
+    )
+
+
+def _experiment(**settings):
+    """Returns an experiment with the settings and image quality data, without reading the database."""
+    experiment = Experiment.__new__(Experiment)
+    experiment.__dict__.update(settings, image_quality_data=_qc_data())
+    return experiment
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{"method": "mahalanobis"}, {"method": "isolation"}, {"normalization": "robust"}],
+)
+def test_unsupported_qc_model_settings_raise_before_reading_data(tmp_path, settings):
+    settings_file = tmp_path / "experiment.json"
+    settings_file.write_text(
+        json.dumps(
+            {
+                "experiment_name": "synthetic-project-0",
+                "qc_model_path": str(tmp_path / "qc_model.json"),
+                **settings,
+            }
+        )
+    )
+    with pytest.raises(ValueError, match="qc_model_path"):
+        Experiment(settings_file)
+
+
+def test_qc_model_parses_the_iqr_normalization_setting(tmp_path):
+    flagged = {}
+    for i, value in enumerate([False, "False", "false"]):
+        experiment = _experiment(
+            method="IQR",
+            IQR_normalization=value,
+            qc_model_path=str(tmp_path / f"qc_model_{i}.json"),
+        )
+        flagged[value] = experiment.apply_qc_model()
+    assert flagged[False].equals(flagged["False"])
+    assert flagged[False].equals(flagged["false"])
+    assert flagged[False]["outlier_flag"].head(5).sum() == 5
+
+    experiment = _experiment(IQR_normalization="no", qc_model_path=str(tmp_path / "qc_model.json"))
+    with pytest.raises(ValueError, match="IQR_normalization"):
+        experiment.apply_qc_model()
+
+
+def test_qc_model_warns_that_normalize_by_is_ignored(tmp_path, caplog):
+    experiment = _experiment(normalize_by="plate", qc_model_path=str(tmp_path / "qc_model.json"))
+    with caplog.at_level(logging.WARNING):
+        flagged = experiment.apply_qc_model()
+    assert "normalize_by is ignored" in caplog.text
+    assert flagged.equals(_experiment(qc_model_path=str(tmp_path / "qc_model.json")).apply_qc_model())
+
+
+def test_qc_threads_are_set_separately_from_the_morphology_processes(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        experiment_module, "flag_outlier_images", lambda **kwargs: calls.append(kwargs)
+    )
+    _experiment(max_workers=8).flag_outlier_images()
+    _experiment(max_workers=8, qc_max_workers=2).flag_outlier_images()
+    assert [call["max_workers"] for call in calls] == [None, 2]
@@ -0,0 +1,44 @@
+import polars as pl
+
+from pharmbio import config as cfg
+from pharmbio.dataset.image_quality import get_image_quality_ref
+
+PROJECT = "synthetic-project-0"
+BARCODE_COLUMN = cfg.DATABASE_SCHEMA["EXPERIMENT_PLATE_BARCODE_COLUMN"]
+ANALYSIS_ID_COLUMN = cfg.DATABASE_SCHEMA["EXPERIMENT_ANALYSIS_ID_COLUMN"]
+
+
+def _replicated_analyses():
+    all_analyses = get_image_quality_ref(PROJECT, drop_replication="None")
+    return all_analyses.filter(pl.col(BARCODE_COLUMN).is_duplicated()).sort(
+        BARCODE_COLUMN, ANALYSIS_ID_COLUMN
+    )
+
+
+def test_filter_is_applied_after_the_latest_analyses_are_selected(synthetic_db):
+    replicated = _replicated_analyses()
+    assert not replicated.is_empty()
+    older_analysis_id = replicated[ANALYSIS_ID_COLUMN][0]
+    latest_analysis_id = replicated[ANALYSIS_ID_COLUMN][1]
+    barcode = replicated[BARCODE_COLUMN][0]
+
+    # Only the older analysis of the plate matches, it was dropped as a replication
+    assert get_image_quality_ref(
+        PROJECT, filter={ANALYSIS_ID_COLUMN: {"in": [older_analysis_id]}}
+    ).is_empty()
+    assert get_image_quality_ref(
+        PROJECT,
+        drop_replication="None",
+        filter={ANALYSIS_ID_COLUMN: {"in": [older_analysis_id]}},
+    ).height == 1
+
+    by_barcode = get_image_quality_ref(PROJECT, filter={BARCODE_COLUMN: {"in": [barcode]}})
+    assert by_barcode[ANALYSIS_ID_COLUMN].to_list() == [latest_analysis_id]
+
+
+def test_filtered_reference_matches_filtering_the_deduplicated_reference(synthetic_db):
+    filter = {BARCODE_COLUMN: ["PB00000[0-3]"]}
+    expected = get_image_quality_ref(PROJECT).filter(
+        pl.col(BARCODE_COLUMN).str.contains("PB00000[0-3]")
+    )
+    assert get_image_quality_ref(PROJECT, filter=filter).equals(expected)
@@ -0,0 +1,105 @@
+import polars as pl
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.dataset.morphology_dataset import (
+    get_partition_dir,
+    has_plate_partition,
+    scan_morphology_dataset,
+    upsert_plate_partitions,
+)
+
+
+def _plates_df(plates, value=0.0):
+    rows = [
+        {
+            cfg.METADATA_BARCODE_COLUMN: barcode,
+            cfg.METADATA_ACQID_COLUMN: str(acq_id),
+            cfg.METADATA_WELL_COLUMN: well,
+            "feature": value,
+        }
+        for barcode, acq_id in plates
+        for well in ["A01", "A02"]
+    ]
+    return pl.DataFrame(rows)
+
+
+def _sorted(df):
+    return df.sort(cfg.METADATA_BARCODE_COLUMN, cfg.METADATA_WELL_COLUMN)
+
+
+def test_upsert_writes_one_partition_per_plate(tmp_path):
+    df = _plates_df([("PB1", 3001), ("PB2", 3002)])
+    written_files = upsert_plate_partitions(df, tmp_path, "well", partition_tag="a")
+
+    assert written_files == [
+        get_partition_dir(tmp_path, "well", "PB1", 3001) / "part-a.parquet",
+        get_partition_dir(tmp_path, "well", "PB2", 3002) / "part-a.parquet",
+    ]
+    # The partition columns are stored in the directory names only
+    assert pl.read_parquet(written_files[0], hive_partitioning=False).columns == [
+        cfg.METADATA_WELL_COLUMN,
+        "feature",
+    ]
+
+    result = scan_morphology_dataset(tmp_path, "well").collect()
+    assert _sorted(result).equals(_sorted(df.select(result.columns)))
+
+
+def test_upsert_replaces_only_the_given_plates(tmp_path):
+    upsert_plate_partitions(_plates_df([("PB1", 3001), ("PB2", 3002)]), tmp_path, "well", "a")
+    untouched_file = get_partition_dir(tmp_path, "well", "PB2", 3002) / "part-a.parquet"
+    untouched_mtime = untouched_file.stat().st_mtime_ns
+
+    upsert_plate_partitions(_plates_df([("PB1", 3001)], value=1.0), tmp_path, "well", "b")
+
+    assert has_plate_partition(tmp_path, "well", "PB1", 3001, partition_tag="b")
+    assert not has_plate_partition(tmp_path, "well", "PB1", 3001, partition_tag="a")
+    assert list(get_partition_dir(tmp_path, "well", "PB1", 3001).iterdir()) == [
+        get_partition_dir(tmp_path, "well", "PB1", 3001) / "part-b.parquet"
+    ]
+    assert untouched_file.stat().st_mtime_ns == untouched_mtime
+
+    result = scan_morphology_dataset(tmp_path, "well").collect()
+    features = dict(
+        result.group_by(cfg.METADATA_BARCODE_COLUMN).agg(pl.col("feature").first()).rows()
+    )
+    assert features == {"PB1": 1.0, "PB2": 0.0}
+    assert result.height == 4
+
+
+def test_has_plate_partition(tmp_path):
+    assert not has_plate_partition(tmp_path, "well", "PB1", 3001)
+    upsert_plate_partitions(_plates_df([("PB1", 3001)]), tmp_path, "well", "a")
+    assert has_plate_partition(tmp_path, "well", "PB1", 3001)
+    assert has_plate_partition(tmp_path, "well", "PB1", 3001, partition_tag="a")
+    assert not has_plate_partition(tmp_path, "site", "PB1", 3001)
+
+
+def test_scan_prunes_partitions_without_opening_them(tmp_path):
+    upsert_plate_partitions(
+        _plates_df([("PB1", 3001), ("PB2", 3002), ("PB3", 3003)]), tmp_path, "well"
+    )
+    # A file that cannot be read fails the scan if its partition is not pruned
+    (get_partition_dir(tmp_path, "well", "PB2", 3002) / "part-0.parquet").write_bytes(b"")
+
+    by_barcode = scan_morphology_dataset(tmp_path, "well", barcodes=["PB1", "PB3"]).collect()
+    assert sorted(by_barcode[cfg.METADATA_BARCODE_COLUMN].unique()) == ["PB1", "PB3"]
+
+    by_acq_id = scan_morphology_dataset(tmp_path, "well", acq_ids=[3003]).collect()
+    assert by_acq_id[cfg.METADATA_ACQID_COLUMN].unique().to_list() == ["3003"]
+
+    with pytest.raises(pl.ComputeError):
+        scan_morphology_dataset(tmp_path, "well").collect()
+
+
+def test_scan_selects_the_aggregation_level(tmp_path):
+    upsert_plate_partitions(_plates_df([("PB1", 3001)]), tmp_path, "well")
+    assert scan_morphology_dataset(tmp_path).collect().height == 2
+
+    upsert_plate_partitions(_plates_df([("PB1", 3001)]).head(1), tmp_path, "plate")
+    assert scan_morphology_dataset(tmp_path, "plate").collect().height == 1
+    with pytest.raises(ValueError):
+        scan_morphology_dataset(tmp_path)
+    with pytest.raises(FileNotFoundError):
+        scan_morphology_dataset(tmp_path, "well", barcodes=["PB9"])
@@ -0,0 +1,146 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.data_processing import multivariate_outliers
+from pharmbio.data_processing.multivariate_outliers import (
+    _chi2_quantile,
+    isolation_forest_scores,
+    multivariate_outlier_flags,
+    robust_mahalanobis_distances,
+)
+from pharmbio.data_processing.quality_control import flag_outlier_images
+
+N_CHANNELS = 4
+FOCUS_COLUMNS = [
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}FocusScore_{channel}"
+    for channel in ["CONC", "HOECHST", "MITO", "PHAandWGA"]
+]
+
+
+def _correlated_images(n_images=2000, n_outliers=100, seed=0):
+    """Returns images with strongly correlated channels, the first rows shifted as a cluster."""
+    rng = np.random.default_rng(seed)
+    covariance = np.full((N_CHANNELS, N_CHANNELS), 0.9) + 0.1 * np.eye(N_CHANNELS)
+    X = rng.multivariate_normal(np.full(N_CHANNELS, 10.0), covariance, size=n_images)
+    X[:n_outliers] += rng.normal(6.0, 0.2, size=(n_outliers, N_CHANNELS))
+    return X
+
+
+def test_chi2_quantile_approximation():
+    # Exact quantiles of the chi-square distribution, the approximation is within a few percent
+    assert _chi2_quantile(0.5, 4) == pytest.approx(3.357, rel=2e-2)
+    assert _chi2_quantile(0.975, 4) == pytest.approx(11.143, rel=2e-2)
+    assert _chi2_quantile(0.999, 4) == pytest.approx(18.467, rel=2e-2)
+    assert _chi2_quantile(0.999, 30) == pytest.approx(59.703, rel=2e-3)
+
+
+def test_robust_distances_are_not_masked_by_a_cluster_of_outliers():
+    X = _correlated_images()
+    distances = robust_mahalanobis_distances(X)
+    cutoff = _chi2_quantile(0.999, N_CHANNELS)
+
+    assert (distances[:100] > cutoff).all()
+    assert (distances[100:] > cutoff).mean() < 0.01
+    # The inliers follow the chi-square distribution
+    assert np.median(distances[100:]) == pytest.approx(_chi2_quantile(0.5, N_CHANNELS), rel=0.15)
+
+    # The classical estimate is pulled towards the cluster and misses it
+    centered = X - X.mean(axis=0)
+    classical = np.einsum(
+        "ij,jk,ik->i", centered, np.linalg.inv(np.cov(X, rowvar=False)), centered
+    )
+    assert (classical[:100] > cutoff).mean() < 0.5
+
+
+def test_robust_distances_flag_images_off_across_correlated_channels():
+    X = _correlated_images(n_outliers=0)
+    # Within 2.5 standard deviations in every channel, against the correlation of the channels
+    X[0] = 10.0 + np.array([2.5, -2.5, 2.5, -2.5])
+    distances = robust_mahalanobis_distances(X)
+    assert distances[0] > _chi2_quantile(0.999, N_CHANNELS)
+    assert distances[0] == distances.max()
+
+
+def test_robust_distances_skip_rows_with_missing_values():
+    X = _correlated_images(n_images=200, n_outliers=0)
+    X[3, 1] = np.nan
+    X[7, 0] = np.inf
+    distances = robust_mahalanobis_distances(X)
+    assert np.isnan(distances[[3, 7]]).all()
+    assert np.isfinite(np.delete(distances, [3, 7])).all()
+
+    assert np.isnan(robust_mahalanobis_distances(X[:N_CHANNELS + 1])).all()
+
+
+def test_robust_distances_fitted_on_a_subset():
+    X = _correlated_images()
+    subset_distances = robust_mahalanobis_distances(X, max_fit_rows=1000)
+    cutoff = _chi2_quantile(0.999, N_CHANNELS)
+    assert (subset_distances[:100] > cutoff).all()
+    assert (subset_distances[100:] > cutoff).mean() < 0.01
+
+
+def test_isolation_scores_separate_outliers():
+    X = _correlated_images(n_images=500, n_outliers=10)
+    scores = isolation_forest_scores(X)
+
+    assert ((scores > 0) & (scores < 1)).all()
+    assert (scores[:10] > 0.7).all()
+    assert (scores[10:] <= 0.7).all()
+    assert np.median(scores[10:]) < 0.5
+    np.testing.assert_array_equal(scores, isolation_forest_scores(X))
+    assert not np.array_equal(scores, isolation_forest_scores(X, seed=1))
+
+
+def test_isolation_scores_do_not_depend_on_the_batch_size(monkeypatch):
+    X = _correlated_images(n_images=500)
+    X[5, 2] = np.nan
+    scores = isolation_forest_scores(X, n_trees=50)
+
+    monkeypatch.setattr(multivariate_outliers, "_ISOLATION_BATCH_ELEMENTS", 50 * 7)
+    batched_scores = isolation_forest_scores(X, n_trees=50)
+    np.testing.assert_array_equal(scores, batched_scores)
+    assert np.isnan(scores[5])
+
+
+def _qc_data(n_plates=2):
+    plates = [_correlated_images(n_images=500, n_outliers=10, seed=seed) for seed in range(n_plates)]
+    # The second plate is brighter, its outliers are only outliers within the plate
+    plates = [X + 3.0 * i for i, X in enumerate(plates)]
+    X = np.vstack(plates)
+    return pl.DataFrame(
+        {
+            cfg.METADATA_BARCODE_COLUMN: [f"PB{i:06d}" for i in range(n_plates) for _ in range(500)],
+            **{col: X[:, i] for i, col in enumerate(FOCUS_COLUMNS)},
+        }
+    )
+
+
+@pytest.mark.parametrize("method", ["mahalanobis", "isolation"])
+def test_flags_are_fitted_per_group(method):
+    qc_data = _qc_data()
+    flags = multivariate_outlier_flags(
+        qc_data,
+        {"FocusScore": FOCUS_COLUMNS},
+        method=method,
+        group_columns=[cfg.METADATA_BARCODE_COLUMN],
+        max_workers=2,
+    )["FocusScore"]
+
+    outliers = np.zeros(qc_data.height, dtype=bool)
+    outliers[:10] = outliers[500:510] = True
+    assert flags[outliers].all()
+    assert flags[~outliers].mean() < 0.01
+
+    with pytest.raises(ValueError):
+        multivariate_outlier_flags(qc_data, {"FocusScore": FOCUS_COLUMNS}, method="SD")
+
+
+def test_flag_outlier_images_with_a_multivariate_method():
+    qc_data = _qc_data()
+    flagged = flag_outlier_images(qc_data, module_to_keep={"FocusScore"}, method="mahalanobis")
+    assert "OutlierMahalanobis_FocusScore_0.999" in flagged.columns
+    assert flagged["outlier_flag"].head(10).sum() == 10
+    assert flagged["outlier_flag"].slice(500, 10).sum() == 10
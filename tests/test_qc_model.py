@@ -0,0 +1,141 @@
+import json
+
+import numpy as np
+import polars as pl
+import pytest
+
+from pharmbio import config as cfg
+from pharmbio.data_processing.qc_model import QCModel, QuantileSketch
+from pharmbio.data_processing.quality_control import flag_outlier_images
+
+QC_COLUMNS = [
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}FocusScore_CONC",
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}FocusScore_HOECHST",
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}MeanIntensity_CONC",
+    f"{cfg.IMAGE_QUALITY_COLUMN_PREFIX}MeanIntensity_HOECHST",
+]
+
+
+def _qc_data(n_images=2000, seed=0, outliers=20):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(loc=10.0, scale=2.0, size=(n_images, len(QC_COLUMNS)))
+    values[:outliers] += 30.0
+    return pl.DataFrame(
+        {
+            cfg.METADATA_BARCODE_COLUMN: [f"PB{seed:06d}"] * n_images,
+            **{col: values[:, i] for i, col in enumerate(QC_COLUMNS)},
+        }
+    )
+
+
+def _flag_columns(df):
+    return [col for col in df.columns if col.startswith("Outlier")]
+
+
+def test_sketch_quantiles_are_close_to_exact_quantiles():
+    values = np.random.default_rng(0).lognormal(size=100_000)
+    sketch = QuantileSketch().update(values)
+
+    assert sketch.count == values.size
+    # The error of a t-digest is bounded in rank, it is smallest near the tails
+    for q in [0.001, 0.01, 0.25, 0.5, 0.75, 0.99, 0.999]:
+        assert np.mean(values <= sketch.quantile(q)) == pytest.approx(q, abs=5e-4)
+    assert sketch.quantile(0) == values.min()
+    assert sketch.quantile(1) == values.max()
+    # The sketch is bounded by the compression, not by the number of values
+    assert sketch.means.size <= sketch.compression
+
+
+def test_merged_sketches_match_one_sketch_of_all_values():
+    rng = np.random.default_rng(1)
+    batches = [rng.normal(loc=i, size=20_000) for i in range(5)]
+    all_values = np.concatenate(batches)
+
+    merged = QuantileSketch()
+    for batch in batches:
+        merged.merge(QuantileSketch().update(batch))
+    single = QuantileSketch().update(all_values)
+
+    assert merged.count == single.count == all_values.size
+    assert merged.min == all_values.min() and merged.max == all_values.max()
+    for q in [0.01, 0.25, 0.5, 0.75, 0.99]:
+        assert merged.quantile(q) == pytest.approx(single.quantile(q), abs=0.02)
+        assert merged.quantile(q) == pytest.approx(np.quantile(all_values, q), abs=0.02)
+
+
+def test_sketch_ignores_missing_values_and_round_trips():
+    sketch = QuantileSketch().update(pl.Series([1.0, None, float("nan"), 3.0]))
+    assert sketch.count == 2
+    assert np.isnan(QuantileSketch().quantile(0.5))
+
+    restored = QuantileSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert restored.quantile(0.5) == sketch.quantile(0.5)
+    assert restored.to_dict() == sketch.to_dict()
+
+
+@pytest.mark.parametrize("method", ["SD", "IQR"])
+def test_model_flags_match_flag_outlier_images(method):
+    qc_data = _qc_data()
+    expected = flag_outlier_images(qc_data, method=method)
+    flagged = QCModel(method=method).fit(qc_data).apply(qc_data)
+
+    if method == "SD":
+        assert _flag_columns(flagged) == _flag_columns(expected)
+        assert flagged.equals(expected)
+    else:
+        # The IQR thresholds come from the quantile sketches, up to their approximation
+        mismatches = (flagged["outlier_flag"] != expected["outlier_flag"]).sum()
+        assert mismatches <= 0.005 * qc_data.height
+    assert flagged["outlier_flag"].head(20).sum() == 20
+
+
+def test_saved_model_loads_with_the_same_flags(tmp_path):
+    qc_data = _qc_data()
+    model = QCModel(method="IQR", module_to_keep={"FocusScore"}).fit(qc_data)
+    path = model.save(tmp_path / "models" / "qc_model.json")
+
+    loaded = QCModel.load(path)
+    assert loaded.settings == model.settings
+    assert loaded.module_columns == model.module_columns == {"FocusScore": QC_COLUMNS[:2]}
+    assert loaded.statistics == model.statistics
+    assert loaded.get_thresholds() == model.get_thresholds()
+    assert loaded.apply(qc_data).equals(model.apply(qc_data))
+
+
+def test_loading_another_format_version_raises(tmp_path):
+    path = QCModel().fit(_qc_data()).save(tmp_path / "qc_model.json")
+    data = json.loads(path.read_text())
+    data["format_version"] = 0
+    path.write_text(json.dumps(data))
+    with pytest.raises(ValueError):
+        QCModel.load(path)
+
+
+def test_incremental_updates_match_a_fit_on_all_plates():
+    plates = [_qc_data(n_images=500, seed=seed) for seed in range(4)]
+    incremental = QCModel(method="SD").fit(plates[0])
+    for plate in plates[1:]:
+        incremental.update(plate)
+    fitted = QCModel(method="SD").fit(pl.concat(plates))
+
+    assert incremental.image_count == fitted.image_count == 2000
+    for col in QC_COLUMNS:
+        for statistic in ["count", "mean", "m2", "min", "max"]:
+            assert incremental.statistics[col][statistic] == pytest.approx(
+                fitted.statistics[col][statistic]
+            )
+
+    new_plate = _qc_data(n_images=100, seed=10)
+    assert incremental.apply(new_plate).equals(fitted.apply(new_plate))
+
+
+def test_apply_does_not_change_the_model_and_update_requires_a_fit():
+    model = QCModel().fit(_qc_data())
+    statistics = json.dumps(model.statistics)
+    model.apply(_qc_data(seed=1))
+    assert json.dumps(model.statistics) == statistics
+
+    with pytest.raises(ValueError):
+        QCModel().update(_qc_data())
+    with pytest.raises(ValueError):
+        QCModel(normalization="robust")